@@ -0,0 +1,95 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from base.engine import vhlr_engine
+from base.queue.vhlr_queue import QueueTimeout
+from base.views.vhlr_views import queue_client, storeResult
+
+# Cache misses of the ASGI entry points (FastPath, LookupSocket), dialed
+# without a Django request thread. Django runs sync views on one thread per
+# process, so a miss waiting there for its whole dial would hold up every
+# other miss of the process. Here a queue lookup blocks a thread of its own
+# executor while the dialer works, an inline lookup waits on the engine loop.
+
+DEADLINE_EXCEEDED = 'Deadline exceeded before dialing'
+
+
+class Dispatcher(object):
+	def __init__(self, threads):
+		self.executor = ThreadPoolExecutor(threads, thread_name_prefix='vhlr-asgi-lookup')
+		self.detached = set() # lookups finishing for clients gone
+
+	async def lookup(self, dst_number, number, connect_timeout, priority, deadline):
+		"""
+		(status, body) of a cache miss, as api/vhlr/ answers it. Shielded: a
+		client that goes away drops the answer, not the dial and its caching.
+		"""
+		task = asyncio.create_task(self.resolve(dst_number, number, connect_timeout, priority, deadline))
+		self.detached.add(task)
+		task.add_done_callback(self.detached.discard)
+		return await asyncio.shield(task)
+
+	async def resolve(self, dst_number, number, connect_timeout, priority, deadline):
+		if deadline is not None and time.time() >= deadline:
+			return deadlineExceeded(dst_number)
+
+		loop = asyncio.get_running_loop()
+		try:
+			disconnect_code, retrying, partial = await self.dispatch(number, connect_timeout, priority, deadline)
+		except (QueueTimeout, asyncio.TimeoutError) as e:
+			return 504, {'number': dst_number, 'error': str(e) or 'No result in time'}
+		except vhlr_engine.EngineNotReady as e:
+			return 503, {'number': dst_number, 'error': str(e)}
+		except Exception as e:
+			return 502, {'number': dst_number, 'error': str(e)}
+
+		if partial and not disconnect_code:
+			return deadlineExceeded(dst_number)
+		body = {'number': dst_number, 'code': disconnect_code}
+		if partial:
+			# The state so far, not an outcome: not cached
+			body['partial'] = True
+		elif retrying:
+			# The dialer caches the final outcome itself
+			body['retrying'] = True
+		elif not vhlr_engine.isRetryable(disconnect_code):
+			await loop.run_in_executor(None, storeResult, number, disconnect_code)
+		return 200, body
+
+	async def dispatch(self, number, connect_timeout, priority, deadline):
+		"""Returns (disconnect code, retrying, partial), see EngineHost.lookup()."""
+		loop = asyncio.get_running_loop()
+		if settings.VHLR_DISPATCH == 'queue':
+			result = await loop.run_in_executor(self.executor,
+				queue_client.lookup, number, connect_timeout, priority, deadline)
+			return result['code'], result.get('retrying', False), result.get('partial', False)
+
+		timeout = connect_timeout + settings.VHLR_ENGINE_WAIT_MARGIN
+		host = vhlr_engine.host()
+		if not host.isReady() and not await loop.run_in_executor(None, host.start, timeout):
+			raise vhlr_engine.EngineNotReady(host.error or 'VHLR engine is not ready')
+
+		# Shielded: a dropped client must not cancel a dial other lookups may share
+		future = asyncio.wrap_future(host.submitLookup(number, connect_timeout, priority, deadline))
+		try:
+			disconnect_code = await asyncio.wait_for(asyncio.shield(future), timeout)
+		except vhlr_engine.importFreeswitch().DeadlineExceeded as e:
+			return e.state, False, True
+		return disconnect_code, host.engine.isRetrying(number), False
+
+
+def deadlineExceeded(dst_number):
+	return 504, {'number': dst_number, 'error': DEADLINE_EXCEEDED, 'partial': True}
+
+
+_dispatcher = None
+
+def dispatcher():
+	"""The process' Dispatcher, with settings.VHLR_ASGI_LOOKUP_THREADS threads."""
+	global _dispatcher
+	if _dispatcher is None:
+		_dispatcher = Dispatcher(settings.VHLR_ASGI_LOOKUP_THREADS)
+	return _dispatcher
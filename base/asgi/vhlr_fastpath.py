@@ -0,0 +1,228 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.http.request import split_domain_port, validate_host
+
+from base.asgi import vhlr_dispatch
+from base.cache import vhlr_redis, vhlr_filter
+from base.engine import vhlr_engine
+from base.throttles import vhlr_throttles
+
+priorities = vhlr_engine.importFreeswitch('priorities')
+
+
+class TokenVerifier(object):
+	"""
+	Verifies SIMPLE_JWT access tokens without the DRF stack. A verified token
+	is remembered until it expires, so repeat requests skip the signature
+	check. Like JWTAuthentication it refuses tokens of users that are gone or
+	inactive; whether a user is active is remembered for user_ttl sec, so a
+	deactivated user's tokens stop working within that long.
+	"""
+	def __init__(self, maxsize=10000, user_ttl=30):
+		jwt_settings = settings.SIMPLE_JWT
+		self.key = jwt_settings.get('SIGNING_KEY') or settings.SECRET_KEY
+		self.algorithm = jwt_settings['ALGORITHM']
+		self.audience = jwt_settings['AUDIENCE']
+		self.issuer = jwt_settings['ISSUER']
+		self.leeway = jwt_settings['LEEWAY']
+		self.headerTypes = tuple(t.encode() for t in jwt_settings['AUTH_HEADER_TYPES'])
+		self.typeClaim = jwt_settings['TOKEN_TYPE_CLAIM']
+		self.userIdClaim = jwt_settings['USER_ID_CLAIM']
+		self.userIdField = jwt_settings['USER_ID_FIELD']
+		self.maxsize = maxsize
+		self.userTtl = user_ttl
+		self.tokens = OrderedDict() # token -> (user id, exp)
+		self.users = OrderedDict() # user id -> (active, time.monotonic() to check again)
+
+	async def verify(self, header):
+		"""
+		Return the user id for an 'Authorization' header value, None if the
+		token is not valid or its user can't log in. Database errors are raised.
+		"""
+		user_id = self.tokenUserId(header)
+		if user_id is None or not await self.isActive(user_id):
+			return None
+		return user_id
+
+	async def isActive(self, user_id):
+		cached = self.users.get(user_id)
+		if cached and cached[1] > time.monotonic():
+			return cached[0]
+
+		active = await asyncio.get_running_loop().run_in_executor(None, self.loadActive, user_id)
+		self.users[user_id] = (active, time.monotonic() + self.userTtl)
+		self.users.move_to_end(user_id)
+		if len(self.users) > self.maxsize:
+			self.users.popitem(last=False)
+		return active
+
+	def loadActive(self, user_id):
+		# Same check as JWTAuthentication.get_user(), on an executor thread
+		close_old_connections()
+		try:
+			user = get_user_model().objects.only('is_active').get(**{self.userIdField: user_id})
+		except get_user_model().DoesNotExist:
+			return False
+		finally:
+			close_old_connections()
+		return user.is_active
+
+	def tokenUserId(self, header):
+		# User id claim of a valid access token, None if not valid
+		parts = header.split()
+		if len(parts) != 2 or parts[0] not in self.headerTypes:
+			return None
+		token = parts[1]
+
+		cached = self.tokens.get(token)
+		if cached and cached[1] > time.time():
+			return cached[0]
+
+		try:
+			payload = jwt.decode(token, self.key, algorithms=[self.algorithm],
+				audience=self.audience, issuer=self.issuer, leeway=self.leeway)
+		except jwt.InvalidTokenError:
+			return None
+
+		if payload.get(self.typeClaim) != 'access' or self.userIdClaim not in payload:
+			return None
+
+		self.tokens[token] = (payload[self.userIdClaim], payload.get('exp', 0))
+		if len(self.tokens) > self.maxsize:
+			self.tokens.popitem(last=False)
+
+		return payload[self.userIdClaim]
+
+
+class FastPath(object):
+	"""
+	ASGI middleware answering POST api/vhlr/ without the DRF stack: token
+	check, the client's rate limit, the negative filter or one Redis read,
+	and a JSON body. Cache misses are dialed through vhlr_dispatch, on the
+	event loop rather than Django's single sync thread. Requests it can't
+	parse or authenticate go to the Django application unchanged, which
+	then reports errors the usual way. The rate limit outcome travels with
+	the scope, so a forwarded request is not charged twice.
+	"""
+	def __init__(self, app, path='/api/vhlr/'):
+		self.app = app
+		self.path = path
+		self.verifier = TokenVerifier()
+		self.normalizer = vhlr_engine.normalizer()
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] != self.path:
+			return await self.app(scope, receive, send)
+
+		body = await self.readBody(receive)
+		response = await self.lookup(scope, body)
+		if response is None:
+			return await self.app(scope, self.replay(body, receive), send)
+
+		status, content, headers = response
+		await send({
+			'type': 'http.response.start',
+			'status': status,
+			'headers': [
+				(b'content-type', b'application/json'),
+				(b'content-length', str(len(content)).encode()),
+			] + [(name.lower().encode(), value.encode()) for name, value in headers],
+		})
+		await send({'type': 'http.response.body', 'body': content})
+
+	async def lookup(self, scope, body):
+		headers = dict(scope['headers'])
+
+		host, _port = split_domain_port(headers.get(b'host', b'').decode('latin-1'))
+		if not host or not validate_host(host, settings.ALLOWED_HOSTS):
+			return None
+
+		if not headers.get(b'content-type', b'').startswith(b'application/json'):
+			return None
+
+		try:
+			user_id = await self.verifier.verify(headers.get(b'authorization', b''))
+		except Exception:
+			# Django decides, and reports the error
+			return None
+		if user_id is None:
+			return None
+
+		loop = asyncio.get_running_loop()
+		rate = scope['vhlr_rate'] = await loop.run_in_executor(None, vhlr_throttles.consume, user_id)
+		rateHeaders = vhlr_throttles.headers(rate) if rate else []
+		if rate and not rate.allowed:
+			wait = vhlr_throttles.retryAfter(rate)
+			# Same body as DRF's Throttled exception
+			detail = 'Request was throttled. Expected available in %d second%s.' % (wait, '' if wait == 1 else 's')
+			return 429, self.render({'detail': detail}), rateHeaders + [('Retry-After', str(wait))]
+
+		try:
+			dst_number, number, connect_timeout, priority, deadline = self.parse(headers, body)
+		except Exception:
+			return None
+
+		# Local hits don't need the executor
+		disconnect_code = vhlr_filter.deadCode(number) or vhlr_redis.getL1(number)
+		if not disconnect_code:
+			disconnect_code = await loop.run_in_executor(None, vhlr_redis.getCode, number)
+		if disconnect_code:
+			return 200, self.render({'number': dst_number, 'code': disconnect_code}), rateHeaders
+
+		status, data = await vhlr_dispatch.dispatcher().lookup(dst_number, number, connect_timeout, priority, deadline)
+		return status, self.render(data), rateHeaders
+
+	def parse(self, headers, body):
+		# Same parameters as vhlrRequest, which reports the errors
+		started = time.time()
+		data = json.loads(body)
+		dst_number = data['dst_number']
+		connect_timeout = int(data['connect_timeout']) if data.get('connect_timeout') else 7
+		priority = data.get('priority') or 'interactive'
+		if priority not in priorities.NAMES:
+			raise ValueError('unknown priority %s' % priority)
+		number = self.normalizer.normalize(dst_number)
+
+		deadline = None
+		timeout = data.get('timeout') or headers.get(b'x-request-timeout', b'').decode('latin-1')
+		if timeout:
+			timeout = float(timeout)
+			if timeout <= 0:
+				raise ValueError('timeout must be positive')
+			deadline = started + timeout
+		return dst_number, number, connect_timeout, priority, deadline
+
+	@staticmethod
+	def render(data):
+		# Same rendering as DRF's JSONRenderer
+		return json.dumps(data, separators=(',', ':')).encode()
+
+	@staticmethod
+	async def readBody(receive):
+		body = b''
+		while True:
+			message = await receive()
+			body += message.get('body', b'')
+			if not message.get('more_body'):
+				return body
+
+	@staticmethod
+	def replay(body, receive):
+		# Hand the already consumed body to the Django application
+		replayed = False
+
+		async def replayReceive():
+			nonlocal replayed
+			if not replayed:
+				replayed = True
+				return {'type': 'http.request', 'body': body, 'more_body': False}
+			return await receive()
+
+		return replayReceive
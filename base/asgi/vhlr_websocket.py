@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.http.request import split_domain_port, validate_host
+
+from base.asgi import vhlr_dispatch
+from base.asgi.vhlr_fastpath import TokenVerifier
+from base.cache import vhlr_redis, vhlr_filter
+from base.engine import vhlr_engine
+from base.throttles import vhlr_throttles
+
+logger = logging.getLogger(__name__)
+
+priorities = vhlr_engine.importFreeswitch('priorities')
+
+# Close codes, 4000-4999 are free for applications
+CLOSE_INTERNAL_ERROR = 1011
+CLOSE_UNAUTHORIZED = 4401
+
+
+class LookupSocket(object):
+	"""
+	ASGI middleware serving lookups over one WebSocket per client at
+	config['path']. The handshake carries the same 'Authorization: Bearer'
+	header as api/vhlr/. The client then sends any number of
+	{"id", "dst_number"[, "connect_timeout", "priority", "timeout"]} text
+	messages and gets {"id", "number", "code"[, "retrying" or "partial"]} or
+	{"id", "error", "status"} back as each lookup finishes, in any order.
+	Every lookup is charged to the client's rate limit like a POST.
+
+	Flow control: at most max_inflight lookups run per connection and no
+	message is read while they do, so a fast sender is held back by the
+	transport. Results wait in a send queue of send_queue; while a slow
+	reader lets it fill up, finished lookups keep their slot, which in turn
+	stops reading. A connection never holds more than max_inflight +
+	send_queue lookups and results. If sending fails the connection is
+	closed, its waiting lookups with it.
+	"""
+	def __init__(self, app, config):
+		self.app = app
+		self.path = config['path']
+		self.maxInflight = config['max_inflight']
+		self.sendQueue = config['send_queue']
+		self.verifier = TokenVerifier()
+		self.normalizer = vhlr_engine.normalizer()
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'websocket' or scope['path'] != self.path:
+			return await self.app(scope, receive, send)
+
+		message = await receive()
+		if message['type'] != 'websocket.connect':
+			return
+
+		headers = dict(scope['headers'])
+		host, _port = split_domain_port(headers.get(b'host', b'').decode('latin-1'))
+		authorization = headers.get(b'authorization', b'')
+		user_id = await self.verify(authorization)
+		if not host or not validate_host(host, settings.ALLOWED_HOSTS) or user_id is None:
+			# Before the accept: the client gets HTTP 403
+			await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+			return
+
+		await send({'type': 'websocket.accept'})
+		await Connection(self, user_id, authorization, receive, send).run()
+
+	async def verify(self, authorization):
+		# User id, None if the token or its user is not valid or can't be checked
+		try:
+			return await self.verifier.verify(authorization)
+		except Exception as e:
+			logger.error('WebSocket token check failed: %s', e)
+			return None
+
+
+class Connection(object):
+	def __init__(self, server, user_id, authorization, receive, send):
+		self.server = server
+		self.userId = user_id
+		self.authorization = authorization
+		self.receive = receive
+		self.send = send
+		self.slots = asyncio.Semaphore(server.maxInflight)
+		self.results = asyncio.Queue(server.sendQueue) # result dicts, None closes the connection
+		self.tasks = set()
+		self.runner = None
+		self.sender = None
+		self.sendFailed = False
+
+	async def run(self):
+		self.runner = asyncio.current_task()
+		self.sender = sender = asyncio.create_task(self.sendResults())
+		sender.add_done_callback(self.onSenderDone)
+		try:
+			while True:
+				await self.slots.acquire()
+				message = await self.receive()
+				if message['type'] == 'websocket.disconnect':
+					break
+				if message['type'] != 'websocket.receive':
+					self.slots.release()
+					continue
+
+				# The token may expire while the connection lasts
+				if await self.server.verify(self.authorization) is None:
+					await self.results.put({'error': 'Token is invalid or expired', 'status': 401})
+					await self.results.put(None)
+					await asyncio.wait([sender])
+					break
+
+				task = asyncio.create_task(self.handle(message.get('text') or message.get('bytes')))
+				self.tasks.add(task)
+				task.add_done_callback(self.tasks.discard)
+		except asyncio.CancelledError:
+			if not self.sendFailed:
+				raise
+			try:
+				await self.send({'type': 'websocket.close', 'code': CLOSE_INTERNAL_ERROR})
+			except Exception:
+				pass
+		finally:
+			# Lookups already dispatched finish and are cached, see resolve(),
+			# only their results are dropped
+			for task in self.tasks:
+				task.cancel()
+			sender.cancel()
+
+	def onSenderDone(self, task):
+		if task.cancelled() or not task.exception():
+			return
+		logger.error('WebSocket send failed for user %s: %s', self.userId, task.exception())
+		# Nothing takes results off the queue any more: stop reading, which
+		# also ends the lookups waiting to put theirs
+		self.sendFailed = True
+		self.runner.cancel()
+
+	async def sendResults(self):
+		while True:
+			result = await self.results.get()
+			if result is None:
+				await self.send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+				return
+			await self.send({'type': 'websocket.send', 'text': json.dumps(result, separators=(',', ':'))})
+
+	async def handle(self, raw):
+		try:
+			result = await self.lookup(raw)
+			if not self.sender.done():
+				await self.results.put(result)
+		finally:
+			self.slots.release()
+
+	async def lookup(self, raw):
+		try:
+			data = json.loads(raw)
+			request_id = data.get('id')
+		except Exception:
+			return {'id': None, 'error': 'Message must be a JSON object', 'status': 400}
+
+		# Same parameters as api/vhlr/
+		started = time.time()
+		connect_timeout = 7
+		deadline = None
+		try:
+			dst_number = data['dst_number']
+			if data.get('connect_timeout'):
+				connect_timeout = int(data['connect_timeout'])
+			priority = data.get('priority') or 'interactive'
+			if priority not in priorities.NAMES:
+				raise ValueError('unknown priority %s' % priority)
+			number = self.server.normalizer.normalize(dst_number)
+			if data.get('timeout'):
+				timeout = float(data['timeout'])
+				if timeout <= 0:
+					raise ValueError('timeout must be positive')
+				deadline = started + timeout
+		except Exception as e:
+			return {'id': request_id, 'error': 'Cant accept HLR request. Error: %s' % e, 'status': 400}
+
+		loop = asyncio.get_running_loop()
+		rate = await loop.run_in_executor(None, vhlr_throttles.consume, self.userId)
+		if rate and not rate.allowed:
+			return {'id': request_id, 'number': dst_number, 'error': 'Request was throttled',
+				'retry_after': vhlr_throttles.retryAfter(rate), 'status': 429}
+
+		disconnect_code = vhlr_filter.deadCode(number) or vhlr_redis.getL1(number)
+		if not disconnect_code:
+			disconnect_code = await loop.run_in_executor(None, vhlr_redis.getCode, number)
+		if disconnect_code:
+			return {'id': request_id, 'number': dst_number, 'code': disconnect_code}
+
+		status, body = await vhlr_dispatch.dispatcher().lookup(dst_number, number, connect_timeout, priority, deadline)
+		result = {'id': request_id}
+		result.update(body)
+		if status != 200:
+			result['status'] = status
+		return result
@@ -0,0 +1,75 @@
+import mmap
+import os
+import struct
+import time
+from itertools import accumulate
+
+# Binary snapshot of an in-process cache, so a restart doesn't start cold.
+#
+# Layout: header (magic, count), then count expiry times (float64, unix
+# time), count key lengths and count value lengths (uint16), then the keys
+# and values back to back. Expired entries are dropped from the fixed-size
+# arrays alone, without touching their bytes.
+
+MAGIC = b'VHLRSNP1'
+HEADER = struct.Struct('<8sI')
+
+
+def save(path, items):
+	"""Write (key, value, expire unix time) items, atomically replacing path."""
+	keys = []
+	values = []
+	expires = []
+	for key, value, expire in items:
+		key = key.encode()
+		value = value.encode()
+		if len(key) > 0xFFFF or len(value) > 0xFFFF:
+			continue
+		keys.append(key)
+		values.append(value)
+		expires.append(expire)
+
+	count = len(keys)
+	tmp = '%s.%s.tmp' % (path, os.getpid())
+	with open(tmp, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, count))
+		f.write(struct.pack('<%sd' % count, *expires))
+		f.write(struct.pack('<%sH' % count, *(len(k) for k in keys)))
+		f.write(struct.pack('<%sH' % count, *(len(v) for v in values)))
+		for key, value in zip(keys, values):
+			f.write(key)
+			f.write(value)
+	os.replace(tmp, path)
+	return count
+
+
+def load(path, now=None):
+	"""Return the (key, value, expire unix time) items of path that have not expired yet."""
+	now = now or time.time()
+	with open(path, 'rb') as f:
+		if os.fstat(f.fileno()).st_size < HEADER.size:
+			return []
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			magic, count = HEADER.unpack_from(data, 0)
+			if magic != MAGIC:
+				raise ValueError('Not a cache snapshot: %s' % path)
+
+			offset = HEADER.size
+			expires = struct.unpack_from('<%sd' % count, data, offset)
+			offset += 8 * count
+			keyLens = struct.unpack_from('<%sH' % count, data, offset)
+			offset += 2 * count
+			valueLens = struct.unpack_from('<%sH' % count, data, offset)
+			offset += 2 * count
+
+			# Start of every entry in the blob
+			starts = accumulate((k + v for k, v in zip(keyLens, valueLens)), initial=offset)
+
+			items = []
+			for expire, keyLen, valueLen, start in zip(expires, keyLens, valueLens, starts):
+				if expire <= now:
+					continue
+				key = data[start:start + keyLen].decode()
+				value = data[start + keyLen:start + keyLen + valueLen].decode()
+				items.append((key, value, expire))
+			return items
@@ -0,0 +1,62 @@
+import logging
+import threading
+
+from django.conf import settings
+
+from base.engine.vhlr_engine import importFreeswitch
+
+# Negative filter: numbers recently found dead are answered before the cache and the dialer
+
+logger = logging.getLogger(__name__)
+
+filter_settings = settings.VHLR_NEGATIVE_FILTER
+
+counting_filter = importFreeswitch('counting_filter')
+
+_filters = None # disconnect code -> counting_filter.CountingFilter, opened on first use
+_filtersLock = threading.Lock()
+counters = {'hits': 0, 'added': 0, 'removed': 0}
+
+
+def filters():
+	"""
+	The filters of this process, {} if disabled. Opened, and their files
+	created, on first use, so processes that never look up a number, like
+	management commands, leave them alone.
+	"""
+	global _filters
+	if _filters is None:
+		with _filtersLock:
+			if _filters is None:
+				opened = {}
+				if filter_settings['enabled']:
+					try:
+						opened = counting_filter.openFilters(filter_settings)
+					except OSError as e:
+						logger.error('Negative filter disabled, cannot open %s: %s', filter_settings['dir'], e)
+				_filters = opened
+	return _filters
+
+
+def deadCode(dst_number):
+	"""The dead disconnect code recorded for the number, None if not known dead."""
+	for cause, numbers in filters().items():
+		if numbers.contains(dst_number):
+			counters['hits'] += 1
+			return cause
+	return None
+
+
+def record(dst_number, disconnect_code):
+	"""Track a dial outcome: add dead numbers, drop numbers that came back alive."""
+	opened = filters()
+	if not opened:
+		return
+
+	change = counting_filter.record(opened, dst_number, disconnect_code)
+	if change:
+		counters[change] += 1
+
+
+def stats():
+	return dict(counters, causes=list(filters()))
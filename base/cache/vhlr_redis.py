@@ -0,0 +1,565 @@
+import atexit
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+
+from base.cache import cache_snapshot
+from base.engine.vhlr_engine import importFreeswitch
+
+# Number status cache shared by the API views and the ASGI fast path
+
+logger = logging.getLogger(__name__)
+
+hash_ring = importFreeswitch('hash_ring')
+
+redis_settings = settings.VHLR_REDIS
+redis_expire_timeout = redis_settings['expire']
+local_ttl = redis_settings.get('local_ttl') or redis_expire_timeout
+
+
+def connect(node, **options):
+	return redis.StrictRedis(connection_pool=redis.ConnectionPool(
+		host=node['host'],
+		port=node['port'],
+		db=node.get('db', 0),
+		socket_connect_timeout=redis_settings['socket_connect_timeout'],
+		**options
+	))
+
+# Blocking commands of the lookup queue wait far longer than a cache read,
+# the queue stays on the first node
+queue_client = connect(redis_settings['nodes'][0])
+
+
+class CircuitBreaker(object):
+	"""
+	Stops calling a failing dependency for cooldown seconds after threshold
+	consecutive failures. After the cool-down one probe request is let
+	through; its outcome closes the circuit again or restarts the cool-down.
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, threshold, cooldown, name='Redis'):
+		self.name = name
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.state = self.CLOSED
+		self.failures = 0
+		self.openedAt = 0
+		self.lock = threading.Lock()
+		self.counters = {'errors': 0, 'rejected': 0, 'opened': 0}
+
+	def allow(self):
+		with self.lock:
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.OPEN and time.monotonic() - self.openedAt >= self.cooldown:
+				self.state = self.HALF_OPEN
+				return True
+			self.counters['rejected'] += 1
+			return False
+
+	def success(self):
+		with self.lock:
+			if self.state != self.CLOSED:
+				logger.info('%s circuit closed', self.name)
+			self.state = self.CLOSED
+			self.failures = 0
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			self.counters['errors'] += 1
+			if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+				if self.state == self.CLOSED:
+					logger.warning('%s circuit opened after %s failures', self.name, self.failures)
+					self.counters['opened'] += 1
+				self.state = self.OPEN
+				self.openedAt = time.monotonic()
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counters, state=self.state, failures=self.failures)
+		return stats
+
+
+class LocalCache(object):
+	"""
+	Bounded in-process TTL cache. The fallback while Redis is unavailable
+	and, with invalidation on, the L1 in front of Redis, see Invalidator.
+	"""
+	def __init__(self, maxsize, ttl):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.data = OrderedDict() # key -> (value, expire time, write time)
+		self.lock = threading.Lock()
+
+	def get(self, key, since=None):
+		"""The value unless expired or, with since, written before since."""
+		with self.lock:
+			item = self.data.get(key)
+			if item is None:
+				return None
+			if item[1] <= time.monotonic():
+				del self.data[key]
+				return None
+			if since is not None and item[2] < since:
+				return None
+			return item[0]
+
+	def set(self, key, value, ttl=None, written=None):
+		"""
+		written: when a value read from Redis was read; an entry written since
+		then is newer and kept.
+		"""
+		now = time.monotonic()
+		with self.lock:
+			if written is not None:
+				item = self.data.get(key)
+				if item and item[2] > written:
+					return
+			self.data[key] = (value, now + (ttl or self.ttl), written or now)
+			self.data.move_to_end(key)
+			if len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def update(self, items):
+		"""set() of many (key, value) under one lock."""
+		now = time.monotonic()
+		expire = now + self.ttl
+		with self.lock:
+			for key, value in items:
+				self.data[key] = (value, expire, now)
+				self.data.move_to_end(key)
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def count(self):
+		return len(self.data)
+
+	def snapshot(self):
+		"""Entries as (key, value, expire unix time)."""
+		offset = time.time() - time.monotonic()
+		with self.lock:
+			return [(key, value, expire + offset) for key, (value, expire, _) in self.data.items()]
+
+	def restore(self, items):
+		# Entries set since start are newer than the snapshot. Restored ones
+		# count as written long ago: they may have missed updates.
+		offset = time.monotonic() - time.time()
+		with self.lock:
+			for key, value, expire in items:
+				if key not in self.data:
+					self.data[key] = (value, expire + offset, 0)
+					self.data.move_to_end(key, last=False)
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+
+class Shard(object):
+	def __init__(self, name, client):
+		self.name = name
+		self.client = client
+		self.breaker = CircuitBreaker(redis_settings['breaker_threshold'], redis_settings['breaker_cooldown'], name)
+
+
+class ShardedCache(object):
+	"""
+	Number cache over several Redis nodes: either client-side consistent
+	hashing over settings.VHLR_REDIS['nodes'], or one Redis Cluster that
+	routes keys itself. Each shard has its own circuit breaker, so one node
+	going away only sends its own keys to the local fallback.
+	"""
+	def __init__(self, nodes, cluster=False):
+		self.ring = hash_ring.HashRing()
+		self.shards = {}
+
+		if cluster:
+			from redis.cluster import RedisCluster
+			client = RedisCluster(
+				host=nodes[0]['host'],
+				port=nodes[0]['port'],
+				socket_timeout=redis_settings['socket_timeout'],
+				socket_connect_timeout=redis_settings['socket_connect_timeout'],
+			)
+			self.addShard('cluster', client)
+		else:
+			for node in nodes:
+				self.addNode(node)
+
+	def addNode(self, node):
+		self.addShard(hash_ring.nodeName(node), connect(node, socket_timeout=redis_settings['socket_timeout']))
+
+	def addShard(self, name, client):
+		self.shards[name] = Shard(name, client)
+		self.ring.add(name)
+
+	def removeNode(self, node):
+		name = hash_ring.nodeName(node)
+		self.ring.remove(name)
+		del self.shards[name]
+
+	def shard(self, key):
+		if len(self.shards) == 1:
+			return next(iter(self.shards.values()))
+		return self.shards[self.ring.node(key)]
+
+	def group(self, keys):
+		groups = {}
+		for key in keys:
+			groups.setdefault(self.shard(key), []).append(key)
+		return groups
+
+	def stats(self):
+		return {name: shard.breaker.stats() for name, shard in self.shards.items()}
+
+
+cache = ShardedCache(redis_settings['nodes'], redis_settings.get('cluster', False))
+# First shard, for health checks
+redis_client = next(iter(cache.shards.values())).client
+local_cache = LocalCache(redis_settings['local_maxsize'], local_ttl)
+counters = {'local_hits': 0, 'l1_hits': 0}
+
+
+class Invalidator(object):
+	"""
+	Keeps the local caches of all workers coherent: every write is published
+	on the channel of the key's shard, and a thread per shard subscribes and
+	applies the writes of the other workers in batches. The local cache is
+	read before Redis only while every subscription is up, and only entries
+	written since the last one (re)started count: older ones may have missed
+	an update.
+
+	The threads start on first use in each process: they don't survive a
+	fork, and a process whose own subscriptions aren't confirmed yet reads
+	Redis first.
+
+	Message: writer id, then a 'number code' line per number.
+	"""
+	BATCH = 500 # messages applied under one lock
+	PING_PERIOD = 5 # sec of silence before a ping
+	MAX_SILENCE = 3 * PING_PERIOD # sec without any message, pongs included, before a resubscribe
+
+	def __init__(self, cache, channel, shards):
+		self.cache = cache
+		self.channel = channel
+		self.shards = shards
+		self.pid = None # process the threads run in
+		self.subscribed = {} # shard name -> bool
+		self.since = None # monotonic time every subscription has been up since, None while one is down
+		self.lock = threading.Lock()
+		os.register_at_fork(after_in_child=self.afterFork)
+		self.counters = {'published': 0, 'received': 0, 'applied': 0, 'batches': 0, 'resubscribed': 0}
+
+	@staticmethod
+	def origin():
+		# Per call: workers forked after import share the module state
+		return '%s-%s' % (socket.gethostname(), os.getpid())
+
+	def afterFork(self):
+		# The parent's threads and subscriptions are not this process'
+		self.pid = None
+		self.subscribed = {}
+		self.since = None
+		self.lock = threading.Lock()
+
+	def coherentSince(self):
+		"""Monotonic time the local cache is coherent since in this process, None while it is not."""
+		if self.pid != os.getpid():
+			self.start()
+			return None
+		return self.since
+
+	def start(self):
+		with self.lock:
+			if self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			for name in self.shards:
+				self.subscribed[name] = False
+		for shard in self.shards.values():
+			threading.Thread(target=self.run, args=(shard,),
+				name='vhlr-cache-invalidation-%s' % shard.name, daemon=True).start()
+
+	def message(self, codes):
+		return '\n'.join([self.origin()] + ['%s %s' % item for item in codes])
+
+	def publish(self, pipe, codes):
+		"""Queue the message for {number: code} on the pipeline of their shard."""
+		pipe.publish(self.channel, self.message(codes.items()))
+		self.counters['published'] += 1
+
+	def onSubscribed(self, shard, up):
+		with self.lock:
+			self.subscribed[shard.name] = up
+			self.since = time.monotonic() if all(self.subscribed.values()) else None
+
+	def run(self, shard):
+		while True:
+			pubsub = shard.client.pubsub()
+			try:
+				pubsub.subscribe(self.channel)
+				message = pubsub.get_message(timeout=self.PING_PERIOD)
+				if not message or message['type'] != 'subscribe':
+					raise ConnectionError('No subscription confirmation')
+				self.onSubscribed(shard, True)
+				logger.info('Cache invalidation subscribed on %s', shard.name)
+				self.listen(pubsub)
+			except Exception as e:
+				logger.warning('Cache invalidation on %s failed: %s', shard.name, e)
+			finally:
+				self.onSubscribed(shard, False)
+				try:
+					pubsub.close()
+				except Exception:
+					pass
+			self.counters['resubscribed'] += 1
+			time.sleep(redis_settings['breaker_cooldown'])
+
+	def listen(self, pubsub):
+		lastMessage = lastPing = time.monotonic()
+		while True:
+			message = pubsub.get_message(timeout=1.0)
+			now = time.monotonic()
+			if message is None:
+				if now - lastMessage >= self.MAX_SILENCE:
+					raise ConnectionError('No message or pong for %s sec' % self.MAX_SILENCE)
+				if now - max(lastMessage, lastPing) >= self.PING_PERIOD:
+					pubsub.ping()
+					lastPing = now
+				continue
+
+			lastMessage = now
+			# Drain what already arrived, a burst is applied at once
+			batch = [message]
+			while len(batch) < self.BATCH:
+				message = pubsub.get_message(timeout=0)
+				if message is None:
+					break
+				batch.append(message)
+			self.apply(batch)
+
+	def apply(self, batch):
+		me = self.origin()
+		items = []
+		for message in batch:
+			if message['type'] != 'message':
+				continue
+			self.counters['received'] += 1
+			lines = message['data'].decode('utf-8').split('\n')
+			if lines[0] == me:
+				continue
+			for line in lines[1:]:
+				key, _, value = line.partition(' ')
+				if value:
+					items.append((key, value))
+		if items:
+			self.cache.update(items)
+			self.counters['applied'] += len(items)
+			self.counters['batches'] += 1
+
+	def stats(self):
+		return dict(self.counters, coherent=self.coherentSince() is not None,
+			subscribed=sum(self.subscribed.values()), shards=len(self.subscribed))
+
+
+invalidator = None
+if redis_settings.get('invalidation_channel'):
+	invalidator = Invalidator(local_cache, redis_settings['invalidation_channel'], cache.shards)
+
+
+def saveSnapshot():
+	try:
+		count = cache_snapshot.save(redis_settings['snapshot_path'], local_cache.snapshot())
+	except OSError as e:
+		logger.error('Failed to save cache snapshot %s: %s', redis_settings['snapshot_path'], e)
+	else:
+		logger.debug('Saved %s cache entries to %s', count, redis_settings['snapshot_path'])
+
+
+def loadSnapshot():
+	try:
+		items = cache_snapshot.load(redis_settings['snapshot_path'])
+	except FileNotFoundError:
+		return
+	except (OSError, ValueError, struct.error) as e:
+		logger.error('Failed to load cache snapshot %s: %s', redis_settings['snapshot_path'], e)
+		return
+	local_cache.restore(items)
+	logger.info('Loaded %s cache entries from %s', len(items), redis_settings['snapshot_path'])
+
+
+def onSnapshotTimer(period):
+	while True:
+		time.sleep(period)
+		saveSnapshot()
+
+
+_snapshots = False
+
+def startSnapshots():
+	"""
+	Load the fallback's snapshot, then save it every snapshot_period sec and
+	at exit. Called by the server entry points (vhlr/wsgi.py, vhlr/asgi.py)
+	only, so management commands and tests never touch the file. Every
+	worker saves what it holds, which includes the snapshot it loaded, so
+	the last writer loses little.
+	"""
+	global _snapshots
+	if _snapshots or not redis_settings.get('snapshot_path'):
+		return
+	_snapshots = True
+	loadSnapshot()
+	threading.Thread(target=onSnapshotTimer, args=(redis_settings['snapshot_period'],),
+		name='vhlr-cache-snapshot', daemon=True).start()
+	atexit.register(saveSnapshot)
+
+
+def getLocal(dst_number):
+	disconnect_code = local_cache.get(dst_number)
+	if disconnect_code:
+		counters['local_hits'] += 1
+	return disconnect_code
+
+
+def getL1(dst_number):
+	"""The local code while the local cache is coherent with Redis, None otherwise."""
+	since = invalidator.coherentSince() if invalidator else None
+	if since is None:
+		return None
+	disconnect_code = local_cache.get(dst_number, since)
+	if disconnect_code:
+		counters['l1_hits'] += 1
+	return disconnect_code
+
+
+def fillL1(dst_number, redis_value, pttl, started):
+	# Keep a Redis hit locally no longer than Redis keeps it
+	if invalidator and redis_value and pttl > 0:
+		local_cache.set(dst_number, redis_value.decode('utf-8'), min(local_ttl, pttl / 1000), written=started)
+
+
+def getCode(dst_number):
+	disconnect_code = getL1(dst_number)
+	if disconnect_code:
+		return disconnect_code
+
+	shard = cache.shard(dst_number)
+	if shard.breaker.allow():
+		started = time.monotonic()
+		try:
+			if invalidator:
+				redis_value, pttl = shard.client.pipeline(transaction=False).get(dst_number).pttl(dst_number).execute()
+			else:
+				redis_value = shard.client.get(dst_number)
+		except Exception as e:
+			shard.breaker.failure()
+			logger.debug('Redis get failed for %s on %s: %s', dst_number, shard.name, e)
+		else:
+			shard.breaker.success()
+			if invalidator:
+				fillL1(dst_number, redis_value, pttl, started)
+			return redis_value.decode('utf-8') if redis_value else None
+
+	return getLocal(dst_number)
+
+
+def setCode(dst_number, disconnect_code):
+	# Written through, so the fallback already holds recent results when Redis goes away
+	local_cache.set(dst_number, disconnect_code)
+
+	shard = cache.shard(dst_number)
+	if not shard.breaker.allow():
+		return
+
+	try:
+		if invalidator:
+			pipe = shard.client.pipeline(transaction=False)
+			pipe.setex(dst_number, redis_expire_timeout, disconnect_code)
+			invalidator.publish(pipe, {dst_number: disconnect_code})
+			pipe.execute()
+		else:
+			shard.client.setex(dst_number, redis_expire_timeout, disconnect_code)
+	except Exception as e:
+		shard.breaker.failure()
+		logger.debug('Redis setex failed for %s on %s: %s', dst_number, shard.name, e)
+	else:
+		shard.breaker.success()
+
+
+def getCodes(dst_numbers):
+	"""Batch getCode: one pipelined round trip per shard, returns {number: code or None}."""
+	codes = {}
+	missing = []
+	for dst_number in dst_numbers:
+		disconnect_code = getL1(dst_number)
+		if disconnect_code:
+			codes[dst_number] = disconnect_code
+		else:
+			missing.append(dst_number)
+
+	for shard, keys in cache.group(missing).items():
+		if shard.breaker.allow():
+			started = time.monotonic()
+			try:
+				pipe = shard.client.pipeline(transaction=False)
+				for key in keys:
+					pipe.get(key)
+					if invalidator:
+						pipe.pttl(key)
+				values = pipe.execute()
+			except Exception as e:
+				shard.breaker.failure()
+				logger.debug('Redis batch get failed on %s: %s', shard.name, e)
+			else:
+				shard.breaker.success()
+				if invalidator:
+					for key, value, pttl in zip(keys, values[::2], values[1::2]):
+						fillL1(key, value, pttl, started)
+					values = values[::2]
+				codes.update((key, value.decode('utf-8') if value else None) for key, value in zip(keys, values))
+				continue
+
+		codes.update((key, getLocal(key)) for key in keys)
+	return codes
+
+
+def setCodes(codes):
+	"""Batch setCode for {number: code}, one pipelined round trip per shard."""
+	for dst_number, disconnect_code in codes.items():
+		local_cache.set(dst_number, disconnect_code)
+
+	for shard, keys in cache.group(codes).items():
+		if not shard.breaker.allow():
+			continue
+		try:
+			pipe = shard.client.pipeline(transaction=False)
+			for key in keys:
+				pipe.setex(key, redis_expire_timeout, codes[key])
+			if invalidator:
+				invalidator.publish(pipe, {key: codes[key] for key in keys})
+			pipe.execute()
+		except Exception as e:
+			shard.breaker.failure()
+			logger.debug('Redis batch setex failed on %s: %s', shard.name, e)
+		else:
+			shard.breaker.success()
+
+
+def stats():
+	return {
+		'shards': cache.stats(),
+		'local_cache_size': local_cache.count(),
+		'local_hits': counters['local_hits'],
+		'l1_hits': counters['l1_hits'],
+		'invalidation': invalidator.stats() if invalidator else None,
+	}
@@ -0,0 +1,215 @@
+import asyncio
+import concurrent.futures
+import importlib
+import threading
+import logging
+import sys
+import os
+
+from base.engine import vhlr_profiler
+
+logger = logging.getLogger(__name__)
+
+FREESWITCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'freeswitch')
+
+
+def importFreeswitch(name='vhlr_callgen'):
+	"""
+	Import the dialer on first use: vhlr_callgen pulls in uvloop and the
+	FreeSWITCH glue, which the cache-hit path never needs.
+	"""
+	# The dialer modules import each other as top level modules
+	if FREESWITCH_DIR not in sys.path:
+		sys.path.append(FREESWITCH_DIR)
+
+	return importlib.import_module(name)
+
+
+def isRetryable(code):
+	return code in importFreeswitch().freeswitch_api.CallState.retry_disconnect_codes
+
+
+def normalizer():
+	"""Number normalizer built from settings.VHLR_NUMBERS."""
+	global _normalizer
+	if _normalizer is None:
+		from django.conf import settings
+		_normalizer = importFreeswitch('number_utils').fromConfig(settings.VHLR_NUMBERS)
+	return _normalizer
+
+_normalizer = None
+
+
+class EngineNotReady(Exception):
+	pass
+
+
+class EngineTimeout(Exception):
+	pass
+
+
+def prewarm():
+	"""
+	Start this worker's engine before it takes traffic, waiting up to
+	VHLR_PREWARM_TIMEOUT sec. Called by the server entry points
+	(vhlr/wsgi.py, vhlr/asgi.py) only, so management commands, tests and
+	scripts calling django.setup() never dial.
+	"""
+	from django.conf import settings
+	if settings.VHLR_PREWARM and settings.VHLR_DISPATCH == 'inline':
+		host().start(timeout=settings.VHLR_PREWARM_TIMEOUT)
+
+
+def summarizeCalls(calls):
+	"""Counts by call state and the oldest call age of Engine.snapshot() rows."""
+	states = {}
+	for call in calls:
+		states[call['state']] = states.get(call['state'], 0) + 1
+	return {
+		'count': len(calls),
+		'states': states,
+		'oldest_age': max((call['age'] for call in calls), default=0),
+	}
+
+
+class EngineHost(object):
+	"""
+	Runs one vhlr_callgen.Engine per web worker on a dedicated event loop
+	thread, so the loop, logger, profile and FSCLI are set up once instead of
+	on every lookup. Request threads submit lookups with lookup().
+	"""
+	def __init__(self, params):
+		self.params = params
+		self.engine = None
+		self.loop = None
+		self.thread = None
+		self.error = None
+		self.resultListeners = []
+		self.lock = threading.Lock()
+		self.startedEvent = threading.Event()
+
+	def start(self, timeout=None):
+		"""Start the engine thread if needed and wait up to timeout sec for it to be ready."""
+		with self.lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.error = None
+				self.startedEvent.clear()
+				self.thread = threading.Thread(target=self.run, name='vhlr-engine', daemon=True)
+				self.thread.start()
+
+		self.startedEvent.wait(timeout)
+		return self.isReady()
+
+	def run(self):
+		vhlr_callgen = importFreeswitch()
+		try:
+			import uvloop
+			self.loop = uvloop.new_event_loop()
+		except ImportError:
+			self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+
+		config = vhlr_callgen.Config()
+		config.__dict__.update(self.params)
+		vhlr_callgen.initLogger(config)
+
+		self.engine = vhlr_callgen.Engine(config)
+		self.engine.resultListeners.append(self.onResult)
+
+		try:
+			self.loop.run_until_complete(self.engine.start())
+		except Exception as e:
+			logger.error('Failed to start VHLR engine: %s', e)
+			self.error = str(e)
+			self.teardown()
+			self.startedEvent.set()
+			return
+
+		self.startedEvent.set()
+		self.loop.run_forever()
+
+	def teardown(self):
+		# Whatever the failed start got running: reaper, poller, lag monitor, tasks
+		try:
+			self.loop.run_until_complete(self.engine.stop())
+		except Exception as e:
+			logger.debug('EngineHost.teardown() -> Engine stop failed: %s', e)
+		tasks = asyncio.all_tasks(self.loop)
+		for task in tasks:
+			task.cancel()
+		self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+		self.loop.close()
+
+	def isReady(self):
+		return bool(self.engine and self.engine.started and self.thread.is_alive())
+
+	def status(self):
+		return {
+			'ready': self.isReady(),
+			'profile': self.engine.config.profile if self.isReady() else None,
+			'error': self.error,
+		}
+
+	def submit(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+	def lookup(self, dst_number, connect_timeout=None, timeout=None, priority=None, deadline=None):
+		"""
+		Blocking lookup from a request thread, returns (disconnect code,
+		retrying, partial). With a deadline (unix time) the result comes by
+		then, partial with the state so far if the call isn't over; the code is
+		None if it was never dialed.
+		"""
+		if not self.isReady() and not self.start(timeout):
+			raise EngineNotReady(self.error or 'VHLR engine is not ready')
+
+		future = self.submitLookup(dst_number, connect_timeout, priority, deadline)
+		try:
+			code = future.result(timeout)
+		except importFreeswitch().DeadlineExceeded as e:
+			return e.state, False, True
+		except concurrent.futures.TimeoutError:
+			# Drops this wait only, the dial goes on for lookups sharing it
+			future.cancel()
+			raise EngineTimeout('No result for %s within %s sec' % (dst_number, timeout))
+		return code, self.engine.isRetrying(dst_number), False
+
+	def submitLookup(self, dst_number, connect_timeout=None, priority=None, deadline=None):
+		"""Lookup on a ready engine as a concurrent.futures.Future, for callers on other loops."""
+		return self.submit(self.engine.lookup(dst_number, connect_timeout, priority, deadline))
+
+	def snapshot(self, timeout=None):
+		"""In-flight calls of this worker's engine, see vhlr_callgen.Engine.snapshot()."""
+		if not self.isReady():
+			raise EngineNotReady(self.error or 'VHLR engine is not ready')
+		return self.submit(self.engine.snapshot()).result(timeout)
+
+	def loopStats(self, timeout=None):
+		"""Background tasks and loop lag of the engine loop, see async_utils.stats()."""
+		if not self.isReady():
+			raise EngineNotReady(self.error or 'VHLR engine is not ready')
+		return self.submit(self.engine.loopStats()).result(timeout)
+
+	def profile(self, seconds):
+		"""cProfile the engine loop thread for seconds sec, returns pstats.Stats."""
+		if not self.isReady():
+			raise EngineNotReady(self.error or 'VHLR engine is not ready')
+		return self.submit(vhlr_profiler.profileLoop(seconds)).result(seconds + 5)
+
+	def onResult(self, dst_number, code):
+		# Background retry results, listeners may block so keep them off the loop
+		for listener in self.resultListeners:
+			self.loop.run_in_executor(None, listener, dst_number, code)
+
+
+_host = None
+_hostLock = threading.Lock()
+
+def host():
+	global _host
+	if _host is None:
+		from django.conf import settings
+		with _hostLock:
+			if _host is None:
+				_host = EngineHost(settings.VHLR_ENGINE)
+	return _host
@@ -0,0 +1,95 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+# On-demand profiling of a running web worker. Nothing is installed while no
+# profile runs, so there is no cost when idle. Profiles run on a thread of
+# their own, see background(), never on a request thread.
+
+_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+	pass
+
+
+def frameLabel(frame):
+	code = frame.f_code
+	return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+def background(run, *args):
+	"""
+	Run run(*args) on a profiler thread, one profile per process at a time:
+	ProfilerBusy right away while another one runs.
+	"""
+	if not _lock.acquire(blocking=False):
+		raise ProfilerBusy('A profile is already running')
+
+	def target():
+		try:
+			run(*args)
+		finally:
+			_lock.release()
+
+	try:
+		threading.Thread(target=target, name='vhlr-profiler', daemon=True).start()
+	except Exception:
+		_lock.release()
+		raise
+
+
+def sample(seconds, interval=0.005):
+	"""
+	Sample the stacks of every thread of the process each interval sec for
+	seconds sec, blocking the calling thread. Returns {collapsed stack:
+	samples}, stacks as 'thread;outer frame;...;inner frame' for flame
+	graph tools.
+	"""
+	me = threading.get_ident()
+	stacks = {}
+	deadline = time.monotonic() + seconds
+	while time.monotonic() < deadline:
+		names = {thread.ident: thread.name for thread in threading.enumerate()}
+		for ident, frame in sys._current_frames().items():
+			if ident == me:
+				continue
+			frames = []
+			while frame is not None:
+				frames.append(frameLabel(frame))
+				frame = frame.f_back
+			frames.append(names.get(ident, str(ident)))
+			stack = ';'.join(reversed(frames))
+			stacks[stack] = stacks.get(stack, 0) + 1
+		time.sleep(interval)
+	return stacks
+
+
+def collapsed(stacks):
+	return ''.join('%s %s\n' % (stack, count) for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+
+async def profileLoop(seconds):
+	"""
+	Deterministic profile of everything the loop thread this runs on does for
+	seconds sec: cProfile only hooks the thread it is enabled on.
+	"""
+	profiler = cProfile.Profile()
+	profiler.enable()
+	try:
+		await asyncio.sleep(seconds)
+	finally:
+		profiler.disable()
+	return pstats.Stats(profiler)
+
+
+def statsText(stats, sort='cumulative', limit=50):
+	stream = io.StringIO()
+	stats.stream = stream
+	stats.sort_stats(sort).print_stats(limit)
+	return stream.getvalue()
@@ -1,18 +1,203 @@
-
 import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
 from functools import partial
 
-def create_task(coroutine, *, logger, msg, msg_args=()):
-	task = asyncio.create_task(coroutine)
-	task.add_done_callback(partial(_handle_task_result, logger=logger, msg=msg, msg_args=msg_args))
+# Background task and event loop accounting. Every task of the dialer is
+# started by create_task(), which counts it by name; a LagMonitor measures
+# how late the loop runs and logs the loop thread's stack while it blocks.
+# stats() has both, for metrics.
+
+def create_task(coroutine, *, logger, msg, msg_args=(), name=None):
+	# name: the coroutine's qualified name, e.g. 'Call.onCheckCallState'
+	name = name or getattr(coroutine, '__qualname__', None) or type(coroutine).__name__
+	task = asyncio.create_task(coroutine, name=name)
+	counter = taskStats.onStart(name)
+	task.add_done_callback(partial(_handle_task_result, counter=counter, started=time.monotonic(),
+		logger=logger, msg=msg, msg_args=msg_args))
 	return task
 
-def _handle_task_result(task, *, logger, msg, msg_args):
+def _handle_task_result(task, *, counter, started, logger, msg, msg_args):
+	counter.onDone(time.monotonic() - started)
 	try:
 		task.result()
 	except asyncio.CancelledError:
-		pass
-	except Exception:  # pylint: disable=broad-except
+		counter.cancelled += 1
+	except Exception as e:  # pylint: disable=broad-except
+		counter.onError(e)
 		logger.exception(msg, *msg_args)
 
 
+class TaskCounter:
+	__slots__ = ('live', 'started', 'cancelled', 'failed', 'lifetime', 'maxLifetime', 'errors')
+
+	def __init__(self):
+		self.live = 0
+		self.started = 0
+		self.cancelled = 0
+		self.failed = 0
+		self.lifetime = 0.0 # sec, sum over finished tasks
+		self.maxLifetime = 0.0 # sec
+		self.errors = {} # exception class name -> count
+
+	def onDone(self, lifetime):
+		self.live -= 1
+		self.lifetime += lifetime
+		if lifetime > self.maxLifetime:
+			self.maxLifetime = lifetime
+
+	def onError(self, e):
+		self.failed += 1
+		kind = type(e).__name__
+		self.errors[kind] = self.errors.get(kind, 0) + 1
+
+	def stats(self):
+		finished = self.started - self.live
+		return {
+			'live': self.live,
+			'started': self.started,
+			'cancelled': self.cancelled,
+			'failed': self.failed,
+			'mean_lifetime': round(self.lifetime / finished, 6) if finished else None,
+			'max_lifetime': round(self.maxLifetime, 6),
+			'errors': dict(self.errors),
+		}
+
+
+class TaskStats:
+	"""Tasks started by create_task() by name, updated on the loop thread only."""
+	def __init__(self):
+		self.counters = {} # name -> TaskCounter
+
+	def onStart(self, name):
+		counter = self.counters.get(name)
+		if counter is None:
+			counter = self.counters[name] = TaskCounter()
+		counter.live += 1
+		counter.started += 1
+		return counter
+
+	def stats(self):
+		byName = {name: counter.stats() for name, counter in list(self.counters.items())}
+		errors = {}
+		for counter in byName.values():
+			for kind, count in counter['errors'].items():
+				errors[kind] = errors.get(kind, 0) + count
+		return {
+			'live': sum(counter['live'] for counter in byName.values()),
+			'errors': errors,
+			'by_name': byName,
+		}
+
+
+class LagMonitor:
+	"""
+	Event loop lag. A probe the loop runs every interval sec records how
+	late it ran: anything blocking the loop delays it by as long. A watchdog
+	thread checks the probe's heartbeat, and once the loop has not come back
+	for threshold sec logs the stack of the loop thread, so the blocking
+	call (sync logging, a regex on a large dump, ...) shows while it still
+	blocks. One dump per stall, at most one per dump_period sec.
+	"""
+	def __init__(self, interval=0.5, threshold=0.2, dump_period=60, logger=None, window=60):
+		self.interval = interval
+		self.threshold = threshold
+		self.dumpPeriod = dump_period
+		self.logger = logger or logging.getLogger(__name__)
+		self.loop = None
+		self.loopThread = None
+		self.handle = None
+		self.watchdog = None
+		self.stopped = threading.Event()
+
+		self.beat = None # time.monotonic() of the last probe
+		self.last = 0.0 # sec
+		self.max = 0.0 # sec
+		self.total = 0.0 # sec
+		self.probes = 0
+		self.overThreshold = 0
+		self.recent = collections.deque(maxlen=max(1, int(window / interval))) # lags of the last window sec
+		self.dumps = 0
+		self.lastDump = None # {'time', 'blocked', 'stack'}
+		self.dumpedBeat = None # beat of the stall last dumped
+
+	def start(self):
+		"""Start on the loop to watch."""
+		self.loop = asyncio.get_running_loop()
+		self.loopThread = threading.get_ident()
+		self.beat = time.monotonic()
+		self.stopped.clear()
+		self.schedule()
+		self.watchdog = threading.Thread(target=self.watch, name='loop-lag-watchdog', daemon=True)
+		self.watchdog.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.handle:
+			self.handle.cancel()
+			self.handle = None
+
+	def schedule(self):
+		self.handle = self.loop.call_at(self.loop.time() + self.interval, self.onProbe, time.monotonic() + self.interval)
+
+	def onProbe(self, expected):
+		now = time.monotonic()
+		lag = max(0.0, now - expected)
+		self.beat = now
+		self.last = lag
+		self.total += lag
+		self.probes += 1
+		self.recent.append(lag)
+		if lag > self.max:
+			self.max = lag
+		if lag >= self.threshold:
+			self.overThreshold += 1
+		self.schedule()
+
+	def watch(self):
+		period = min(self.interval, self.threshold) / 2
+		while not self.stopped.wait(period):
+			beat = self.beat
+			blocked = time.monotonic() - beat - self.interval
+			if blocked < self.threshold or beat == self.dumpedBeat:
+				continue
+			if self.lastDump and time.time() - self.lastDump['time'] < self.dumpPeriod:
+				continue
+
+			frame = sys._current_frames().get(self.loopThread)
+			if frame is None:
+				return
+			stack = ''.join(traceback.format_stack(frame))
+			del frame
+			self.dumpedBeat = beat
+			self.dumps += 1
+			self.lastDump = {'time': time.time(), 'blocked': round(blocked, 3), 'stack': stack}
+			self.logger.warning('Event loop blocked for %.3f sec, loop thread stack:\n%s', blocked, stack)
+
+	def stats(self):
+		recent = list(self.recent)
+		return {
+			'interval': self.interval,
+			'threshold': self.threshold,
+			'last': round(self.last, 6),
+			'mean': round(self.total / self.probes, 6) if self.probes else None,
+			'max': round(self.max, 6),
+			'recent_max': round(max(recent), 6) if recent else None,
+			'over_threshold': self.overThreshold,
+			'dumps': self.dumps,
+			'last_dump': self.lastDump,
+		}
+
+
+taskStats = TaskStats()
+lagMonitor = None # LagMonitor of the process' loop, set by its owner
+
+def stats():
+	return {
+		'tasks': taskStats.stats(),
+		'lag': lagMonitor.stats() if lagMonitor else None,
+	}
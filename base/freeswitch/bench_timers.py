@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Memory and loop cost per in-flight call. Every call is started against a
+# fake FreeSWITCH whose channels never leave DIALING, so each one holds its
+# connect deadline and state check ticks until the connect timeout ends it.
+#
+#   python3 bench_timers.py --calls 20000 --connect-timeout 15 --seconds 5
+
+import argparse
+import asyncio
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+import uuid
+
+import freeswitch_api
+
+
+class FakeFSCLI:
+	"""originate waits for the call to be torn down, uuid_dump reports DIALING."""
+	def __init__(self):
+		self.channels = {} # uuid -> originate future
+		self.commands = 0
+
+	async def execute(self, cmd, type=None, owner=None, timeout=None):
+		self.commands += 1
+		if cmd.startswith('originate'):
+			future = self.channels[owner] = asyncio.get_running_loop().create_future()
+			return await future
+		if cmd.startswith('uuid_dump'):
+			return 'Channel-Call-State: DIALING\n'
+		return '+OK'
+
+	def fsCliTerminate(self, owner=None):
+		future = self.channels.pop(owner, None)
+		if future and not future.done():
+			future.set_exception(Exception('ORIGINATOR_CANCEL'))
+
+
+class Owner:
+	def __init__(self, count):
+		self.remaining = count
+		self.done = asyncio.get_running_loop().create_future()
+		self.lastTime = None
+
+	def onCallTerminated(self, call):
+		self.remaining -= 1
+		if not self.remaining:
+			self.lastTime = time.monotonic()
+			self.done.set_result(None)
+
+
+async def run(args):
+	config = freeswitch_api.Config()
+	config.connect_timeout = args.connect_timeout
+	config.check_timeout = args.check_timeout
+	config.timer_tick = args.tick
+	config.profile = 'bench'
+
+	freeswitch_api.config = config
+	freeswitch_api.fsCli = fsCli = FakeFSCLI()
+	freeswitch_api.timerWheel = wheel = freeswitch_api.TimerWheel(config.timer_tick)
+	# Any poller disables the per-call state checks
+	freeswitch_api.channelPoller = True if args.polled else None
+
+	owner = Owner(args.calls)
+	tasks = set()
+
+	async def startCalls(count):
+		for _ in range(count):
+			call = freeswitch_api.Call('bench', '4930123456', str(uuid.uuid4()), owner)
+			task = asyncio.create_task(call.start())
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		# Let every call reach its originate
+		await asyncio.sleep(0)
+		await asyncio.sleep(0)
+		return call
+
+	# Memory from a traced sample, tracing would distort the timings
+	sample = min(args.sample, args.calls)
+	gc.collect()
+	tracemalloc.start()
+	baseline = tracemalloc.get_traced_memory()[0]
+	call = await startCalls(sample)
+	memory = tracemalloc.get_traced_memory()[0] - baseline
+	tracemalloc.stop()
+
+	cpu = time.process_time()
+	await startCalls(args.calls - sample)
+	startCpu = time.process_time() - cpu
+	started = time.monotonic()
+
+	commands = fsCli.commands
+	cpu = time.process_time()
+	await asyncio.sleep(args.seconds)
+	steadyCpu = time.process_time() - cpu
+	commands = fsCli.commands - commands
+
+	deadline = started + args.connect_timeout
+	cpu = time.process_time()
+	await owner.done
+	while tasks:
+		await asyncio.sleep(0.01)
+	teardownCpu = time.process_time() - cpu
+
+	calls = args.calls
+	print('calls:                  %s' % calls)
+	print('Call object:            %s bytes' % sys.getsizeof(call))
+	print('memory per call:        %.0f bytes (call, timers, originate task)' % (memory / sample))
+	print('start cost per call:    %.1f us' % (startCpu / max(calls - sample, 1) * 1e6))
+	print('steady CPU per call:    %.2f us/sec (%.0f fake commands/sec)' % (
+		steadyCpu / args.seconds / calls * 1e6, commands / args.seconds))
+	print('teardown cost per call: %.1f us' % (teardownCpu / calls * 1e6))
+	print('last timeout late by:   %.3f sec' % (owner.lastTime - deadline))
+	print('timers left:            %s' % len(wheel))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='In-flight call timer benchmark')
+	parser.add_argument('--calls', type=int, default=20000)
+	parser.add_argument('--connect-timeout', type=float, default=15, help='sec, must exceed --seconds')
+	parser.add_argument('--check-timeout', type=float, default=0.5, help='sec between state checks of a call')
+	parser.add_argument('--tick', type=float, default=0.1, help='sec, timer wheel resolution')
+	parser.add_argument('--seconds', type=float, default=5, help='sec of steady state measured')
+	parser.add_argument('--sample', type=int, default=1000, help='calls traced for the memory figure')
+	parser.add_argument('--polled', action='store_true', help='no per-call state checks, as with a ChannelPoller')
+	parser.add_argument('--uvloop', action='store_true')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+	if args.uvloop:
+		import uvloop
+		uvloop.install()
+	asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,201 @@
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+import file_lock
+
+# Rolling outcome statistics per number prefix and gateway
+
+# One contiguous array per field, so aggregation reads memory sequentially
+COLUMNS = [
+	('time', '<f8'),     # termination, unix time
+	('prefix', '<u4'),   # leading prefix_digits digits of the number
+	('ring', '<f4'),     # sec from setup to ringing, NaN if it never rang
+	('sip', '<u2'),      # SIP equivalent of the disconnect code, 0 if unknown
+	('gateway', 'u1'),   # index in the gateway table
+	('timeout', 'u1'),   # 1 if the connect timeout ended the call
+]
+RECORD_SIZE = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+
+
+class OutcomeStats(object):
+	"""
+	Fixed-size ring buffer of call outcomes in a memory-mapped file, so every
+	dialer on a host appends to the same buffer and readers see all of them.
+	Writers serialize on flock; readers don't lock and at worst miss the
+	record being written. summary() aggregates a sliding window with
+	vectorized NumPy operations only: no Python loop over records and no
+	sort except for the medians. prefix_digits is at most 9.
+	"""
+	MAGIC = b'VHLROUT1'
+	HEADER = struct.Struct('<8sQIIQ') # magic, capacity, prefix digits, reserved, records written
+	CURSOR_OFFSET = 24
+	GATEWAYS = 255
+	GATEWAY_SIZE = 64
+	DENSE_LIMIT = 1 << 24 # largest key range grouped with bincount instead of a sort
+
+	def __init__(self, path, capacity, prefix_digits=6, readonly=False):
+		self.path = path
+		self.capacity = capacity
+		self.prefixDigits = prefix_digits
+
+		self.gatewaysOffset = self.HEADER.size
+		self.dataOffset = self.gatewaysOffset + self.GATEWAYS * self.GATEWAY_SIZE
+		fileSize = self.dataOffset + RECORD_SIZE * capacity
+		self.gateways = {} # name -> index, cache of the table in the file
+
+		if readonly:
+			self.fd = os.open(path, os.O_RDONLY)
+			header = os.pread(self.fd, self.CURSOR_OFFSET, 0)
+			magic, self.capacity, self.prefixDigits, _ = struct.unpack('<8sQII', header)
+			if magic != self.MAGIC:
+				raise OSError('Not an outcome stats file: %s' % path)
+			fileSize = self.dataOffset + RECORD_SIZE * self.capacity
+			self.map = mmap.mmap(self.fd, fileSize, mmap.MAP_SHARED, mmap.PROT_READ)
+		else:
+			self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+			with self.locked():
+				header = os.pread(self.fd, self.CURSOR_OFFSET, 0)
+				expected = self.HEADER.pack(self.MAGIC, capacity, prefix_digits, 0, 0)[:self.CURSOR_OFFSET]
+				if header != expected or os.fstat(self.fd).st_size != fileSize:
+					# New file or other parameters: start empty
+					os.ftruncate(self.fd, 0)
+					os.ftruncate(self.fd, fileSize)
+					os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, capacity, prefix_digits, 0, 0), 0)
+			self.map = mmap.mmap(self.fd, fileSize, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+		self.cursor = np.ndarray((1,), '<u8', buffer=self.map, offset=self.CURSOR_OFFSET)
+		self.columns = {}
+		offset = self.dataOffset
+		for name, dtype in COLUMNS:
+			self.columns[name] = np.ndarray((self.capacity,), dtype, buffer=self.map, offset=offset)
+			offset += np.dtype(dtype).itemsize * self.capacity
+
+	def locked(self):
+		return file_lock.FileLock(self.fd)
+
+	def gatewayNames(self):
+		names = []
+		for i in range(self.GATEWAYS):
+			start = self.gatewaysOffset + i * self.GATEWAY_SIZE
+			name = self.map[start:start + self.GATEWAY_SIZE].rstrip(b'\0')
+			if not name:
+				break
+			names.append(name.decode())
+		return names
+
+	def gatewayIndex(self, gateway):
+		# Under the lock: the table is shared with other writers
+		index = self.gateways.get(gateway)
+		if index is not None:
+			return index
+
+		names = self.gatewayNames()
+		if gateway not in names:
+			if len(names) >= self.GATEWAYS:
+				return self.GATEWAYS - 1
+			start = self.gatewaysOffset + len(names) * self.GATEWAY_SIZE
+			self.map[start:start + self.GATEWAY_SIZE] = gateway.encode()[:self.GATEWAY_SIZE].ljust(self.GATEWAY_SIZE, b'\0')
+			names.append(gateway)
+
+		index = self.gateways[gateway] = names.index(gateway)
+		return index
+
+	def prefix(self, number):
+		digits = ''.join(c for c in number if c.isdigit())[:self.prefixDigits]
+		return int(digits.ljust(self.prefixDigits, '0') or 0)
+
+	def record(self, number, sip, ring, gateway, timeout, when=None):
+		with self.locked():
+			position = int(self.cursor[0])
+			index = position % self.capacity
+			columns = self.columns
+			columns['time'][index] = when or time.time()
+			columns['prefix'][index] = self.prefix(number)
+			columns['ring'][index] = np.nan if ring is None else ring
+			columns['sip'][index] = sip
+			columns['gateway'][index] = self.gatewayIndex(gateway)
+			columns['timeout'][index] = 1 if timeout else 0
+			self.cursor[0] = position + 1
+
+	def window(self, seconds, now=None):
+		"""Columns of the records of the last seconds, oldest first."""
+		written = int(self.cursor[0])
+		if written <= self.capacity:
+			columns = {name: column[:written] for name, column in self.columns.items()}
+		else:
+			# Wrapped: the oldest record is at the write position
+			position = written % self.capacity
+			columns = {name: np.concatenate((column[position:], column[:position])) for name, column in self.columns.items()}
+
+		# Appended under the lock, so times only go up (short of clock steps)
+		start = np.searchsorted(columns['time'], (now or time.time()) - seconds)
+		return {name: column[start:] for name, column in columns.items()}
+
+	@classmethod
+	def dense(cls, values, maxValue):
+		"""np.unique(values, return_inverse=True) for small non-negative ints, without sorting."""
+		present = np.bincount(values, minlength=maxValue) if maxValue <= cls.DENSE_LIMIT else None
+		if present is None:
+			return np.unique(values, return_inverse=True)
+		unique = np.flatnonzero(present)
+		lookup = np.zeros(len(present), np.intp)
+		lookup[unique] = np.arange(len(unique))
+		return unique, lookup[values]
+
+	def summary(self, seconds, digits=None, limit=100, now=None):
+		"""
+		Per prefix and gateway over the last seconds: count, share of each SIP
+		code, median time to ring and timeout rate, busiest groups first.
+		"""
+		digits = min(digits or self.prefixDigits, self.prefixDigits)
+		records = self.window(seconds, now)
+		if not len(records['time']):
+			return []
+
+		gatewayNames = self.gatewayNames()
+		gateways = max(len(gatewayNames), 1)
+		keys = (records['prefix'] // 10 ** (self.prefixDigits - digits)).astype(np.intp) * gateways + records['gateway']
+		groups, inverse = self.dense(keys, 10 ** digits * gateways)
+		counts = np.bincount(inverse)
+
+		codes, codeInverse = self.dense(records['sip'], 1 << 16)
+		codeCounts = np.bincount(inverse * len(codes) + codeInverse,
+			minlength=len(groups) * len(codes)).reshape(len(groups), len(codes))
+
+		timeouts = np.bincount(inverse[records['timeout'].view(bool)], minlength=len(groups))
+
+		# Median ring time: one sort of group * span + ring time orders rang
+		# calls by group then ring time, the middle of each group is the median
+		rang = ~np.isnan(records['ring'])
+		ringGroups = inverse[rang]
+		ringTimes = records['ring'][rang].astype(np.float64)
+		medians = np.full(len(groups), np.nan)
+		if len(ringTimes):
+			span = float(ringTimes.max()) + 1
+			ringTimes = np.sort(ringGroups * span + ringTimes)
+			ringCounts = np.bincount(ringGroups, minlength=len(groups))
+			starts = np.concatenate(([0], np.cumsum(ringCounts)[:-1]))
+			hasRing = np.flatnonzero(ringCounts)
+			low = starts[hasRing] + (ringCounts[hasRing] - 1) // 2
+			high = starts[hasRing] + ringCounts[hasRing] // 2
+			medians[hasRing] = (ringTimes[low] + ringTimes[high]) / 2 - hasRing * span
+
+		top = np.argsort(-counts, kind='stable')[:limit]
+
+		result = []
+		for i in top:
+			gateway = int(groups[i] % gateways)
+			shares = codeCounts[i] / counts[i]
+			result.append({
+				'prefix': str(int(groups[i] // gateways)).zfill(digits),
+				'gateway': gatewayNames[gateway] if gateway < len(gatewayNames) else None,
+				'count': int(counts[i]),
+				'codes': {str(int(code)): round(float(share), 4) for code, share in zip(codes, shares) if share},
+				'median_ring_time': None if np.isnan(medians[i]) else round(float(medians[i]), 3),
+				'timeout_rate': round(float(timeouts[i] / counts[i]), 4),
+			})
+		return result
@@ -0,0 +1,153 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+import file_lock
+
+# Counting Bloom filters of numbers recently found dead, one per disconnect
+# code. Shared through memory-mapped files by the API workers of a host
+# (base/cache/vhlr_filter.py) and a dialer worker running next to them.
+
+
+class CountingFilter(object):
+	"""
+	Counting Bloom filter with 4-bit counters in a memory-mapped file, so all
+	workers on a host share it. Entries age out through generations: each
+	one covers max_age / generations seconds and the oldest is wiped when the
+	clock enters a new one, so an entry lives between max_age * (G-1)/G and
+	max_age. remove() decrements the counters of every generation holding
+	the entry.
+
+	Counter updates from several processes are not locked; a lost update only
+	shifts the false positive rate slightly, which a probabilistic filter
+	tolerates. Generation wipes are serialized with flock.
+
+	contains() probes every generation, so each one is sized for
+	error_rate / generations and the whole filter stays within error_rate
+	with capacity entries in each generation.
+	"""
+	MAGIC = b'VHLRCBF1'
+	HEADER = struct.Struct('<8sQIII') # magic, counters per generation, hashes, generations, generation sec
+	EPOCH = struct.Struct('<q')
+
+	def __init__(self, path, capacity, error_rate, max_age, generations):
+		self.path = path
+		generationRate = error_rate / generations
+		self.size = int(math.ceil(-capacity * math.log(generationRate) / (math.log(2) ** 2)))
+		self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+		self.generations = generations
+		self.period = max(1, int(max_age // generations))
+
+		self.genBytes = (self.size + 1) // 2
+		self.epochsOffset = self.HEADER.size
+		self.dataOffset = self.epochsOffset + self.EPOCH.size * generations
+		fileSize = self.dataOffset + self.genBytes * generations
+
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		with self.locked():
+			header = os.pread(self.fd, self.HEADER.size, 0)
+			expected = self.HEADER.pack(self.MAGIC, self.size, self.hashes, self.generations, self.period)
+			if header != expected or os.fstat(self.fd).st_size != fileSize:
+				# New file or other parameters: start empty
+				os.ftruncate(self.fd, 0)
+				os.ftruncate(self.fd, fileSize)
+				os.pwrite(self.fd, expected, 0)
+		self.map = mmap.mmap(self.fd, fileSize, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+	def locked(self):
+		return file_lock.FileLock(self.fd)
+
+	def positions(self, key):
+		digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+		h1, h2 = struct.unpack('<QQ', digest)
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def epoch(self, generation):
+		return self.EPOCH.unpack_from(self.map, self.epochsOffset + self.EPOCH.size * generation)[0]
+
+	def current(self):
+		# Generation slot for now, wiped first if it still holds an expired epoch
+		now = int(time.time()) // self.period
+		generation = now % self.generations
+		if self.epoch(generation) != now:
+			with self.locked():
+				if self.epoch(generation) != now:
+					start = self.dataOffset + generation * self.genBytes
+					self.map[start:start + self.genBytes] = bytes(self.genBytes)
+					self.EPOCH.pack_into(self.map, self.epochsOffset + self.EPOCH.size * generation, now)
+		return now, generation
+
+	def live(self):
+		now, _ = self.current()
+		return [g for g in range(self.generations) if now - self.epoch(g) < self.generations]
+
+	def counter(self, offset, position):
+		return (self.map[offset + (position >> 1)] >> ((position & 1) * 4)) & 0xF
+
+	def contains(self, key, generations=None):
+		positions = self.positions(key)
+		for generation in generations if generations is not None else self.live():
+			offset = self.dataOffset + generation * self.genBytes
+			if all(self.counter(offset, p) for p in positions):
+				return True
+		return False
+
+	def add(self, key):
+		_, generation = self.current()
+		offset = self.dataOffset + generation * self.genBytes
+		for p in self.positions(key):
+			index = offset + (p >> 1)
+			shift = (p & 1) * 4
+			if (self.map[index] >> shift) & 0xF < 0xF:
+				self.map[index] += 1 << shift
+
+	def remove(self, key):
+		positions = self.positions(key)
+		for generation in self.live():
+			if not self.contains(key, [generation]):
+				continue
+			offset = self.dataOffset + generation * self.genBytes
+			for p in positions:
+				index = offset + (p >> 1)
+				shift = (p & 1) * 4
+				# Saturated counters can no longer be decremented safely
+				if (self.map[index] >> shift) & 0xF < 0xF:
+					self.map[index] -= 1 << shift
+
+
+def openFilters(config):
+	"""
+	{cause: CountingFilter} from a settings.VHLR_NEGATIVE_FILTER style dict,
+	OSError if the dir is unusable. A lookup probes every cause, each gets
+	its share of error_rate.
+	"""
+	os.makedirs(config['dir'], exist_ok=True)
+	return {
+		cause: CountingFilter(
+			os.path.join(config['dir'], '%s.bin' % cause.lower()),
+			config['capacity'],
+			config['error_rate'] / len(config['causes']),
+			config['max_age'],
+			config['generations'],
+		) for cause in config['causes']
+	}
+
+
+def record(filters, dst_number, disconnect_code):
+	"""
+	Track a dial outcome: add dead numbers, drop numbers that came back
+	alive. Returns 'added', 'removed' or None.
+	"""
+	if disconnect_code in filters:
+		filters[disconnect_code].add(dst_number)
+		return 'added'
+
+	removed = None
+	for numbers in filters.values():
+		if numbers.contains(dst_number):
+			numbers.remove(dst_number)
+			removed = 'removed'
+	return removed
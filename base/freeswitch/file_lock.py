@@ -0,0 +1,15 @@
+import fcntl
+
+# Exclusive flock on an open file, shared by the memory-mapped stores of
+# the dialer and the API workers (call_stats, counting_filter)
+
+
+class FileLock(object):
+	def __init__(self, fd):
+		self.fd = fd
+
+	def __enter__(self):
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+	def __exit__(self, *exc):
+		fcntl.flock(self.fd, fcntl.LOCK_UN)
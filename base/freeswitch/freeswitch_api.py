@@ -10,7 +10,11 @@ import logging
 #import json
 import uuid
 import re
+import signal
+import json
+import sqlite3
 import random
+import math
 import asyncio
 #import uvloop
 #import asyncssh
@@ -18,6 +22,7 @@ import asyncio
 from datetime import datetime
 from collections import OrderedDict, deque
 from functools import partial
+from urllib.parse import unquote
 
 RUN_DIR = os.path.abspath(os.getcwd())
 INSTANCE_NAME = RUN_DIR.split('/')[-1]
@@ -35,7 +40,7 @@ class Config:
 		self.dst_address = "192.168.127.130:5060" # address:port
 		self.src_number_pattern = None
 		self.dst_number_pattern = None
-		#self.connect_timeout = 7 # sec
+		self.connect_timeout = 7 # sec
 		self.max_connected_duration = None # sec, format: X or (X, Y) - random value in the range [X, Y] for each call
 		self.cps = 1
 		self.max_calls_count = None
@@ -62,6 +67,17 @@ class Config:
 
 		self.fs_cli_host = None
 		self.fs_cli_port = None
+		self.fs_cli_timeout = 5 # sec, deadline of a single command, originate gets connect_timeout on top
+		self.fs_cli_reap_period = 5 # sec
+		self.timer_tick = 0.1 # sec, resolution of the call timers, see TimerWheel
+		self.loop_lag_interval = 0.5 # sec between event loop lag probes, None disables, see async_utils.LagMonitor
+		self.loop_lag_threshold = 0.2 # sec the loop may block before its stack is logged
+		self.loop_lag_dump_period = 60 # sec, at most one stack dump per period
+
+		self.originate_mode = 'api' # api - fs_cli per command, bgapi - event socket with background jobs
+		self.fs_esl_host = '127.0.0.1'
+		self.fs_esl_port = 8021
+		self.fs_esl_password = 'ClueCon'
 
 		self.dump_stat_period = 10 # sec
 		self.silent_mode = False
@@ -75,27 +91,49 @@ class Config:
 		self.comment = None
 
 
+class FSCLITimeout(Exception):
+	pass
+
+
 class FSCLI:
-	def __init__(self, host=None, port=None):
+	def __init__(self, host=None, port=None, timeout=None):
 		self.command = 'fs_cli%s%s' % ((' -H %s' % host) if host else '', (' -P %s' % port) if port else '')
+		self.timeout = timeout # sec, default deadline of a command
 		self.proc_list = {}
-
-	async def execute(self, cmd, type='call_orignate'):
+		self.proc_info = {} # fs_guid -> (owner, cmd, deadline)
+		self.reaperTask = None
+
+	async def execute(self, cmd, type='call_orignate', owner=None, timeout=None):
+		"""
+		Run cmd through fs_cli. The process is killed and FSCLITimeout raised
+		once timeout (or the default deadline) expires, and it is also killed
+		if the caller is cancelled.
+		"""
 		fs_guid = str(uuid.uuid1())
-		cmd = '%s -x "%s"' % (self.command, cmd)
+		timeout = timeout or self.timeout
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + timeout if timeout else None
+
+		command = '%s -x "%s"' % (self.command, cmd)
+		# Own process group: the shell doesn't always exec fs_cli, signals go to the whole group
 		proc = await asyncio.create_subprocess_shell(
-			cmd,
+			command,
 			stdout=asyncio.subprocess.PIPE,
-			stderr=asyncio.subprocess.PIPE)
+			stderr=asyncio.subprocess.PIPE,
+			start_new_session=True)
 		self.proc_list[fs_guid] = proc
+		self.proc_info[fs_guid] = (owner, cmd, deadline)
 
-		stdout, stderr = await proc.communicate()
-		
-		# Delete after finising
 		try:
-			del self.proc_list[fs_guid]
-		except:
-			pass
+			stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+		except asyncio.TimeoutError:
+			raise FSCLITimeout('Command timed out after %s sec: %s' % (timeout, cmd))
+		finally:
+			# Delete after finising
+			self.proc_list.pop(fs_guid, None)
+			self.proc_info.pop(fs_guid, None)
+			if proc.returncode is None:
+				self.kill(proc)
 
 		if proc.returncode:
 			if stderr:
@@ -109,16 +147,244 @@ class FSCLI:
 			if result.startswith('-ERR'):
 				raise Exception(result[4:].strip())
 			return result
-	
-	def fsCliTerminate(self):
-		if self.proc_list:
-			logger.info('FSCLI.fsCliTerminate()')
-			for proc in self.proc_list.values():
+
+	@staticmethod
+	def signal(proc, sig):
+		try:
+			os.killpg(proc.pid, sig)
+		except ProcessLookupError:
+			pass
+
+	@classmethod
+	def kill(cls, proc):
+		cls.signal(proc, signal.SIGKILL)
+		# Collect the exit status in the background so no zombie is left
+		async_utils.create_task(
+			proc.wait(),
+			logger=logger,
+			msg='Failed to reap fs_cli process %s',
+			msg_args=(proc.pid,)
+		)
+
+	def fsCliTerminate(self, owner=None):
+		# Only processes started for the owner, all of them if no owner given
+		procs = [proc for fs_guid, proc in self.proc_list.items() if owner is None or self.proc_info[fs_guid][0] == owner]
+		if procs:
+			logger.info('FSCLI.fsCliTerminate(): %s', owner)
+			for proc in procs:
 				try:
-					proc.terminate()
+					self.signal(proc, signal.SIGTERM)
 				except Exception as e:
 					logger.debug('FSCLI.fsCliTerminate() -> Exception : %s', e)
 
+	def pending(self):
+		"""Running commands by owner: {owner: [cmd, ...]}."""
+		commands = {}
+		for owner, cmd, _deadline in list(self.proc_info.values()):
+			commands.setdefault(owner, []).append(cmd)
+		return commands
+
+	def startReaper(self, period):
+		self.reaperTask = async_utils.create_task(
+			self.onReaperTimer(period),
+			logger=logger,
+			msg='FSCLI reaper exception'
+		)
+
+	def stopReaper(self):
+		if self.reaperTask:
+			self.reaperTask.cancel()
+			self.reaperTask = None
+
+	async def onReaperTimer(self, period):
+		# Backstop for processes nobody waits for any more, e.g. after a lost task
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep(period)
+			now = loop.time()
+			for fs_guid, (owner, cmd, deadline) in list(self.proc_info.items()):
+				if deadline and now > deadline + period:
+					logger.warning('FSCLI reaper -> Killing orphaned command: %s, owner: %s', cmd, owner)
+					proc = self.proc_list.pop(fs_guid, None)
+					self.proc_info.pop(fs_guid, None)
+					if proc and proc.returncode is None:
+						self.kill(proc)
+
+
+class ESLClient:
+	"""
+	Minimal inbound event socket client with the FSCLI interface. All
+	commands share one connection: api replies arrive in request order and
+	bgapi jobs are matched to their BACKGROUND_JOB event by Job-UUID, so a
+	ringing originate holds neither a connection nor a process.
+	"""
+	def __init__(self, host, port, password, timeout=None):
+		self.host = host
+		self.port = port
+		self.password = password
+		self.timeout = timeout # sec, default deadline of an api command
+		self.reader = None
+		self.writer = None
+		self.replies = deque() # Futures waiting for command/reply or api/response
+		self.jobs = {} # Job-UUID -> Future
+		self.commands = {} # command id -> (owner, cmd), for introspection
+		self.readerTask = None
+		self.connectLock = None
+
+	async def connect(self):
+		self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+		headers, _ = await self.readMessage()
+		if headers.get('Content-Type') != 'auth/request':
+			raise Exception('Unexpected event socket greeting: %s' % headers)
+
+		for cmd in ('auth %s' % self.password, 'event plain BACKGROUND_JOB'):
+			self.writer.write(('%s\n\n' % cmd).encode())
+			headers, _ = await self.readMessage()
+			reply = headers.get('Reply-Text', '')
+			if not reply.startswith('+OK'):
+				self.writer.close()
+				raise Exception('Event socket command failed: %s' % reply)
+
+		self.readerTask = async_utils.create_task(
+			self.onRead(),
+			logger=logger,
+			msg='Event socket reader exception'
+		)
+		logger.info('Connected to event socket %s:%s', self.host, self.port)
+
+	async def ensureConnected(self):
+		if self.connectLock is None:
+			self.connectLock = asyncio.Lock()
+
+		async with self.connectLock:
+			if self.writer is None or self.writer.is_closing():
+				await self.connect()
+
+	def close(self):
+		if self.writer:
+			self.writer.close()
+		if self.readerTask:
+			self.readerTask.cancel()
+			self.readerTask = None
+
+	async def readMessage(self):
+		headers = {}
+		while True:
+			line = await self.reader.readline()
+			if not line:
+				raise ConnectionError('Event socket connection closed')
+			line = line.decode().rstrip('\n')
+			if not line:
+				if headers:
+					break
+				continue
+			name, _, value = line.partition(': ')
+			headers[name] = value
+
+		body = ''
+		if 'Content-Length' in headers:
+			body = (await self.reader.readexactly(int(headers['Content-Length']))).decode()
+		return headers, body
+
+	async def onRead(self):
+		error = None
+		try:
+			while True:
+				headers, body = await self.readMessage()
+				contentType = headers.get('Content-Type')
+				if contentType in ('command/reply', 'api/response'):
+					if self.replies:
+						future = self.replies.popleft()
+						if not future.done():
+							future.set_result((headers, body))
+				elif contentType == 'text/event-plain':
+					self.onEvent(body)
+				elif contentType == 'text/disconnect-notice':
+					break
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			error = e
+		finally:
+			self.onDisconnected(error)
+
+	def onEvent(self, body):
+		head, _, jobBody = body.partition('\n\n')
+		event = {}
+		for line in head.splitlines():
+			name, _, value = line.partition(': ')
+			event[name] = unquote(value)
+
+		if event.get('Event-Name') == 'BACKGROUND_JOB':
+			future = self.jobs.pop(event.get('Job-UUID'), None)
+			if future and not future.done():
+				future.set_result(jobBody)
+
+	def onDisconnected(self, error):
+		logger.warning('Event socket disconnected: %s', error)
+		if self.writer:
+			self.writer.close()
+
+		pending = list(self.replies) + list(self.jobs.values())
+		self.replies.clear()
+		self.jobs.clear()
+		for future in pending:
+			if not future.done():
+				future.set_exception(ConnectionError('Event socket connection lost'))
+
+	async def command(self, text):
+		await self.ensureConnected()
+		future = asyncio.get_running_loop().create_future()
+		self.replies.append(future)
+		self.writer.write(text.encode())
+		return await future
+
+	async def execute(self, cmd, type=None, owner=None, timeout=None):
+		commandId = str(uuid.uuid1())
+		self.commands[commandId] = (owner, cmd)
+		try:
+			headers, body = await asyncio.wait_for(self.command('api %s\n\n' % cmd), timeout or self.timeout)
+		except asyncio.TimeoutError:
+			raise FSCLITimeout('Command timed out after %s sec: %s' % (timeout or self.timeout, cmd))
+		finally:
+			self.commands.pop(commandId, None)
+		result = body.strip()
+		if result.startswith('-ERR'):
+			raise Exception(result[4:].strip())
+		return result
+
+	async def bgapi(self, cmd, jobUuid, timeout=None):
+		future = self.jobs[jobUuid] = asyncio.get_running_loop().create_future()
+		self.commands[jobUuid] = (jobUuid, 'bgapi %s' % cmd)
+		try:
+			headers, _ = await asyncio.wait_for(self.command('bgapi %s\nJob-UUID: %s\n\n' % (cmd, jobUuid)), self.timeout)
+			reply = headers.get('Reply-Text', '')
+			if not reply.startswith('+OK'):
+				raise Exception(reply[4:].strip())
+
+			result = (await asyncio.wait_for(future, timeout)).strip()
+		except asyncio.TimeoutError:
+			raise FSCLITimeout('Background job timed out: %s' % jobUuid)
+		finally:
+			self.jobs.pop(jobUuid, None)
+			self.commands.pop(jobUuid, None)
+
+		if result.startswith('-ERR'):
+			raise Exception(result[4:].strip())
+		return result
+
+	def pending(self):
+		"""Commands waiting for a reply or job result by owner: {owner: [cmd, ...]}."""
+		commands = {}
+		for owner, cmd in list(self.commands.values()):
+			commands.setdefault(owner, []).append(cmd)
+		return commands
+
+	def fsCliTerminate(self, owner=None):
+		# Commands own no processes, a pending originate ends with its channel
+		pass
+
 
 class CallState:
 
@@ -181,21 +447,134 @@ class CallState:
 		'NORMAL_TEMPORARY_FAILURE'
 	]
 
+	# Transient outcomes worth another attempt instead of being cached as final
+	retry_disconnect_codes = [
+		'NORMAL_CIRCUIT_CONGESTION',
+		'SWITCH_CONGESTION',
+		'REQUESTED_CHAN_UNAVAIL',
+	]
+
+
+class WheelTimer:
+	__slots__ = ('wheel', 'expires', 'callback', 'args')
+
+	def __init__(self, wheel, expires, callback, args):
+		self.wheel = wheel
+		self.expires = expires # tick number
+		self.callback = callback
+		self.args = args
+
+	def cancel(self):
+		if self.wheel:
+			self.wheel.remove(self)
+
+
+class TimerWheel:
+	"""
+	Hashed timing wheel for the per-call timers: connect deadlines, state
+	check ticks and lookup backstops. A timer is an entry in the slot of its
+	tick; one loop callback per tick fires every due timer of the slot,
+	instead of a heap entry, and usually a task, per timer. Timers fire up
+	to one tick late, never early. Callbacks run on the loop and must not
+	block. While the wheel is empty nothing is scheduled on the loop.
+	"""
+	def __init__(self, tick=0.1, size=512):
+		self.tick = tick
+		self.slots = [set() for _ in range(size)]
+		self.count = 0
+		self.next = 0 # next tick to process
+		self.handle = None
+		self.loop = None
+
+	def __len__(self):
+		return self.count
+
+	def schedule(self, delay, callback, *args):
+		"""Call callback(*args) after delay sec, returns a timer with cancel()."""
+		if self.loop is None:
+			self.loop = asyncio.get_running_loop()
+		now = self.loop.time()
+		if self.handle is None:
+			# Idle: skip the ticks passed meanwhile
+			self.next = int(now / self.tick)
+
+		expires = max(math.ceil((now + delay) / self.tick), self.next)
+		timer = WheelTimer(self, expires, callback, args)
+		self.slots[expires % len(self.slots)].add(timer)
+		self.count += 1
+
+		if self.handle is None:
+			self.handle = self.loop.call_at(self.next * self.tick, self.onTick)
+		return timer
+
+	def remove(self, timer):
+		self.slots[timer.expires % len(self.slots)].discard(timer)
+		timer.wheel = None
+		self.count -= 1
+
+	def clear(self):
+		for slot in self.slots:
+			for timer in slot:
+				timer.wheel = None
+			slot.clear()
+		self.count = 0
+		if self.handle:
+			self.handle.cancel()
+			self.handle = None
+
+	def onTick(self):
+		self.handle = None
+		# The loop may run a handle up to its clock resolution early
+		current = max(int(self.loop.time() / self.tick), self.next)
+
+		while self.next <= current and self.count:
+			tick = self.next
+			# Timers scheduled by the callbacks go to later ticks
+			self.next += 1
+			slot = self.slots[tick % len(self.slots)]
+			if not slot:
+				continue
+
+			due = [timer for timer in slot if timer.expires <= tick]
+			for timer in due:
+				self.remove(timer)
+			for timer in due:
+				try:
+					timer.callback(*timer.args)
+				except Exception:
+					logger.exception('TimerWheel -> Timer callback %s failed', timer.callback)
+
+		if self.count:
+			self.handle = self.loop.call_at(self.next * self.tick, self.onTick)
+
 
 class Call:
-	def __init__(self, srcNum, dstNum, guid, owner):
+	__slots__ = (
+		'srcNum', 'dstNum', 'guid', 'owner', 'connectTimeout',
+		'state', 'disconnect_code', 'terminated', 'timedOut',
+		'setupTime', 'ringTime', 'connectTime', 'disconnectTime',
+		'connectTimer', 'checkTimer', 'checkCallStateTask',
+	)
+
+	def __init__(self, srcNum, dstNum, guid, owner, connectTimeout=None):
 		self.srcNum = srcNum
 		self.dstNum = dstNum
 		self.guid = guid
 		self.owner = owner
+		self.connectTimeout = connectTimeout or config.connect_timeout
 		self.state = 'INITIAL'
 		self.disconnect_code = None
+		self.terminated = False
+		self.timedOut = False # ended by the connect timeout
 
 		self.setupTime = None
+		self.ringTime = None
 		self.connectTime = None
 		self.disconnectTime = None
 
-		self.connectTimeoutTask = None
+		# Timers live on the timerWheel, a task only runs while a check command does
+		self.connectTimer = None
+		self.checkTimer = None
 		self.checkCallStateTask = None
 
 	async def start(self):
@@ -203,22 +582,12 @@ class Call:
 		self.state = 'DIALING'
 
 		self.setupTime = datetime.utcnow()
-		loop = asyncio.get_running_loop()
-		
-		self.checkCallStateTask = async_utils.create_task(
-				self.onCheckCallState(config.check_timeout),
-				logger=logger,
-				msg='Checking current call state. uuid: %s',
-				msg_args=(self.guid,)
-			)
-
-		if config.connect_timeout:
-			self.connectTimeoutTask = async_utils.create_task(
-				self.onConnectTimeoutTimer(config.connect_timeout),
-				logger=logger,
-				msg='Connect timeout timer exception, uuid: %s',
-				msg_args=(self.guid,)
-			)
+
+		if not channelPoller:
+			self.checkTimer = timerWheel.schedule(0, self.onCheckTimer)
+
+		if self.connectTimeout:
+			self.connectTimer = timerWheel.schedule(self.connectTimeout, self.onConnectTimeout)
 
 		try:
 			audioFilesDelimiter = '!'
@@ -283,7 +652,12 @@ class Call:
 			#  	'application': application
 			#  }
 
-			result = await fsCli.execute(cmd)
+			# The connect timeout stops the call first, the deadline is a backstop
+			timeout = (self.connectTimeout or 0) + config.fs_cli_timeout
+			if config.originate_mode == 'bgapi':
+				result = await fsCli.bgapi(cmd, jobUuid=self.guid, timeout=timeout)
+			else:
+				result = await fsCli.execute(cmd, owner=self.guid, timeout=timeout)
 			logger.debug('Call.start() -> result: %s. uuid: %s', result, self.guid)
 
 		except Exception as e:
@@ -314,7 +688,7 @@ class Call:
 		#self.state = CallState.HANGUP
 
 		try:
-			await fsCli.execute('uuid_kill %s' % self.guid)
+			await fsCli.execute('uuid_kill %s' % self.guid, owner=self.guid)
 		except asyncio.CancelledError:
 			logger.warning('Failed to stop call, src = %s, dst = %s, uuid = %s: cancelled', self.srcNum, self.dstNum, self.guid)
 		except Exception as e:
@@ -329,69 +703,172 @@ class Call:
 	def onTerminated(self):
 		logger.debug('Call.onTerminated(): %s', self.guid)
 
-		if self.state == 'HANGUP':
+		# state alone can't tell: FreeSWITCH itself may report a HANGUP channel state
+		if self.terminated:
 			return
 
+		self.terminated = True
 		self.state = 'HANGUP'
 
 		self.disconnectTime = datetime.utcnow()		
 
-		if self.connectTimeoutTask:
-			self.connectTimeoutTask.cancel()
-			self.connectTimeoutTask = None
+		if self.connectTimer:
+			self.connectTimer.cancel()
+			self.connectTimer = None
+
+		if self.checkTimer:
+			self.checkTimer.cancel()
+			self.checkTimer = None
 
 		if self.checkCallStateTask:
 			self.checkCallStateTask.cancel()
 			self.checkCallStateTask = None
 
-		fsCli.fsCliTerminate()
+		fsCli.fsCliTerminate(self.guid)
 		
 		if self.owner:
 			self.owner.onCallTerminated(self)
 
-	async def onCheckCallState(self, timeout):
-		stop_call = False
-		while True:
+	def onCheckTimer(self):
+		self.checkTimer = None
+		self.checkCallStateTask = async_utils.create_task(
+			self.onCheckCallState(),
+			logger=logger,
+			msg='Checking current call state. uuid: %s',
+			msg_args=(self.guid,)
+		)
+
+	async def onCheckCallState(self):
+		# One check, the next one is scheduled on the wheel unless the call is done
+		try:
+			callInfo = await fsCli.execute('uuid_dump %s' % self.guid, owner=self.guid)
+			logger.debug('Call.onCheckCallState -> callInfo: %s', callInfo)
 			try:
-				callInfo = await fsCli.execute('uuid_dump %s' % self.guid)
-				logger.debug('Call.onCheckCallState -> callInfo: %s', callInfo)
-				try:
-					self.state = re.findall('.*Channel-Call-State: (\w+).*', callInfo)[0]
-					logger.info('Call.onCheckCallState -> state: %s. uuid: %s', self.state, self.guid)
-				except Exception as e:
-					logger.info('Call.onCheckCallState -> Cant get Channel-Call-State: %s. Exception: %s. uuid: %s', callInfo, e, self.guid)
-					self.disconnect_code = 'ORIGINATOR_CANCEL'
-					stop_call = True
-					break
-
-				if self.state in CallState.states_disconnect_code_map and CallState.states_disconnect_code_map[self.state] in CallState.success_disconnect_codes:
-					self.disconnect_code = CallState.states_disconnect_code_map[self.state]
-					stop_call = True
-					break
-
-				await asyncio.sleep(timeout)
+				self.state = re.findall('.*Channel-Call-State: (\w+).*', callInfo)[0]
+				logger.info('Call.onCheckCallState -> state: %s. uuid: %s', self.state, self.guid)
 			except Exception as e:
-				logger.debug('Call.onCheckCallState -> Exception: %s. uuid: %s', e, self.guid)
-				break
-		if stop_call:
-			await self.stop()	
+				logger.info('Call.onCheckCallState -> Cant get Channel-Call-State: %s. Exception: %s. uuid: %s', callInfo, e, self.guid)
+				self.disconnect_code = 'ORIGINATOR_CANCEL'
+				stop_call = True
+			else:
+				stop_call = self.onChannelState(self.state)
+		except Exception as e:
+			logger.debug('Call.onCheckCallState -> Exception: %s. uuid: %s', e, self.guid)
+			return
+		finally:
+			self.checkCallStateTask = None
 
-		
-	
-	async def onConnectTimeoutTimer(self, timeout):
-		await asyncio.sleep(timeout)
+		if stop_call:
+			await self.stop()
+		elif not self.terminated:
+			self.checkTimer = timerWheel.schedule(config.check_timeout, self.onCheckTimer)
+
+	def onChannelState(self, state):
+		# Returns True when the state is final enough to stop the call
+		self.state = state
+		if state in ('EARLY', 'RINGING') and not self.ringTime:
+			self.ringTime = datetime.utcnow()
+		if self.state in CallState.states_disconnect_code_map and CallState.states_disconnect_code_map[self.state] in CallState.success_disconnect_codes:
+			self.disconnect_code = CallState.states_disconnect_code_map[self.state]
+			return True
+		return False
 
+	def onConnectTimeout(self):
+		self.connectTimer = None
 		logger.debug('Connect timeout exceeds, stopping call with uuid = %s', self.guid)
+		self.timedOut = True
 		# Wait PROGESS for some time
 		if self.state and self.state in ('EARLY', 'RINGING'):
 			self.disconnect_code = 'RINGING'
 		else:	
 			self.disconnect_code = 'RINGING_TIMEOUT'
-		await self.stop()
+		async_utils.create_task(
+			self.stop(),
+			logger=logger,
+			msg='Connect timeout stop exception, uuid: %s',
+			msg_args=(self.guid,)
+		)
+
+class ChannelPoller:
+	"""
+	Polls the state of every in-flight call with one FreeSWITCH query per
+	tick instead of a uuid_dump per call, and fans the states out to the
+	calls by uuid. Modes:
+		channels - 'show channels as json' through FSCLI
+		core_db  - SELECT from the channels table in config.receiver_core_db
+	"""
+	def __init__(self, calls, mode, period):
+		self.calls = calls # uuid -> Call, owned by the engine
+		self.mode = mode
+		self.period = period
+		self.stopping = set()
+		self.task = None
+
+	def start(self):
+		self.task = async_utils.create_task(
+			self.onPollTimer(),
+			logger=logger,
+			msg='Channel poller exception'
+		)
+
+	def stop(self):
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+	async def fetchStates(self):
+		if self.mode == 'core_db':
+			loop = asyncio.get_running_loop()
+			rows = await loop.run_in_executor(None, self.readCoreDb, config.receiver_core_db)
+			return dict(rows)
+
+		output = await fsCli.execute('show channels as json')
+		return {row['uuid']: row['callstate'] for row in json.loads(output or '{}').get('rows', ())}
+
+	@staticmethod
+	def readCoreDb(path):
+		db = sqlite3.connect('file:%s?mode=ro' % path, uri=True, timeout=1)
+		try:
+			return db.execute('SELECT uuid, callstate FROM channels').fetchall()
+		finally:
+			db.close()
+
+	async def onPollTimer(self):
+		while True:
+			await asyncio.sleep(self.period)
+			if not self.calls:
+				continue
+
+			try:
+				states = await self.fetchStates()
+			except Exception as e:
+				logger.warning('ChannelPoller -> Failed to get channel states: %s', e)
+				continue
+
+			for guid, call in list(self.calls.items()):
+				state = states.get(guid)
+				# A channel missing from the list is not created yet or already gone,
+				# the originate result covers both
+				if not state or guid in self.stopping:
+					continue
+
+				if call.onChannelState(state):
+					logger.info('ChannelPoller -> state: %s. uuid: %s', state, guid)
+					self.stopping.add(guid)
+					task = async_utils.create_task(
+						call.stop(),
+						logger=logger,
+						msg='Failed to stop call, uuid: %s',
+						msg_args=(guid,)
+					)
+					task.add_done_callback(lambda t, guid=guid: self.stopping.discard(guid))
+
 
 # global objects will be inited in App.start()
 config = None
 fsCli = None
+timerWheel = None
+channelPoller = None # set by the engine when calls are polled in batches
 
 
 
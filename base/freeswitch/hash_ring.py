@@ -0,0 +1,43 @@
+import bisect
+import hashlib
+import struct
+
+# Key placement over the VHLR_REDIS nodes, shared by the API side
+# (base/cache/vhlr_redis.py) and the dialer workers, so both write a number
+# to the node the other one reads it from
+
+
+def nodeName(node):
+	"""Ring name of a {'host', 'port'[, 'db']} node."""
+	return '%s:%s/%s' % (node['host'], node['port'], node.get('db', 0))
+
+
+class HashRing(object):
+	"""
+	Consistent hash ring (ketama style): every node owns replicas * 4 points
+	on a 32-bit circle and a key belongs to the next point clockwise. Adding
+	or removing a node only moves the keys of the arcs it gains or loses,
+	about 1/N of them.
+	"""
+	def __init__(self, replicas=40):
+		self.replicas = replicas
+		self.points = [] # sorted point hashes
+		self.owners = [] # node name of each point
+
+	def add(self, name):
+		for i in range(self.replicas):
+			digest = hashlib.md5(('%s-%s' % (name, i)).encode()).digest()
+			for point in struct.unpack('<4I', digest):
+				index = bisect.bisect(self.points, point)
+				self.points.insert(index, point)
+				self.owners.insert(index, name)
+
+	def remove(self, name):
+		keep = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != name]
+		self.points = [point for point, _ in keep]
+		self.owners = [owner for _, owner in keep]
+
+	def node(self, key):
+		point = struct.unpack_from('<I', hashlib.md5(key.encode()).digest())[0]
+		index = bisect.bisect(self.points, point)
+		return self.owners[index % len(self.owners)]
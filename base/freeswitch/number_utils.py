@@ -0,0 +1,86 @@
+# Offline phone number normalization to E.164 digits
+
+FORMATTING = ' -.()/\t'
+
+
+class NumberError(ValueError):
+	pass
+
+
+class Normalizer:
+	"""
+	Turns the ways a number gets written ('+4917...', '004917...',
+	'017...', '4917...', '+49 (0) 17...') into one key: country code and
+	national number, digits only, no '+'. Caches, single-flight and the
+	dialer all use that key, so spellings of one number share one entry
+	and one call.
+
+	Rules, checked longest prefix first:
+	  - '+' and config international prefixes ('00') are dropped
+	  - the trunk prefix ('0') becomes the default country code
+	  - extra rules {prefix: replacement} from the config, e.g. {'0049': '49'}
+	  - without a trunk prefix in the country (trunk_prefix=None) a number of
+	    national_length digits gets the default country code
+	  - anything else is taken as already international
+	The rule table is compiled once per Normalizer, normalize() is a
+	translate and at most a few dict lookups.
+	"""
+	def __init__(self, default_country, trunk_prefix='0', international_prefixes=('00',), rules=None,
+			national_length=None, min_length=7, max_length=15):
+		self.defaultCountry = default_country
+		self.trunkPrefix = trunk_prefix
+		self.nationalLength = national_length
+		self.minLength = min_length
+		self.maxLength = max_length
+		self.strip = str.maketrans('', '', FORMATTING)
+
+		table = {prefix: '' for prefix in international_prefixes}
+		if trunk_prefix:
+			table[trunk_prefix] = default_country
+		table.update(rules or {})
+
+		# prefix length -> {prefix: replacement}, longest first
+		self.table = {}
+		for prefix, replacement in table.items():
+			self.table.setdefault(len(prefix), {})[prefix] = replacement
+		self.lengths = sorted(self.table, reverse=True)
+
+	def normalize(self, number):
+		"""E.164 digits of number, NumberError if it can't be one."""
+		if not isinstance(number, str):
+			raise NumberError('number must be a string')
+
+		digits = number.translate(self.strip)
+		if digits.startswith('+'):
+			digits = digits[1:]
+			# '+49 (0) 17...': the trunk prefix some people keep after the country code
+			if self.trunkPrefix and '(%s)' % self.trunkPrefix in number and digits.startswith(self.defaultCountry + self.trunkPrefix):
+				digits = self.defaultCountry + digits[len(self.defaultCountry) + len(self.trunkPrefix):]
+		else:
+			for length in self.lengths:
+				replacement = self.table[length].get(digits[:length])
+				if replacement is not None:
+					digits = replacement + digits[length:]
+					break
+			else:
+				if not self.trunkPrefix and len(digits) == self.nationalLength:
+					digits = self.defaultCountry + digits
+
+		if not digits.isdigit() or not digits.isascii():
+			raise NumberError('invalid number %s' % number)
+		if not self.minLength <= len(digits) <= self.maxLength:
+			raise NumberError('invalid number length %s' % number)
+		return digits
+
+
+def fromConfig(config):
+	"""Normalizer from a settings.VHLR_NUMBERS style dict."""
+	return Normalizer(
+		config['default_country'],
+		trunk_prefix=config.get('trunk_prefix', '0'),
+		international_prefixes=config.get('international_prefixes', ('00',)),
+		rules=config.get('rules'),
+		national_length=config.get('national_length'),
+		min_length=config.get('min_length', 7),
+		max_length=config.get('max_length', 15),
+	)
@@ -0,0 +1,15 @@
+# Dial priority classes, shared by the dialer (vhlr_callgen.DialScheduler,
+# vhlr_worker) and the API side (base/views, base/asgi, base/queue), so both
+# accept the same classes and agree on the queue stream of each
+
+INTERACTIVE = 'interactive'
+
+# Default config.priority_weights: dial starts under contention
+WEIGHTS = {INTERACTIVE: 8, 'bulk': 2, 'refresh': 1}
+
+NAMES = tuple(WEIGHTS)
+
+
+def streamName(stream, priority):
+	"""Queue stream of a priority class, interactive lookups keep the original stream."""
+	return stream if priority == INTERACTIVE else '%s:%s' % (stream, priority)
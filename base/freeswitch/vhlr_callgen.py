@@ -2,18 +2,22 @@
 
 import freeswitch_api
 import async_utils
+import number_utils
+import priorities
 import os
 import logging
 import json
 import uuid
 import asyncio
-import uvloop
+import argparse
+import csv
+import random
+import socket
 import sys
+import time
 
 from datetime import datetime
-
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+from collections import deque
 
 # sys.path.append(os.path.join(os.path.abspath(os.getcwd()), 'base/cache'))
 # from vhlr_cache import initCache, cache
@@ -24,6 +28,13 @@ INSTANCE_NAME = RUN_DIR.split('/')[-1]
 freeswitch_api.logger = logger = logging.getLogger()
 
 
+def httpClient():
+	# Imported on first use: the curl client is slow to load and only needed for DLR
+	from tornado.httpclient import AsyncHTTPClient
+	AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+	return AsyncHTTPClient()
+
+
 class Config(freeswitch_api.Config):
 	def __init__(self):
 		super().__init__()
@@ -36,8 +47,25 @@ class Config(freeswitch_api.Config):
 		self.dlr_url = None
 		self.dlr_http_method = 'GET'
 		self.dlr_https_validate_cert = False
-		self.reconnect_schedule = None
+		self.reconnect_schedule = None # sec, list of delays between attempts, e.g. [5, 20, 60]
+		self.reconnect_jitter = 0.5 # each delay is randomized by +-50%
+		self.max_pending_retries = 1000
 		self.check_timeout = 0.5
+		self.call_state_poll = 'call' # Engine only: call - uuid_dump per call, channels or core_db - one query per tick for all calls
+		self.node = '%s-%s' % (socket.gethostname(), os.getpid()) # reported with in-flight calls
+		self.stats_path = None # Engine only: outcome ring buffer shared by the dialers of the host, see call_stats
+		self.stats_capacity = 1000000 # outcomes
+		self.stats_prefix_digits = 6
+		# Engine only: dial scheduling per priority class, see DialScheduler
+		self.priority_weights = dict(priorities.WEIGHTS)
+		self.priority_reserved = {'interactive': 2} # slots of max_calls_count kept for the class
+		self.default_priority = 'interactive'
+		self.retry_priority = 'refresh'
+		# Engine only: lookups with a deadline answer deadline_margin sec before
+		# it, their call ends twice that before it, and a dial that can't get
+		# min_connect_timeout sec is dropped
+		self.deadline_margin = 0.5 # sec
+		self.min_connect_timeout = 1 # sec
 		
 		# Cache options
 		# self.cache_type = 'redis'
@@ -51,6 +79,68 @@ class Config(freeswitch_api.Config):
 		# self.redis_pool_maxsize       = 10
 
 
+def initLogger(config):
+	for h in (x for x in logger.handlers if hasattr(x, 'close')):
+		h.close()
+	for h in logger.handlers[:]:
+		logger.removeHandler(h)
+
+	logFormat = '%(asctime)s'
+	if config.internal_message_id:
+		logFormat += ' ' + '[sms_id=%s]' % config.internal_message_id
+	logFormat += ' %(levelname)s: %(message)s'
+
+	formatter = logging.Formatter(fmt=logFormat)
+
+	if not config.silent_mode:
+		sh = logging.StreamHandler()
+		sh.setFormatter(formatter)
+		logger.addHandler(sh)
+
+	logger.setLevel(getattr(logging, config.loglevel.upper()))
+
+	if config.logfile:
+		try:
+			fh = logging.FileHandler(config.logfile)
+		except Exception as e:
+			logger.error('Failed to open log file %s: %s',
+						 config.logfile, e)
+		else:
+			fh.setFormatter(formatter)
+			logger.addHandler(fh)
+
+
+async def resolveProfile(fsCli, config):
+	"""Find the FreeSWITCH originator profile bound to config.src_address."""
+	if not config.profile and config.src_address:
+		try:
+			output = await fsCli.execute('sofia status')
+			logger.debug('Returned sofia status: %s' % output)
+		except Exception as e:
+			raise Exception('Failed to get freeswitch profile for address %s: %s' % (config.src_address, e))
+
+		for line in output.splitlines():
+			if config.src_address.split(':')[0] in line:
+				parts = line.split()
+				if parts:
+					config.profile = parts[0]
+
+	if not config.profile:
+		raise Exception('Failed to get freeswitch profile for address %s' % config.src_address)
+
+	return config.profile
+
+
+def startLagMonitor(config):
+	"""Watch the running loop per config.loop_lag_*, None if disabled."""
+	if not config.loop_lag_interval:
+		return None
+	async_utils.lagMonitor = monitor = async_utils.LagMonitor(
+		config.loop_lag_interval, config.loop_lag_threshold, config.loop_lag_dump_period, logger=logger)
+	monitor.start()
+	return monitor
+
+
 class CallGenerator:
 	def __init__(self, app):
 		self.app = app
@@ -128,11 +218,490 @@ class CallGenerator:
 		self.app.stop()
 
 
+class RetryQueue:
+	"""
+	Re-dials numbers whose outcome is in CallState.retry_disconnect_codes,
+	following config.reconnect_schedule with jitter. A waiting retry is only a
+	loop timer: it holds no call slot and no channel, and goes through the
+	engine's dial path so it shares the same CPS budget and call limit.
+	"""
+	def __init__(self, engine):
+		self.engine = engine
+		self.config = engine.config
+		self.pending = {} # dst number -> TimerHandle or Task
+
+	def isRetryable(self, code):
+		return code in freeswitch_api.CallState.retry_disconnect_codes
+
+	def schedule(self, dstNum, connectTimeout, attempt=0):
+		schedule = self.config.reconnect_schedule or []
+		if attempt >= len(schedule):
+			return False
+
+		if dstNum not in self.pending and len(self.pending) >= self.config.max_pending_retries:
+			logger.warning('Retry queue is full, not retrying %s', dstNum)
+			return False
+
+		jitter = self.config.reconnect_jitter
+		delay = schedule[attempt] * random.uniform(1 - jitter, 1 + jitter)
+		logger.debug('Retry #%s of %s in %.1f second(s)', attempt + 1, dstNum, delay)
+
+		self.cancel(dstNum)
+		self.pending[dstNum] = self.engine.loop.call_later(delay, self.onRetryTimer, dstNum, connectTimeout, attempt + 1)
+		return True
+
+	def cancel(self, dstNum):
+		# A retry already dialing is left to finish, its result is just dropped
+		handle = self.pending.pop(dstNum, None)
+		if handle and not isinstance(handle, asyncio.Future):
+			handle.cancel()
+
+	def clear(self):
+		for dstNum in list(self.pending):
+			self.cancel(dstNum)
+
+	def onRetryTimer(self, dstNum, connectTimeout, attempt):
+		self.pending[dstNum] = async_utils.create_task(
+			self.onRetryTask(dstNum, connectTimeout, attempt),
+			logger=logger,
+			msg='Retry task exception, dst: %s',
+			msg_args=(dstNum,)
+		)
+
+	async def onRetryTask(self, dstNum, connectTimeout, attempt):
+		code = await self.engine.dial(dstNum, connectTimeout, self.config.retry_priority)
+		logger.info('Retry #%s of %s -> %s', attempt, dstNum, code)
+
+		if self.pending.get(dstNum) is not asyncio.current_task():
+			# A fresh lookup took over this number meanwhile
+			return
+
+		del self.pending[dstNum]
+		if self.isRetryable(code) and self.schedule(dstNum, connectTimeout, attempt):
+			return
+
+		self.engine.onResult(dstNum, code)
+
+
+class DeadlineExceeded(Exception):
+	"""
+	The deadline of a lookup came before its outcome. state is the disconnect
+	code of the call state so far, e.g. DIALING or RINGING, None if the
+	number was not dialed.
+	"""
+	def __init__(self, state=None):
+		super().__init__('Deadline exceeded' if state else 'Deadline exceeded before dialing')
+		self.state = state
+
+
+class DialScheduler:
+	"""
+	Decides which waiting dial goes next. Every lookup has a priority class
+	(config.priority_weights); among the classes with waiting dials the one
+	with the smallest virtual time goes, and its virtual time grows by
+	1 / weight, so under contention classes get dial starts in proportion to
+	their weights. A class waiting alone takes all the capacity.
+
+	config.priority_reserved keeps slots of config.max_calls_count free for a
+	class while it uses fewer than reserved: other classes can't take them.
+	Starts are paced by config.cps here too, so a class is only picked when
+	its call can start right away and nobody books dial times ahead.
+	"""
+	def __init__(self, engine):
+		self.engine = engine
+		self.config = engine.config
+		self.weights = self.config.priority_weights
+		self.reserved = self.config.priority_reserved
+		self.queues = {priority: deque() for priority in self.weights} # priority -> deque of Futures
+		self.active = {priority: 0 for priority in self.weights}
+		self.vtimes = {priority: 0.0 for priority in self.weights}
+		self.vtime = 0.0 # virtual time of the last start
+		self.nextDialTime = 0
+		self.timer = None
+		self.counters = {priority: 0 for priority in self.weights} # dials started
+
+	def activeCount(self):
+		return sum(self.active.values())
+
+	def canStart(self, priority):
+		limit = self.config.max_calls_count
+		if not limit:
+			return True
+		# Slots other classes reserved and don't use yet
+		reserved = sum(max(0, self.reserved.get(other, 0) - self.active[other]) for other in self.active if other != priority)
+		return self.activeCount() + 1 + reserved <= limit
+
+	async def acquire(self, priority):
+		queue = self.queues[priority]
+		if not queue:
+			# Back from idle: no credit for the time it didn't compete
+			self.vtimes[priority] = max(self.vtimes[priority], self.vtime)
+
+		if not any(self.queues.values()) and self.canStart(priority) and self.dialTimeReached():
+			self.start(priority)
+			return
+
+		future = self.engine.loop.create_future()
+		queue.append(future)
+		self.dispatch()
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# Started but nobody will dial
+				self.release(priority)
+			else:
+				self.dispatch()
+			raise
+
+	def release(self, priority):
+		self.active[priority] -= 1
+		self.dispatch()
+
+	def start(self, priority):
+		self.active[priority] += 1
+		self.counters[priority] += 1
+		self.vtime = self.vtimes[priority]
+		self.vtimes[priority] += 1.0 / self.weights[priority]
+		if self.config.cps:
+			self.nextDialTime = max(self.engine.loop.time(), self.nextDialTime) + 1.0 / self.config.cps
+
+	def dialTimeReached(self):
+		return not self.config.cps or self.engine.loop.time() >= self.nextDialTime
+
+	def dispatch(self):
+		while True:
+			for queue in self.queues.values():
+				while queue and queue[0].done():
+					queue.popleft()
+
+			candidates = [priority for priority, queue in self.queues.items() if queue and self.canStart(priority)]
+			if not candidates:
+				return
+
+			if not self.dialTimeReached():
+				if not self.timer:
+					self.timer = self.engine.loop.call_at(self.nextDialTime, self.onDialTimer)
+				return
+
+			priority = min(candidates, key=lambda p: self.vtimes[p])
+			self.start(priority)
+			self.queues[priority].popleft().set_result(None)
+
+	def onDialTimer(self):
+		self.timer = None
+		self.dispatch()
+
+	def stats(self):
+		return {
+			priority: {
+				'waiting': len(self.queues[priority]),
+				'active': self.active[priority],
+				'started': self.counters[priority],
+			} for priority in self.weights
+		}
+
+
+class Engine:
+	"""
+	Long-running dialer. Unlike App, which lives for a single call, the engine
+	keeps one FSCLI and resolved profile and serves any number of concurrent
+	lookups, bounded by config.max_calls_count and paced by config.cps.
+	Concurrent lookups of the same number share one call. Dials are started
+	by priority class, see DialScheduler.
+	"""
+	def __init__(self, config):
+		self.config = config
+		self.loop = None
+		self.fsCli = None
+		self.calls = {} # guid -> Call
+		self.waiters = {} # guid -> Future
+		self.inflight = {} # dst number -> (Task, deadline it dials for)
+		self.scheduler = DialScheduler(self)
+		self.retryQueue = RetryQueue(self)
+		self.channelPoller = None
+		self.timerWheel = None
+		self.lagMonitor = None
+		self.stats = None
+		self.resultListeners = [] # callables (dstNum, code) for results of background retries
+		self.started = False
+
+	async def start(self):
+		self.loop = asyncio.get_running_loop()
+
+		freeswitch_api.config = self.config
+		if self.config.originate_mode == 'bgapi':
+			self.fsCli = freeswitch_api.ESLClient(
+				self.config.fs_esl_host, self.config.fs_esl_port, self.config.fs_esl_password,
+				timeout=self.config.fs_cli_timeout)
+			await self.fsCli.connect()
+		else:
+			self.fsCli = freeswitch_api.FSCLI(
+				host=self.config.fs_cli_host, port=self.config.fs_cli_port, timeout=self.config.fs_cli_timeout)
+			self.fsCli.startReaper(self.config.fs_cli_reap_period)
+		freeswitch_api.fsCli = self.fsCli
+		freeswitch_api.timerWheel = self.timerWheel = freeswitch_api.TimerWheel(self.config.timer_tick)
+		self.lagMonitor = startLagMonitor(self.config)
+
+		await resolveProfile(self.fsCli, self.config)
+
+		if self.config.stats_path:
+			# numpy is only needed with stats enabled
+			import call_stats
+			try:
+				self.stats = call_stats.OutcomeStats(
+					self.config.stats_path, self.config.stats_capacity, self.config.stats_prefix_digits)
+			except OSError as e:
+				logger.error('Outcome stats disabled, cannot open %s: %s', self.config.stats_path, e)
+
+		if self.config.call_state_poll != 'call':
+			freeswitch_api.channelPoller = self.channelPoller = freeswitch_api.ChannelPoller(
+				self.calls, self.config.call_state_poll, self.config.check_timeout)
+			self.channelPoller.start()
+
+		self.started = True
+		logger.info('Engine started, profile: %s', self.config.profile)
+
+	async def stop(self):
+		self.started = False
+		self.retryQueue.clear()
+
+		if self.calls:
+			logger.info('Waiting for call termination...')
+
+		while self.calls:
+			await asyncio.sleep(0.1)
+
+		if self.channelPoller:
+			self.channelPoller.stop()
+
+		if self.timerWheel:
+			self.timerWheel.clear()
+
+		if self.lagMonitor:
+			self.lagMonitor.stop()
+
+		if isinstance(self.fsCli, freeswitch_api.ESLClient):
+			self.fsCli.close()
+		elif self.fsCli:
+			self.fsCli.stopReaper()
+
+	async def lookup(self, dstNum, connectTimeout=None, priority=None, deadline=None):
+		"""
+		Dial the number and return its disconnect code. A retryable code is
+		returned right away while the number is re-dialed in the background,
+		see isRetrying() and resultListeners. priority is one of
+		config.priority_weights, config.default_priority if not given.
+		deadline (unix time): the call is fit in before it, or not made, and
+		DeadlineExceeded with the state so far is raised when it comes first.
+		A lookup joins a dial of the same number in progress. When that dial
+		was fit to an earlier deadline and ends without an outcome, the
+		number is dialed again for this lookup's own budget.
+		"""
+		while True:
+			task, taskDeadline = self.inflight.get(dstNum, (None, None))
+			if task is None or task.done():
+				task, taskDeadline = self.startLookup(dstNum, connectTimeout, priority, deadline), deadline
+
+			if deadline is None:
+				code, partial = await asyncio.shield(task)
+			else:
+				try:
+					code, partial = await asyncio.wait_for(asyncio.shield(task), deadline - self.config.deadline_margin - time.time())
+				except asyncio.TimeoutError:
+					raise DeadlineExceeded(self.partialState(dstNum))
+
+			if not partial:
+				return code
+			if taskDeadline is None or (deadline is not None and taskDeadline >= deadline):
+				raise DeadlineExceeded(code)
+
+	def startLookup(self, dstNum, connectTimeout, priority, deadline):
+		self.retryQueue.cancel(dstNum)
+		task = async_utils.create_task(
+			self.onLookup(dstNum, connectTimeout, priority, deadline),
+			logger=logger,
+			msg='Lookup task exception, dst: %s',
+			msg_args=(dstNum,)
+		)
+		self.inflight[dstNum] = (task, deadline)
+		task.add_done_callback(lambda t: self.onLookupDone(dstNum, t))
+		return task
+
+	def onLookupDone(self, dstNum, task):
+		# A re-dial may have taken the number's place already
+		if self.inflight.get(dstNum, (None,))[0] is task:
+			del self.inflight[dstNum]
+
+	async def onLookup(self, dstNum, connectTimeout, priority, deadline):
+		# Returns (code, partial), expected deadline misses are not task errors
+		try:
+			code = await self.dial(dstNum, connectTimeout, priority, deadline)
+		except DeadlineExceeded as e:
+			if not e.state:
+				logger.info('Engine.onLookup() -> Deadline of %s too close to dial, dropped', dstNum)
+			return e.state, True
+		if self.started and self.retryQueue.isRetryable(code):
+			self.retryQueue.schedule(dstNum, connectTimeout)
+		return code, False
+
+	def isRetrying(self, dstNum):
+		return dstNum in self.retryQueue.pending
+
+	def partialState(self, dstNum):
+		"""Disconnect code of the state so far of the call to dstNum, None if not dialed."""
+		for call in self.calls.values():
+			if call.dstNum == dstNum:
+				return freeswitch_api.CallState.states_disconnect_code_map.get(call.state, call.state)
+		return None
+
+	async def snapshot(self, chunk=500):
+		"""
+		In-flight calls with their state, age and pending FreeSWITCH commands.
+		The call table is copied in chunks, yielding to the loop between them,
+		so a large table doesn't delay call handling.
+		"""
+		now = datetime.utcnow()
+		pending = self.fsCli.pending() if self.fsCli else {}
+		calls = list(self.calls.values())
+
+		rows = []
+		for i in range(0, len(calls), chunk):
+			for call in calls[i:i + chunk]:
+				rows.append({
+					'guid': call.guid,
+					'number': call.dstNum,
+					'state': call.state,
+					'age': (now - call.setupTime).total_seconds() if call.setupTime else 0,
+					'node': self.config.node,
+					'pending': pending.get(call.guid, []),
+				})
+			await asyncio.sleep(0)
+
+		return {
+			'node': self.config.node,
+			'time': time.time(),
+			'calls': rows,
+			'lookups': len(self.inflight),
+			'retry_pending': len(self.retryQueue.pending),
+			'priorities': self.scheduler.stats(),
+			'loop': async_utils.stats(),
+		}
+
+	async def loopStats(self):
+		"""Background tasks and event loop lag of this engine's loop, see async_utils.stats()."""
+		return async_utils.stats()
+
+	def onResult(self, dstNum, code):
+		for listener in self.resultListeners:
+			try:
+				listener(dstNum, code)
+			except Exception as e:
+				logger.error('Engine.onResult() -> Listener failed for %s: %s', dstNum, e, exc_info=True)
+
+	async def dial(self, dstNum, connectTimeout=None, priority=None, deadline=None):
+		priority = priority or self.config.default_priority
+		if priority not in self.config.priority_weights:
+			raise ValueError('Unknown priority: %s' % priority)
+
+		if deadline is None:
+			await self.scheduler.acquire(priority)
+		else:
+			# Waiting for a slot only while a useful call still fits in
+			wait = deadline - 2 * self.config.deadline_margin - self.config.min_connect_timeout - time.time()
+			if wait <= 0:
+				raise DeadlineExceeded()
+			try:
+				await asyncio.wait_for(self.scheduler.acquire(priority), wait)
+			except asyncio.TimeoutError:
+				raise DeadlineExceeded()
+
+		try:
+			fitted = False
+			if deadline is not None:
+				fitted = self.fitDeadline(connectTimeout, deadline)
+				if fitted:
+					connectTimeout = fitted
+			return await self.onDial(dstNum, connectTimeout, bool(fitted))
+		finally:
+			self.scheduler.release(priority)
+
+	def fitDeadline(self, connectTimeout, deadline):
+		"""
+		connectTimeout shortened for the call to end before deadline, None if
+		it already does, DeadlineExceeded if too short to dial.
+		"""
+		left = deadline - 2 * self.config.deadline_margin - time.time()
+		if left < self.config.min_connect_timeout:
+			raise DeadlineExceeded()
+		if left < (connectTimeout or self.config.connect_timeout):
+			return left
+		return None
+
+	async def onDial(self, dstNum, connectTimeout, fitted=False):
+		# fitted: connectTimeout was cut to a deadline, ending by it is no outcome
+		guid = str(uuid.uuid1())
+		call = freeswitch_api.Call(srcNum=self.config.src_number, dstNum=dstNum,
+			guid=guid, owner=self, connectTimeout=connectTimeout)
+		future = self.waiters[guid] = self.loop.create_future()
+		self.calls[guid] = call
+
+		# The outcome is known at onCallTerminated, which may come before the
+		# originate command itself returns
+		async_utils.create_task(
+			call.start(),
+			logger=logger,
+			msg='Call start exception, uuid: %s',
+			msg_args=(guid,)
+		)
+
+		# Every command has a deadline, so this only fires if the call logic
+		# itself is stuck; it bounds the lookup regardless
+		timeout = call.connectTimeout + 3 * self.config.fs_cli_timeout
+		backstop = self.timerWheel.schedule(timeout, self.onCallStuck, call, timeout)
+		try:
+			code = await future
+		finally:
+			backstop.cancel()
+
+		if fitted and call.timedOut:
+			raise DeadlineExceeded(code)
+		return code
+
+	def onCallStuck(self, call, timeout):
+		logger.error('Engine.onDial() -> No outcome within %s sec, dropping call %s', timeout, call.guid)
+		if not call.disconnect_code:
+			call.disconnect_code = 'ORIGINATOR_CANCEL'
+		call.onTerminated()
+		self.onCallTerminated(call)
+
+	def onCallTerminated(self, call):
+		logger.debug('Engine.onCallTerminated(): %s, code: %s', call.guid, call.disconnect_code)
+		self.calls.pop(call.guid, None)
+
+		if self.stats and call.guid in self.waiters:
+			self.recordOutcome(call)
+
+		future = self.waiters.pop(call.guid, None)
+		if future and not future.done():
+			future.set_result(call.disconnect_code)
+
+
+	def recordOutcome(self, call):
+		ring = (call.ringTime - call.setupTime).total_seconds() if call.ringTime and call.setupTime else None
+		sip = freeswitch_api.CallState.disconnect_codes_map.get(call.disconnect_code)
+		try:
+			self.stats.record(call.dstNum, int(sip) if sip else 0, ring, self.config.dst_address, call.timedOut)
+		except Exception as e:
+			logger.error('Engine.recordOutcome() -> Failed for %s: %s', call.guid, e)
+
+
 class App:
 	def __init__(self):
 		self.stopFuture = None
 		self.callGenerator = None
 		self.loop = None
+		self.lagMonitor = None
 
 		self.startLoopTime = 0
 		self.startTime = None
@@ -163,27 +732,15 @@ class App:
 		# 	raise
 
 		freeswitch_api.fsCli = self.fsCli = freeswitch_api.FSCLI(
-			host=self.config.fs_cli_host, port=self.config.fs_cli_port)
-
-		if not self.config.profile and self.config.src_address:
-			try:
-				output = await self.fsCli.execute('sofia status')
-				logger.debug('Returned sofia status: %s' % output)
-			except Exception as e:
-				error = 'Failed to get freeswitch profile for address %s' % self.config.src_address
-				logger.exception(error)
-				self.stop(error)
-				return
+			host=self.config.fs_cli_host, port=self.config.fs_cli_port, timeout=self.config.fs_cli_timeout)
+		freeswitch_api.timerWheel = freeswitch_api.TimerWheel(self.config.timer_tick)
+		self.lagMonitor = startLagMonitor(self.config)
 
-			for line in output.splitlines():
-				if self.config.src_address.split(':')[0] in line:
-					parts = line.split()
-					if parts:
-						self.config.profile = parts[0]
-
-		if not self.config.profile:
-			self.stop('Failed to get freeswitch profile for address %s' %
-					  self.config.src_address)
+		try:
+			await resolveProfile(self.fsCli, self.config)
+		except Exception as e:
+			logger.exception(e)
+			self.stop(str(e))
 			return
 
 		logger.debug('Config:\n%s', json.dumps(
@@ -205,34 +762,7 @@ class App:
 		return self.loop.time() - self.startLoopTime
 
 	def initLogger(self):
-		for h in (x for x in logger.handlers if hasattr(x, 'close')):
-			h.close()
-		for h in logger.handlers[:]:
-			logger.removeHandler(h)
-
-		logFormat = '%(asctime)s'
-		if self.config.internal_message_id:
-			logFormat += ' ' + '[sms_id=%s]' % self.config.internal_message_id
-		logFormat += ' %(levelname)s: %(message)s'
-
-		formatter = logging.Formatter(fmt=logFormat)
-
-		if not self.config.silent_mode:
-			sh = logging.StreamHandler()
-			sh.setFormatter(formatter)
-			logger.addHandler(sh)
-
-		logger.setLevel(getattr(logging, self.config.loglevel.upper()))
-
-		if self.config.logfile:
-			try:
-				fh = logging.FileHandler(self.config.logfile)
-			except Exception as e:
-				logger.error('Failed to open log file %s: %s',
-							 self.config.logfile, e)
-			else:
-				fh.setFormatter(formatter)
-				logger.addHandler(fh)
+		initLogger(self.config)
 
 	def stop(self, error=None, grace=True):
 		if error:
@@ -248,13 +778,256 @@ class App:
 		if self.callGenerator:
 			await self.callGenerator.stop(grace)
 
+		if self.lagMonitor:
+			self.lagMonitor.stop()
+
 		if self.stopFuture:
 			self.stopFuture.set_result(True)
 
 
+class CheckpointError(Exception):
+	pass
+
+
+class BulkCheck:
+	"""
+	Offline list check: streams numbers from a file or stdin through an
+	Engine and writes a CSV row per number as outcomes arrive, so rows are
+	not in input order. Input lines are numbers, or CSV rows with the number
+	first; blank lines and lines starting with '#' are skipped.
+
+	Progress is checkpointed as a watermark, the line up to which every line
+	is done, plus the done lines above it. A resumed run skips exactly those
+	lines and appends to the output; a checkpoint of another input is
+	refused. Output is flushed before each checkpoint, so a line is never in the checkpoint without its row; after
+	a crash at most the rows since the last checkpoint are checked again.
+	"""
+	COLUMNS = ['line', 'number', 'e164', 'code', 'sip', 'error']
+
+	def __init__(self, config, args):
+		self.config = config
+		self.args = args
+		self.engine = Engine(config)
+		self.normalizer = number_utils.Normalizer(args.country, trunk_prefix=args.trunk_prefix or None)
+		self.watermark = 0
+		self.done = set() # done lines above the watermark
+		self.final = {} # number -> Future of the outcome of background retries
+		self.counters = {}
+		self.out = None
+		self.writer = None
+
+	async def run(self):
+		resumed = self.loadCheckpoint()
+
+		if self.args.output:
+			self.out = open(self.args.output, 'a' if resumed else 'w', newline='')
+		else:
+			self.out = sys.stdout
+		self.writer = csv.writer(self.out)
+		if not resumed:
+			self.writer.writerow(self.COLUMNS)
+
+		await self.engine.start()
+		self.engine.resultListeners.append(self.onRetryResult)
+
+		checkpointTask = async_utils.create_task(
+			self.onCheckpointTimer(self.args.checkpoint_period),
+			logger=logger,
+			msg='Checkpoint timer exception'
+		)
+		try:
+			await self.checkAll()
+		finally:
+			checkpointTask.cancel()
+			self.saveCheckpoint()
+			if self.out is not sys.stdout:
+				self.out.close()
+			logger.info('Checked up to line %s: %s', self.watermark, json.dumps(self.counters, sort_keys=True))
+
+		await self.engine.stop()
+
+	async def checkAll(self):
+		# Bounded window of lookups: the engine schedules the dials, this
+		# only keeps the rest of the input out of memory
+		window = asyncio.Semaphore(self.args.window or 2 * (self.config.max_calls_count or 10))
+		tasks = set()
+
+		source = open(self.args.input) if self.args.input != '-' else sys.stdin
+		try:
+			async for lineNo, line in self.readLines(source):
+				if lineNo <= self.watermark or lineNo in self.done:
+					continue
+
+				raw = line.split(',', 1)[0].strip()
+				if not raw or raw.startswith('#'):
+					self.markDone(lineNo)
+					continue
+
+				try:
+					number = self.normalizer.normalize(raw)
+				except number_utils.NumberError as e:
+					self.writeRow(lineNo, raw, None, None, str(e))
+					continue
+
+				await window.acquire()
+				task = async_utils.create_task(
+					self.check(lineNo, raw, number),
+					logger=logger,
+					msg='Check exception, line: %s',
+					msg_args=(lineNo,)
+				)
+				tasks.add(task)
+				task.add_done_callback(tasks.discard)
+				task.add_done_callback(lambda t: window.release())
+		finally:
+			if source is not sys.stdin:
+				source.close()
+
+		if tasks:
+			await asyncio.wait(list(tasks))
+
+	@staticmethod
+	async def readLines(source):
+		loop = asyncio.get_running_loop()
+		lineNo = 0
+		while True:
+			# Batches of lines, a blocking read per line would stall the dials
+			lines = await loop.run_in_executor(None, source.readlines, 1 << 16)
+			if not lines:
+				return
+			for line in lines:
+				lineNo += 1
+				yield lineNo, line
+
+	async def check(self, lineNo, raw, number):
+		try:
+			code = await self.engine.lookup(number, self.args.connect_timeout, self.args.priority)
+			if self.engine.isRetrying(number):
+				future = self.final.get(number)
+				if future is None:
+					future = self.final[number] = self.engine.loop.create_future()
+				code = await future
+			else:
+				# A repeat of the number replaces its pending retry, lines
+				# waiting for that retry take this outcome
+				self.onRetryResult(number, code)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			future = self.final.pop(number, None)
+			if future and not future.done():
+				future.set_exception(e)
+			self.writeRow(lineNo, raw, number, None, str(e))
+			return
+		self.writeRow(lineNo, raw, number, code)
+
+	def onRetryResult(self, dstNum, code):
+		future = self.final.pop(dstNum, None)
+		if future and not future.done():
+			future.set_result(code)
+
+	def writeRow(self, lineNo, raw, number, code, error=None):
+		self.writer.writerow([lineNo, raw, number or '', code or '',
+			freeswitch_api.CallState.disconnect_codes_map.get(code, '') if code else '', error or ''])
+		self.counters[code or 'ERROR'] = self.counters.get(code or 'ERROR', 0) + 1
+		self.markDone(lineNo)
+
+	def markDone(self, lineNo):
+		self.done.add(lineNo)
+		while self.watermark + 1 in self.done:
+			self.watermark += 1
+			self.done.discard(self.watermark)
+
+	def loadCheckpoint(self):
+		path = self.args.checkpoint
+		if not path or not os.path.exists(path):
+			return False
+
+		with open(path) as f:
+			checkpoint = json.load(f)
+		if checkpoint.get('input') != self.inputName():
+			raise CheckpointError('Checkpoint %s is for input %s, not %s' % (path, checkpoint.get('input'), self.inputName()))
+		self.watermark = checkpoint['watermark']
+		self.done = set(checkpoint['done'])
+		logger.info('Resuming from %s: line %s, %s lines done above it', path, self.watermark, len(self.done))
+		return True
+
+	def saveCheckpoint(self):
+		path = self.args.checkpoint
+		if not path:
+			return
+
+		self.out.flush()
+		tmp = path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'input': self.inputName(), 'watermark': self.watermark, 'done': sorted(self.done)}, f)
+		os.replace(tmp, path)
+
+	def inputName(self):
+		return os.path.abspath(self.args.input) if self.args.input != '-' else '-'
+
+	async def onCheckpointTimer(self, period):
+		while True:
+			await asyncio.sleep(period)
+			self.saveCheckpoint()
+			logger.info('Progress: line %s, %s', self.watermark, json.dumps(self.counters, sort_keys=True))
+
+
 def main(params):
+	import uvloop
+
 	freeswitch_api.app = app = App()
 	uvloop.install()
 	asyncio.run(app.start(params))
 	
 	return app.callGenerator.disconnect_code
+
+
+def cli():
+	parser = argparse.ArgumentParser(description='VHLR bulk number check',
+		epilog='Example: vhlr_callgen.py numbers.txt -o results.csv --checkpoint numbers.ckpt --cps 20')
+	parser.add_argument('input', nargs='?', default='-', help='File with one number per line, - for stdin')
+	parser.add_argument('-o', '--output', help='Result CSV, stdout if not given')
+	parser.add_argument('--checkpoint', help='Progress file, the run resumes from it if it exists')
+	parser.add_argument('--checkpoint-period', type=float, default=5, help='sec')
+	parser.add_argument('--cps', type=float, help='Calls per second')
+	parser.add_argument('--max-calls', type=int, dest='max_calls_count', help='Concurrent calls')
+	parser.add_argument('--window', type=int, help='Numbers in progress, default 2 * max calls')
+	parser.add_argument('--connect-timeout', type=int, help='sec')
+	parser.add_argument('--priority', default='bulk', help='Dial priority class, see DialScheduler')
+	parser.add_argument('--retries', help='Delays of re-dials after congestion, e.g. 5,20,60')
+	parser.add_argument('--country', default='49', help='Default country code for national numbers')
+	parser.add_argument('--trunk-prefix', default='0', help='National trunk prefix, empty for none')
+	parser.add_argument('--src-address', dest='src_address')
+	parser.add_argument('--dst-address', dest='dst_address')
+	parser.add_argument('--fs-cli-host', dest='fs_cli_host')
+	parser.add_argument('--fs-cli-port', dest='fs_cli_port')
+	parser.add_argument('--originate-mode', dest='originate_mode', choices=['api', 'bgapi'])
+	parser.add_argument('--stats-path', dest='stats_path')
+	parser.add_argument('--logfile')
+	parser.add_argument('--loglevel', default='info')
+	args = parser.parse_args()
+
+	config = Config()
+	config.logfile = None
+	options = ('cps', 'max_calls_count', 'src_address', 'dst_address', 'fs_cli_host', 'fs_cli_port',
+		'originate_mode', 'stats_path', 'logfile', 'loglevel')
+	config.__dict__.update({k: getattr(args, k) for k in options if getattr(args, k) is not None})
+	if args.retries:
+		config.reconnect_schedule = [float(delay) for delay in args.retries.split(',')]
+	if args.priority not in config.priority_weights:
+		parser.error('unknown priority %s' % args.priority)
+	initLogger(config)
+
+	import uvloop
+	uvloop.install()
+	try:
+		asyncio.run(BulkCheck(config, args).run())
+	except CheckpointError as e:
+		parser.error(str(e))
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	cli()
@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+
+# Standalone dialer worker.
+#
+# Consumes lookup requests from Redis streams, one per priority class, as a
+# member of a consumer group, dials them through the local FreeSWITCH with
+# vhlr_callgen.Engine and pushes the result to a per-request list the API side
+# is waiting on.
+#
+# Usage: python3 base/freeswitch/vhlr_worker.py [--consumer NAME] [--max-calls N]
+
+import vhlr_callgen
+import async_utils
+import counting_filter
+import hash_ring
+import priorities
+import json
+import argparse
+import asyncio
+import os
+import socket
+import redis.asyncio as redis
+import uvloop
+
+logger = vhlr_callgen.logger
+
+
+class Config(vhlr_callgen.Config):
+	def __init__(self):
+		super().__init__()
+		self.max_calls_count = 10 # concurrent lookups per worker
+		self.logfile = '/var/log/vhlr_worker.log'
+		self.loglevel = 'info'
+		self.reconnect_schedule = [5, 20, 60] # sec, retries of congestion outcomes
+		self.stats_path = '/var/lib/vhlr/outcomes.bin' # must match settings.VHLR_STATS on the API side
+
+		# Redis options
+		self.redis_address = 'redis://localhost'
+		self.redis_db = 3
+		self.redis_password = None
+		self.redis_pool_maxsize = 10
+
+		# Number cache background retry outcomes go to, must match
+		# settings.VHLR_REDIS on the API side
+		self.cache_nodes = [{'host': 'localhost', 'port': 6379, 'db': 3}]
+		self.cache_cluster = False
+		self.cache_key_time = 60 # sec, VHLR_REDIS['expire']
+		self.invalidation_channel = 'vhlr:cache:updates' # None when the API side runs without
+		# settings.VHLR_NEGATIVE_FILTER of API workers on this host, None if there are none
+		self.negative_filter = None
+
+		# Stream options, must match settings.VHLR_QUEUE on the API side
+		self.stream = 'vhlr:lookups'
+		self.stream_group = 'vhlr-dialers'
+		# Stable across restarts, so a restarted worker gets back its pending
+		# entries: workers sharing a host need a name each (--consumer)
+		self.consumer = socket.gethostname()
+		self.result_key_prefix = 'vhlr:result:'
+		self.result_ttl = 60 # sec
+		self.read_block = 1000 # ms
+		self.claim_period = 5 # sec, also the heartbeat period of own entries
+		self.claim_idle = 30000 # ms, pending entries idle longer than this are lost
+		self.consumer_idle = 600000 # ms, consumers without pending entries idle longer than this are dropped
+		self.max_deliveries = 3
+		self.prefetch = 10 # entries taken beyond max_calls_count, so the engine can pick by priority
+		self.calls_key_prefix = 'vhlr:calls:' # in-flight calls of each worker, read by the API side
+		self.calls_period = 5 # sec
+
+
+class Worker:
+	def __init__(self, config):
+		self.config = config
+		self.engine = vhlr_callgen.Engine(config)
+		self.redis = None
+		self.cache = None
+		self.streams = {priorities.streamName(config.stream, priority): priority for priority in config.priority_weights}
+		self.active = {} # (stream, entry id) -> Task
+		self.slotFreed = None
+		self.claimTask = None
+		self.callsTask = None
+		self.stopping = False
+
+	async def start(self):
+		await self.engine.start()
+
+		self.redis = redis.from_url(
+			self.config.redis_address,
+			db=self.config.redis_db,
+			password=self.config.redis_password,
+			max_connections=self.config.redis_pool_maxsize,
+			decode_responses=True,
+		)
+
+		self.cache = ResultCache(self.config)
+
+		for stream in self.streams:
+			try:
+				await self.redis.xgroup_create(stream, self.config.stream_group, id='$', mkstream=True)
+			except redis.ResponseError as e:
+				if 'BUSYGROUP' not in str(e):
+					raise
+
+		self.engine.resultListeners.append(self.onRetryResult)
+
+		self.slotFreed = asyncio.Event()
+		self.claimTask = async_utils.create_task(
+			self.onClaimTimer(self.config.claim_period),
+			logger=logger,
+			msg='Claim timer exception'
+		)
+		self.callsTask = async_utils.create_task(
+			self.onCallsTimer(self.config.calls_period),
+			logger=logger,
+			msg='Calls timer exception'
+		)
+
+		logger.info('Worker %s consuming %s as %s', self.config.consumer, ', '.join(self.streams), self.config.stream_group)
+
+		# Entries delivered to this consumer name before a restart come first
+		await self.consume('0')
+		await self.consume('>')
+
+	async def stop(self):
+		self.stopping = True
+
+		if self.claimTask:
+			self.claimTask.cancel()
+			self.claimTask = None
+
+		if self.callsTask:
+			self.callsTask.cancel()
+			self.callsTask = None
+			try:
+				await self.redis.delete(self.config.calls_key_prefix + self.config.consumer)
+			except Exception as e:
+				logger.debug('Worker.stop() -> Failed to drop calls snapshot: %s', e)
+
+		if self.active:
+			await asyncio.wait(list(self.active.values()))
+
+		await self.engine.stop()
+
+		if self.cache:
+			await self.cache.close()
+
+	def freeSlots(self):
+		return self.config.max_calls_count + self.config.prefetch - len(self.active)
+
+	async def consume(self, lastId):
+		lastIds = {stream: lastId for stream in self.streams}
+		while not self.stopping and lastIds:
+			free = self.freeSlots()
+			if free <= 0:
+				self.slotFreed.clear()
+				await self.slotFreed.wait()
+				continue
+
+			# count applies per stream, a read may go over free by the other streams
+			try:
+				response = await self.redis.xreadgroup(
+					self.config.stream_group, self.config.consumer,
+					lastIds, count=free, block=self.config.read_block)
+			except Exception as e:
+				logger.error('Worker.consume() -> Failed to read %s: %s', ', '.join(lastIds), e)
+				await asyncio.sleep(1)
+				continue
+
+			received = dict(response or [])
+			for stream in list(lastIds):
+				entries = received.get(stream) or []
+				if lastId != '>' and not entries:
+					# Own history of this stream is done
+					del lastIds[stream]
+					continue
+
+				for entryId, fields in entries:
+					if fields:
+						self.process(stream, entryId, fields)
+					if lastId != '>':
+						lastIds[stream] = entryId
+
+	def process(self, stream, entryId, fields):
+		key = (stream, entryId)
+		if key in self.active:
+			return
+
+		task = self.active[key] = async_utils.create_task(
+			self.onLookup(stream, entryId, fields),
+			logger=logger,
+			msg='Lookup exception, entry: %s',
+			msg_args=(entryId,)
+		)
+		task.add_done_callback(lambda t: self.onLookupDone(key))
+
+	def onLookupDone(self, key):
+		self.active.pop(key, None)
+		self.slotFreed.set()
+
+	async def onLookup(self, stream, entryId, fields):
+		connectTimeout = int(fields.get('connect_timeout') or 0) or None
+		# Unix time the API side stops waiting; entries past it are answered without a call
+		deadline = float(fields['deadline']) if fields.get('deadline') else None
+		try:
+			code = await self.engine.lookup(fields['dst_number'], connectTimeout, self.streams[stream], deadline)
+		except vhlr_callgen.DeadlineExceeded as e:
+			logger.info('Lookup %s: %s -> deadline exceeded, state: %s', fields['id'], fields['dst_number'], e.state)
+			await self.publish(stream, entryId, fields, e.state, partial=True)
+			return
+		logger.info('Lookup %s: %s -> %s', fields['id'], fields['dst_number'], code)
+		await self.publish(stream, entryId, fields, code)
+
+	def onRetryResult(self, dstNum, code):
+		# Final outcome of a background retry, the API side got the transient one
+		async_utils.create_task(
+			self.cache.store(dstNum, code),
+			logger=logger,
+			msg='Failed to cache retry result of %s',
+			msg_args=(dstNum,)
+		)
+
+	async def publish(self, stream, entryId, fields, code, error=None, partial=False):
+		key = self.config.result_key_prefix + fields['id']
+		result = {'number': fields['dst_number'], 'code': code}
+		if error:
+			result['error'] = error
+		elif partial:
+			result['partial'] = True
+		elif self.engine.isRetrying(fields['dst_number']):
+			result['retrying'] = True
+		result = json.dumps(result)
+
+		async with self.redis.pipeline(transaction=True) as pipe:
+			pipe.rpush(key, result)
+			pipe.expire(key, self.config.result_ttl)
+			pipe.xack(stream, self.config.stream_group, entryId)
+			pipe.xdel(stream, entryId)
+			await pipe.execute()
+
+	async def onClaimTimer(self, period):
+		while True:
+			await asyncio.sleep(period)
+			try:
+				# Heartbeat: reset idle time of own entries so nobody else claims them
+				for stream in self.streams:
+					entryIds = [entryId for activeStream, entryId in self.active if activeStream == stream]
+					if entryIds:
+						await self.redis.xclaim(stream, self.config.stream_group, self.config.consumer,
+							0, entryIds, justid=True)
+
+				for stream in self.streams:
+					await self.claimLost(stream)
+					await self.dropIdleConsumers(stream)
+			except Exception as e:
+				logger.error('Worker.onClaimTimer() -> Exception: %s', e)
+
+	async def onCallsTimer(self, period):
+		key = self.config.calls_key_prefix + self.config.consumer
+		while True:
+			try:
+				snapshot = await self.engine.snapshot()
+				# Thousands of rows take a while to encode, keep it off the loop
+				value = await asyncio.get_running_loop().run_in_executor(None, json.dumps, snapshot)
+				await self.redis.setex(key, 3 * period, value)
+			except Exception as e:
+				logger.error('Worker.onCallsTimer() -> Exception: %s', e)
+			await asyncio.sleep(period)
+
+	async def claimLost(self, stream):
+		free = self.freeSlots()
+		if free <= 0:
+			return
+
+		# Only idle entries: live workers heartbeat theirs, however many there are
+		pending = await self.redis.xpending_range(stream, self.config.stream_group,
+			min='-', max='+', count=free, idle=self.config.claim_idle)
+
+		for entry in pending:
+			if free <= 0:
+				break
+			if (stream, entry['message_id']) in self.active:
+				continue
+
+			claimed = await self.redis.xclaim(stream, self.config.stream_group, self.config.consumer,
+				self.config.claim_idle, [entry['message_id']])
+
+			for entryId, fields in claimed:
+				if not fields:
+					# Entry was deleted from the stream, nothing to retry
+					await self.redis.xack(stream, self.config.stream_group, entryId)
+				elif entry['times_delivered'] >= self.config.max_deliveries:
+					error = 'Lookup failed after %s deliveries' % entry['times_delivered']
+					logger.error('%s: %s, %s', error, fields.get('id'), fields.get('dst_number'))
+					await self.publish(stream, entryId, fields, None, error)
+				else:
+					logger.warning('Retrying lost lookup %s for %s from %s', fields.get('id'), fields.get('dst_number'), entry['consumer'])
+					self.process(stream, entryId, fields)
+					free -= 1
+
+	async def dropIdleConsumers(self, stream):
+		# Consumers of workers gone for good, once their entries were claimed
+		for consumer in await self.redis.xinfo_consumers(stream, self.config.stream_group):
+			if consumer['name'] != self.config.consumer and not consumer['pending'] and consumer['idle'] > self.config.consumer_idle:
+				await self.redis.xgroup_delconsumer(stream, self.config.stream_group, consumer['name'])
+				logger.info('Dropped idle consumer %s of %s', consumer['name'], stream)
+
+
+class ResultCache:
+	"""
+	Stores outcomes the way the API side's storeResult() does: on the
+	VHLR_REDIS node the shared hash ring picks for the number, published to
+	the API workers' local caches, and recorded in the negative filter of
+	the host if there is one.
+	"""
+	def __init__(self, config):
+		self.config = config
+		self.ring = hash_ring.HashRing()
+		self.clients = {} # node name -> Redis
+		# Other than the API side's: its workers skip only their own messages
+		self.origin = '%s-%s' % (socket.gethostname(), os.getpid())
+
+		if config.cache_cluster:
+			node = config.cache_nodes[0]
+			self.clients['cluster'] = redis.RedisCluster(host=node['host'], port=node['port'])
+		else:
+			for node in config.cache_nodes:
+				name = hash_ring.nodeName(node)
+				self.clients[name] = redis.Redis(host=node['host'], port=node['port'], db=node.get('db', 0),
+					password=config.redis_password)
+				self.ring.add(name)
+
+		self.filters = {}
+		if config.negative_filter:
+			try:
+				self.filters = counting_filter.openFilters(config.negative_filter)
+			except OSError as e:
+				logger.error('Negative filter disabled, cannot open %s: %s', config.negative_filter['dir'], e)
+
+	def client(self, dstNum):
+		if len(self.clients) == 1:
+			return next(iter(self.clients.values()))
+		return self.clients[self.ring.node(dstNum)]
+
+	async def store(self, dstNum, code):
+		client = self.client(dstNum)
+		# Must match vhlr_redis.Invalidator.message on the API side
+		message = '%s\n%s %s' % (self.origin, dstNum, code)
+		if self.config.cache_cluster:
+			await client.setex(dstNum, self.config.cache_key_time, code)
+			if self.config.invalidation_channel:
+				await client.publish(self.config.invalidation_channel, message)
+		else:
+			async with client.pipeline(transaction=False) as pipe:
+				pipe.setex(dstNum, self.config.cache_key_time, code)
+				if self.config.invalidation_channel:
+					pipe.publish(self.config.invalidation_channel, message)
+				await pipe.execute()
+
+		counting_filter.record(self.filters, dstNum, code)
+
+	async def close(self):
+		for client in self.clients.values():
+			await client.aclose()
+
+
+def cacheNode(value):
+	"""host:port[/db] of --cache-node."""
+	address, _, db = value.partition('/')
+	host, _, port = address.rpartition(':')
+	return {'host': host or 'localhost', 'port': int(port), 'db': int(db or 0)}
+
+
+async def run(params):
+	config = Config()
+	config.__dict__.update(params)
+	vhlr_callgen.initLogger(config)
+
+	worker = Worker(config)
+	try:
+		await worker.start()
+	finally:
+		await worker.stop()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='VHLR dialer worker')
+	parser.add_argument('--consumer', help='Consumer name in the stream group, unique per worker, default: host name')
+	parser.add_argument('--max-calls', type=int, dest='max_calls_count', help='Concurrent lookups')
+	parser.add_argument('--cps', type=float, help='Calls per second')
+	parser.add_argument('--redis', dest='redis_address', help='Redis address, e.g. redis://localhost')
+	parser.add_argument('--cache-node', dest='cache_nodes', type=cacheNode, action='append',
+		help='host:port/db of a VHLR_REDIS node, once per node')
+	parser.add_argument('--fs-cli-host', dest='fs_cli_host')
+	parser.add_argument('--fs-cli-port', dest='fs_cli_port')
+	parser.add_argument('--stats-path', dest='stats_path', help='Outcome stats file, shared with the API side')
+	parser.add_argument('--loglevel')
+	args = parser.parse_args()
+
+	params = {k: v for k, v in vars(args).items() if v is not None}
+
+	uvloop.install()
+	try:
+		asyncio.run(run(params))
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,76 @@
+import json
+import math
+import time
+import uuid
+
+from base.engine.vhlr_engine import importFreeswitch
+
+priorities = importFreeswitch('priorities')
+
+
+class QueueTimeout(Exception):
+	pass
+
+
+class QueueClient(object):
+	"""
+	API side of the distributed lookup queue. Lookups are appended to a Redis
+	stream consumed by base/freeswitch/vhlr_worker.py and the result is read
+	from a per-request list the worker pushes to. Every priority class has
+	its own stream, so a bulk backlog doesn't queue up in front of
+	interactive lookups.
+	"""
+	def __init__(self, redis_client, config):
+		self.redis = redis_client
+		self.stream = config['stream']
+		self.maxlen = config['stream_maxlen']
+		self.resultKeyPrefix = config['result_key_prefix']
+		self.waitMargin = config['wait_margin']
+		self.callsKeyPrefix = config['calls_key_prefix']
+
+	def lookup(self, dst_number, connect_timeout, priority='interactive', deadline=None):
+		"""
+		Return the worker result: {'number', 'code'[, 'retrying' or 'partial']}.
+		With a deadline (unix time) the worker answers by then, with the state
+		so far and 'partial' if the call isn't over.
+		"""
+		request_id = uuid.uuid4().hex
+		fields = {
+			'id': request_id,
+			'dst_number': dst_number,
+			'connect_timeout': connect_timeout,
+			'priority': priority,
+		}
+		wait = connect_timeout + self.waitMargin
+		if deadline is not None:
+			fields['deadline'] = repr(deadline)
+			# 0 would block forever
+			wait = max(1, min(wait, math.ceil(deadline - time.time())))
+		self.redis.xadd(priorities.streamName(self.stream, priority), fields, maxlen=self.maxlen, approximate=True)
+
+		item = self.redis.blpop(self.resultKeyPrefix + request_id, timeout=wait)
+		if item is None:
+			raise QueueTimeout('No result for %s within %s sec' % (dst_number, wait))
+
+		result = json.loads(item[1])
+		if result.get('error'):
+			raise Exception(result['error'])
+
+		return result
+
+	def snapshots(self):
+		"""
+		In-flight calls the workers last published, one snapshot per worker.
+		Ages are brought forward to now.
+		"""
+		keys = list(self.redis.scan_iter(match=self.callsKeyPrefix + '*', count=100))
+		now = time.time()
+		snapshots = []
+		for value in self.redis.mget(keys) if keys else []:
+			if not value:
+				continue
+			snapshot = json.loads(value)
+			for call in snapshot['calls']:
+				call['age'] += now - snapshot['time']
+			snapshots.append(snapshot)
+		return snapshots
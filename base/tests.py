@@ -1,3 +1,864 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import redis
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from base.asgi import vhlr_dispatch, vhlr_fastpath, vhlr_websocket
+from base.cache import cache_snapshot, vhlr_filter, vhlr_redis
+from base.engine.vhlr_engine import importFreeswitch
+from base.queue.vhlr_queue import QueueClient
+from base.throttles import vhlr_throttles
+from base.views import vhlr_views
+
+counting_filter = importFreeswitch('counting_filter')
+freeswitch_api = importFreeswitch('freeswitch_api')
+hash_ring = importFreeswitch('hash_ring')
+number_utils = importFreeswitch('number_utils')
+vhlr_callgen = importFreeswitch('vhlr_callgen')
+
+
+def freePort():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+class RedisServers(object):
+	"""Local redis-server processes on free ports, one per node."""
+	def __init__(self, count):
+		self.dir = tempfile.TemporaryDirectory()
+		self.nodes = []
+		self.processes = []
+		for _ in range(count):
+			port = freePort()
+			self.processes.append(subprocess.Popen(
+				['redis-server', '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no',
+					'--dir', self.dir.name],
+				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+			self.nodes.append({'host': '127.0.0.1', 'port': port, 'db': 0})
+
+		for node in self.nodes:
+			client = redis.Redis(host=node['host'], port=node['port'])
+			deadline = time.monotonic() + 5
+			while True:
+				try:
+					client.ping()
+					break
+				except redis.ConnectionError:
+					if time.monotonic() > deadline:
+						self.stop()
+						raise
+					time.sleep(0.05)
+
+	def client(self, node):
+		return redis.Redis(host=node['host'], port=node['port'], db=node['db'])
+
+	def stop(self):
+		for process in self.processes:
+			process.terminate()
+			process.wait()
+		self.dir.cleanup()
+
+
+class TimerWheelTest(SimpleTestCase):
+	def test_wrap_around(self):
+		async def run():
+			loop = asyncio.get_running_loop()
+			wheel = freeswitch_api.TimerWheel(tick=0.01, size=4)
+			fired = []
+			started = loop.time()
+			# 0.02 and 0.06 sec share a slot of the 4-slot wheel, 0.11 wraps twice
+			for delay in (0.06, 0.02, 0.11):
+				wheel.schedule(delay, lambda delay=delay: fired.append((delay, loop.time() - started)))
+			self.assertEqual(len(wheel), 3)
+			await asyncio.sleep(0.2)
+			return wheel, fired
+
+		wheel, fired = asyncio.run(run())
+		self.assertEqual([delay for delay, _ in fired], [0.02, 0.06, 0.11])
+		for delay, elapsed in fired:
+			self.assertGreaterEqual(elapsed, delay - 0.001)
+		self.assertEqual(len(wheel), 0)
+		self.assertIsNone(wheel.handle)
+
+	def test_cancel(self):
+		async def run():
+			wheel = freeswitch_api.TimerWheel(tick=0.01, size=4)
+			fired = []
+			timer = wheel.schedule(0.02, fired.append, 'cancelled')
+			wheel.schedule(0.03, fired.append, 'kept')
+			timer.cancel()
+			timer.cancel()
+			self.assertEqual(len(wheel), 1)
+			await asyncio.sleep(0.1)
+			return wheel, fired
+
+		wheel, fired = asyncio.run(run())
+		self.assertEqual(fired, ['kept'])
+		self.assertEqual(len(wheel), 0)
+
+
+class DialSchedulerTest(SimpleTestCase):
+	def test_reserved_slots(self):
+		async def run():
+			config = vhlr_callgen.Config()
+			config.max_calls_count = 4
+			config.cps = 0
+			config.priority_reserved = {'interactive': 2}
+			scheduler = vhlr_callgen.DialScheduler(SimpleNamespace(config=config, loop=asyncio.get_running_loop()))
+
+			# Bulk gets the unreserved slots only
+			await scheduler.acquire('bulk')
+			await scheduler.acquire('bulk')
+			waiting = asyncio.ensure_future(scheduler.acquire('bulk'))
+			await asyncio.sleep(0)
+			self.assertFalse(waiting.done())
+
+			# Interactive starts right away on its reserved slots
+			await asyncio.wait_for(scheduler.acquire('interactive'), 1)
+			await asyncio.wait_for(scheduler.acquire('interactive'), 1)
+			self.assertEqual(scheduler.activeCount(), 4)
+
+			# A freed interactive slot stays reserved, a freed bulk one is taken
+			scheduler.release('interactive')
+			await asyncio.sleep(0)
+			self.assertFalse(waiting.done())
+			scheduler.release('bulk')
+			await asyncio.wait_for(waiting, 1)
+			self.assertEqual(scheduler.active, {'interactive': 1, 'bulk': 2, 'refresh': 0})
+			self.assertFalse(scheduler.canStart('refresh'))
+
+		asyncio.run(run())
+
+
+class PriorityStreamsTest(SimpleTestCase):
+	def test_api_writes_where_worker_reads(self):
+		client = mock.Mock()
+		client.blpop.return_value = (b'key', b'{"number": "4917012345678", "code": "USER_BUSY"}')
+		queue = QueueClient(client, settings.VHLR_QUEUE)
+		for priority in vhlr_views.priorities.NAMES:
+			queue.lookup('4917012345678', 7, priority)
+		written = {call.args[0]: priority for call, priority in zip(client.xadd.call_args_list, vhlr_views.priorities.NAMES)}
+
+		vhlr_worker = importFreeswitch('vhlr_worker')
+		config = vhlr_worker.Config()
+		config.stream = settings.VHLR_QUEUE['stream']
+		self.assertEqual(written, vhlr_worker.Worker(config).streams)
+
+
+class NormalizerTest(SimpleTestCase):
+	def test_spellings(self):
+		normalizer = number_utils.fromConfig({'default_country': '49', 'rules': {'0049': '49'}})
+		for number in ('+4917012345678', '004917012345678', '017012345678', '4917012345678',
+				'+49 (0) 170 1234-5678', '0049 170/12345678', '(0170) 123 456 78'):
+			self.assertEqual(normalizer.normalize(number), '4917012345678', number)
+
+	def test_national_length(self):
+		normalizer = number_utils.Normalizer('1', trunk_prefix=None, international_prefixes=('011',), national_length=10)
+		self.assertEqual(normalizer.normalize('212 555 0100'), '12125550100')
+		self.assertEqual(normalizer.normalize('01144207946000'), '44207946000')
+
+	def test_invalid(self):
+		normalizer = number_utils.Normalizer('49')
+		for number in (4917012345678, '', '0170abc4567', '+49 170', '+4917012345678901', '０１７０１２３４５６７'):
+			with self.assertRaises(number_utils.NumberError, msg=repr(number)):
+				normalizer.normalize(number)
+
+
+class StuckCall(object):
+	"""freeswitch_api.Call that never gets an outcome."""
+	def __init__(self, srcNum, dstNum, guid, owner, connectTimeout):
+		self.dstNum = dstNum
+		self.guid = guid
+		self.owner = owner
+		self.connectTimeout = connectTimeout
+		self.state = 'DIALING'
+		self.disconnect_code = None
+		self.timedOut = False
+
+	async def start(self):
+		pass
+
+	def onTerminated(self):
+		self.state = 'TERMINATED'
+
+
+class TimedOutCall(StuckCall):
+	"""freeswitch_api.Call that rings until its connect timeout."""
+	async def start(self):
+		self.state = 'RINGING'
+		self.timedOut = True
+		self.disconnect_code = 'RINGING'
+		self.owner.onCallTerminated(self)
+
+
+class DeadlineTest(SimpleTestCase):
+	def setUp(self):
+		self.config = vhlr_callgen.Config()
+		self.config.connect_timeout = 7
+		self.config.deadline_margin = 0.5
+		self.config.min_connect_timeout = 1
+		self.engine = vhlr_callgen.Engine(self.config)
+
+	def test_fit_deadline(self):
+		now = time.time()
+		with mock.patch.object(vhlr_callgen.time, 'time', lambda: now):
+			# The call fits in as it is
+			self.assertIsNone(self.engine.fitDeadline(None, now + 10))
+			self.assertIsNone(self.engine.fitDeadline(3, now + 5))
+			# Shortened to end a margin before the answer is due, itself a margin before the deadline
+			self.assertAlmostEqual(self.engine.fitDeadline(None, now + 5), 4)
+			self.assertAlmostEqual(self.engine.fitDeadline(30, now + 10), 9)
+			with self.assertRaises(vhlr_callgen.DeadlineExceeded) as raised:
+				self.engine.fitDeadline(None, now + 1.9)
+			self.assertIsNone(raised.exception.state)
+
+	def test_backstop(self):
+		async def run():
+			self.engine.loop = asyncio.get_running_loop()
+			self.engine.timerWheel = freeswitch_api.TimerWheel(0.01)
+			self.config.fs_cli_timeout = 0.01
+			with mock.patch.object(vhlr_callgen.freeswitch_api, 'Call', StuckCall), \
+					self.assertLogs(vhlr_callgen.logger, 'ERROR'):
+				return await asyncio.wait_for(self.engine.onDial('4917012345678', 0.05), 1)
+
+		# A call that never ends is dropped connectTimeout + 3 command timeouts in
+		self.assertEqual(asyncio.run(run()), 'ORIGINATOR_CANCEL')
+		self.assertEqual(self.engine.calls, {})
+		self.assertEqual(self.engine.waiters, {})
+
+	def test_fitted_call_times_out(self):
+		async def run():
+			self.engine.loop = asyncio.get_running_loop()
+			self.engine.timerWheel = freeswitch_api.TimerWheel(0.01)
+			with mock.patch.object(vhlr_callgen.freeswitch_api, 'Call', TimedOutCall):
+				unfitted = await self.engine.onDial('4917012345678', 1)
+				with self.assertRaises(vhlr_callgen.DeadlineExceeded) as raised:
+					await self.engine.onDial('4917012345678', 1, fitted=True)
+			return unfitted, raised.exception.state
+
+		# Cut to the deadline, ending by it is the state so far, not an outcome
+		self.assertEqual(asyncio.run(run()), ('RINGING', 'RINGING'))
+
+	def test_expired_work_in_worker(self):
+		vhlr_worker = importFreeswitch('vhlr_worker')
+		worker = vhlr_worker.Worker(vhlr_worker.Config())
+		published = []
+		async def publish(stream, entryId, fields, code, error=None, partial=False):
+			published.append((entryId, code, partial))
+		async def onDial(dstNum, connectTimeout, fitted=False):
+			raise AssertionError('dialed past the deadline')
+		worker.publish = publish
+		worker.engine.onDial = onDial
+
+		async def run():
+			worker.engine.loop = asyncio.get_running_loop()
+			fields = {'id': 'a1', 'dst_number': '4917012345678', 'connect_timeout': '7', 'deadline': repr(time.time() - 1)}
+			with self.assertLogs(vhlr_callgen.logger, 'INFO'):
+				await asyncio.wait_for(worker.onLookup(worker.config.stream, '1-0', fields), 1)
+
+		asyncio.run(run())
+		# Answered as partial without a call, so the entry is acknowledged
+		self.assertEqual(published, [('1-0', None, True)])
+
+
+class RetryQueueTest(SimpleTestCase):
+	def setUp(self):
+		self.config = vhlr_callgen.Config()
+		self.config.reconnect_schedule = [0.02, 0.04]
+		self.config.reconnect_jitter = 0
+		self.dials = [] # (number, priority, loop time)
+		self.results = []
+		self.dialTime = 0
+
+	def retryQueue(self, codes):
+		codes = iter(codes)
+		async def dial(dstNum, connectTimeout=None, priority=None, deadline=None):
+			self.dials.append((dstNum, priority, asyncio.get_running_loop().time()))
+			await asyncio.sleep(self.dialTime)
+			return next(codes)
+		engine = SimpleNamespace(config=self.config, loop=asyncio.get_running_loop(), dial=dial,
+			onResult=lambda dstNum, code: self.results.append((dstNum, code)))
+		return vhlr_callgen.RetryQueue(engine)
+
+	def test_schedule(self):
+		async def run():
+			retries = self.retryQueue(['SWITCH_CONGESTION', 'USER_BUSY'])
+			started = asyncio.get_running_loop().time()
+			self.assertTrue(retries.schedule('4917012345678', 5))
+			await asyncio.sleep(0.2)
+			return retries, started
+
+		retries, started = asyncio.run(run())
+		# Re-dialed after each delay of the schedule at retry priority, until the outcome isn't retryable
+		self.assertEqual([(number, priority) for number, priority, _ in self.dials],
+			[('4917012345678', 'refresh'), ('4917012345678', 'refresh')])
+		self.assertGreaterEqual(self.dials[0][2] - started, 0.02)
+		self.assertGreaterEqual(self.dials[1][2] - self.dials[0][2], 0.04)
+		self.assertEqual(self.results, [('4917012345678', 'USER_BUSY')])
+		self.assertEqual(retries.pending, {})
+
+	def test_schedule_exhausted(self):
+		async def run():
+			retries = self.retryQueue(['SWITCH_CONGESTION'] * 2)
+			retries.schedule('4917012345678', 5)
+			await asyncio.sleep(0.2)
+			return retries
+
+		retries = asyncio.run(run())
+		self.assertEqual(len(self.dials), 2)
+		self.assertEqual(self.results, [('4917012345678', 'SWITCH_CONGESTION')])
+		self.assertFalse(retries.schedule('4917012345678', 5, attempt=2))
+
+	def test_cancel(self):
+		async def run():
+			retries = self.retryQueue(['USER_BUSY'])
+			retries.schedule('4917012345678', 5)
+			retries.cancel('4917012345678')
+			await asyncio.sleep(0.05)
+			return retries
+
+		asyncio.run(run())
+		self.assertEqual(self.dials, [])
+		self.assertEqual(self.results, [])
+
+	def test_cancel_while_dialing(self):
+		# The retry dialing finishes, its result is dropped
+		self.dialTime = 0.02
+		async def run():
+			retries = self.retryQueue(['USER_BUSY'])
+			retries.schedule('4917012345678', 5)
+			while not self.dials:
+				await asyncio.sleep(0.005)
+			retries.cancel('4917012345678')
+			await asyncio.sleep(0.05)
+
+		asyncio.run(run())
+		self.assertEqual(len(self.dials), 1)
+		self.assertEqual(self.results, [])
+
+	def test_full(self):
+		async def run():
+			self.config.max_pending_retries = 2
+			retries = self.retryQueue([])
+			scheduled = [retries.schedule(number, 5) for number in ('4917000000001', '4917000000002', '4917000000003')]
+			# A number already pending may be rescheduled
+			scheduled.append(retries.schedule('4917000000001', 5))
+			retries.clear()
+			return scheduled
+
+		with self.assertLogs(vhlr_callgen.logger, 'WARNING'):
+			self.assertEqual(asyncio.run(run()), [True, True, False, True])
+
+
+class BulkCheckTest(SimpleTestCase):
+	def setUp(self):
+		self.config = vhlr_callgen.Config()
+		self.config.reconnect_schedule = [0.05]
+		self.config.reconnect_jitter = 0
+		self.config.cps = 0
+		args = SimpleNamespace(country='49', trunk_prefix='0', connect_timeout=None, priority='bulk')
+		self.check = vhlr_callgen.BulkCheck(self.config, args)
+		self.out = io.StringIO()
+		self.check.writer = csv.writer(self.out)
+
+	async def startEngine(self, codes):
+		# Dials get the next of codes instead of calling
+		engine = self.check.engine
+		engine.loop = asyncio.get_running_loop()
+		engine.started = True
+		engine.resultListeners.append(self.check.onRetryResult)
+		codes = iter(codes)
+		async def onDial(dstNum, connectTimeout, fitted=False):
+			await asyncio.sleep(0)
+			return next(codes)
+		engine.onDial = onDial
+
+	def rows(self):
+		return {int(row[0]): row[3] for row in csv.reader(io.StringIO(self.out.getvalue()))}
+
+	def test_repeat_replaces_pending_retry(self):
+		async def run():
+			await self.startEngine(['NORMAL_CIRCUIT_CONGESTION', 'USER_BUSY'])
+			first = asyncio.ensure_future(self.check.check(1, '017012345678', '4917012345678'))
+			while '4917012345678' not in self.check.final:
+				await asyncio.sleep(0)
+
+			# The repeat cancels the pending retry, both lines take its outcome
+			await asyncio.wait_for(self.check.check(2, '017012345678', '4917012345678'), 1)
+			await asyncio.wait_for(first, 1)
+
+		asyncio.run(run())
+		self.assertEqual(self.rows(), {1: 'USER_BUSY', 2: 'USER_BUSY'})
+		self.assertEqual(self.check.watermark, 2)
+		self.assertEqual(self.check.final, {})
+
+	def test_retry_result(self):
+		async def run():
+			await self.startEngine(['NORMAL_CIRCUIT_CONGESTION', 'NORMAL_CLEARING'])
+			await asyncio.wait_for(asyncio.gather(
+				self.check.check(1, '017012345678', '4917012345678'),
+				self.check.check(2, '+4917012345678', '4917012345678'),
+			), 1)
+
+		asyncio.run(run())
+		self.assertEqual(self.rows(), {1: 'NORMAL_CLEARING', 2: 'NORMAL_CLEARING'})
+
+	def test_checkpoint_of_other_input(self):
+		with tempfile.TemporaryDirectory() as dir:
+			self.check.args.checkpoint = os.path.join(dir, 'numbers.ckpt')
+			self.check.args.input = os.path.join(dir, 'numbers.txt')
+			self.check.out = self.out
+			self.check.watermark = 10
+			self.check.saveCheckpoint()
+
+			resumed = vhlr_callgen.BulkCheck(self.config, self.check.args)
+			self.assertTrue(resumed.loadCheckpoint())
+			self.assertEqual(resumed.watermark, 10)
+
+			self.check.args.input = os.path.join(dir, 'other.txt')
+			with self.assertRaises(vhlr_callgen.CheckpointError):
+				vhlr_callgen.BulkCheck(self.config, self.check.args).loadCheckpoint()
+
+
+def accessToken(user_id=1):
+	return jwt.encode({'token_type': 'access', 'user_id': user_id, 'exp': int(time.time()) + 600, 'jti': 'test'},
+		settings.SECRET_KEY, algorithm='HS256')
+
+
+async def callHttp(app, body, token=None):
+	"""Status, headers and body of POST api/vhlr/ through an ASGI app."""
+	headers = [(b'host', settings.ALLOWED_HOSTS[0].encode()), (b'content-type', b'application/json')]
+	if token:
+		headers.append((b'authorization', b'Bearer ' + token.encode()))
+	scope = {'type': 'http', 'method': 'POST', 'path': '/api/vhlr/', 'headers': headers, 'query_string': b''}
+	messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+	async def receive():
+		return messages.pop(0) if messages else {'type': 'http.disconnect'}
+	sent = []
+	async def send(message):
+		sent.append(message)
+	await app(scope, receive, send)
+	headers = {name.lower(): value for name, value in sent[0]['headers']}
+	return sent[0]['status'], headers, json.loads(sent[1]['body'])
+
+
+class FastPathTest(SimpleTestCase):
+	def setUp(self):
+		self.forwarded = []
+		async def django(scope, receive, send):
+			self.forwarded.append(scope)
+			await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+			await send({'type': 'http.response.body', 'body': b'{"via":"django"}'})
+		self.app = vhlr_fastpath.FastPath(django)
+
+		patches = [
+			mock.patch.object(vhlr_fastpath.vhlr_filter, 'deadCode', lambda number: None),
+			mock.patch.object(vhlr_fastpath.vhlr_redis, 'getL1', lambda number: None),
+			mock.patch.object(vhlr_fastpath.vhlr_redis, 'getCode', lambda number: None),
+			mock.patch.object(vhlr_fastpath.vhlr_throttles, 'consume', lambda user_id: None),
+			# User 2 is deactivated
+			mock.patch.object(vhlr_fastpath.TokenVerifier, 'loadActive', lambda verifier, user_id: user_id != 2),
+			mock.patch.object(vhlr_dispatch, 'storeResult', lambda number, code: self.stored.append((number, code))),
+			mock.patch.object(vhlr_dispatch, '_dispatcher', vhlr_dispatch.Dispatcher(4)),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+		self.stored = []
+
+	def test_misses_dialed_concurrently(self):
+		dialing = []
+		async def dispatch(number, connect_timeout, priority, deadline):
+			dialing.append(number)
+			while len(dialing) < 2:
+				await asyncio.sleep(0.01)
+			return 'USER_BUSY', False, False
+
+		async def run():
+			token = accessToken()
+			with mock.patch.object(vhlr_dispatch.dispatcher(), 'dispatch', dispatch):
+				return await asyncio.wait_for(asyncio.gather(
+					callHttp(self.app, b'{"dst_number": "017012345678"}', token),
+					callHttp(self.app, b'{"dst_number": "017087654321", "priority": "bulk"}', token),
+				), 1)
+
+		responses = asyncio.run(run())
+		self.assertEqual([body for _, _, body in responses],
+			[{'number': '017012345678', 'code': 'USER_BUSY'}, {'number': '017087654321', 'code': 'USER_BUSY'}])
+		self.assertEqual(sorted(self.stored), [('4917012345678', 'USER_BUSY'), ('4917087654321', 'USER_BUSY')])
+		self.assertEqual(self.forwarded, [])
+
+	def test_forwards_what_it_cant_parse(self):
+		async def run():
+			token = accessToken()
+			return [
+				await callHttp(self.app, b'{"dst_number": "017012345678", "priority": "urgent"}', token),
+				await callHttp(self.app, b'not json', token),
+				await callHttp(self.app, b'{"dst_number": "017012345678"}'),
+				await callHttp(self.app, b'{"dst_number": "017012345678"}', accessToken(2)),
+			]
+
+		for status, _, body in asyncio.run(run()):
+			self.assertEqual((status, body), (200, {'via': 'django'}))
+		self.assertEqual(len(self.forwarded), 4)
+
+	def test_inactive_user(self):
+		async def run():
+			socket = vhlr_websocket.LookupSocket(None, settings.VHLR_WEBSOCKET)
+			sent = []
+			async def receive():
+				return {'type': 'websocket.connect'}
+			async def send(message):
+				sent.append(message)
+			headers = [(b'host', settings.ALLOWED_HOSTS[0].encode()), (b'authorization', b'Bearer ' + accessToken(2).encode())]
+			await socket({'type': 'websocket', 'path': socket.path, 'headers': headers}, receive, send)
+			return sent
+
+		self.assertEqual(asyncio.run(run()), [{'type': 'websocket.close', 'code': vhlr_websocket.CLOSE_UNAUTHORIZED}])
+
+
+class ThrottleAccountingTest(SimpleTestCase):
+	"""A lookup is charged once, whether the fast path or DRF checks the rate."""
+	def setUp(self):
+		from django.core.asgi import get_asgi_application
+		from rest_framework_simplejwt.authentication import JWTAuthentication
+		self.django = get_asgi_application()
+		self.charged = []
+		self.allowed = True
+
+		user = SimpleNamespace(pk=1, is_authenticated=True, is_active=True)
+		patches = [
+			mock.patch.object(vhlr_throttles, 'consume', self.consume),
+			mock.patch.object(vhlr_fastpath.TokenVerifier, 'loadActive', lambda verifier, user_id: True),
+			mock.patch.object(JWTAuthentication, 'get_user', lambda authentication, token: user),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def consume(self, client_id):
+		self.charged.append(client_id)
+		return vhlr_throttles.RateResult(allowed=self.allowed, limit=10, remaining=3 if self.allowed else 0,
+			quota=100, quota_remaining=42, retry_after=0 if self.allowed else 2.5)
+
+	def test_forwarded_request(self):
+		# The fast path charges and forwards what it can't parse, DRF doesn't charge again
+		app = vhlr_fastpath.FastPath(self.django)
+		status, headers, _ = asyncio.run(callHttp(app, b'{"dst_number": "017012345678", "priority": "urgent"}', accessToken()))
+		self.assertEqual(status, 200)
+		self.assertEqual(self.charged, [1])
+		self.assertEqual((headers[b'x-ratelimit-remaining'], headers[b'x-quota-remaining']), (b'3', b'42'))
+
+	def test_throttled_by_fast_path(self):
+		self.allowed = False
+		app = vhlr_fastpath.FastPath(self.django)
+		status, headers, body = asyncio.run(callHttp(app, b'{"dst_number": "017012345678"}', accessToken()))
+		self.assertEqual(status, 429)
+		self.assertEqual(self.charged, [1])
+		self.assertEqual((headers[b'retry-after'], headers[b'x-ratelimit-remaining']), (b'3', b'0'))
+		self.assertEqual(body, {'detail': 'Request was throttled. Expected available in 3 seconds.'})
+
+	def test_throttled_by_drf(self):
+		# Without the fast path the throttle charges, the 429 has the same headers
+		self.allowed = False
+		status, headers, body = asyncio.run(callHttp(self.django, b'{"dst_number": "017012345678"}', accessToken()))
+		self.assertEqual(status, 429)
+		self.assertEqual(self.charged, [1])
+		self.assertEqual((headers[b'retry-after'], headers[b'x-ratelimit-remaining'], headers[b'x-quota-remaining']),
+			(b'3', b'0', b'42'))
+		self.assertEqual(body, {'detail': 'Request was throttled. Expected available in 3 seconds.'})
+
+
+class LookupSocketTest(SimpleTestCase):
+	def test_failed_send_closes_connection(self):
+		sent = []
+		async def receive():
+			await asyncio.sleep(0)
+			return {'type': 'websocket.receive', 'text': '{"id": 1, "dst_number": "017012345678"}'}
+		async def send(message):
+			sent.append(message)
+			raise OSError('client gone')
+		async def lookup(raw):
+			return {'id': 1, 'code': 'USER_BUSY'}
+
+		async def run():
+			async def verify(authorization):
+				return 1
+			server = SimpleNamespace(maxInflight=2, sendQueue=1, verify=verify)
+			connection = vhlr_websocket.Connection(server, 1, b'', receive, send)
+			connection.lookup = lookup
+			with self.assertLogs(vhlr_websocket.logger, 'ERROR'):
+				await asyncio.wait_for(connection.run(), 1)
+			await asyncio.sleep(0)
+			return connection
+
+		connection = asyncio.run(run())
+		self.assertEqual(connection.tasks, set())
+		self.assertEqual(sent[-1], {'type': 'websocket.close', 'code': vhlr_websocket.CLOSE_INTERNAL_ERROR})
+
+
+class CountingFilterTest(SimpleTestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.dir.cleanup)
+
+	def openFilter(self, capacity=1000, error_rate=0.01):
+		return counting_filter.CountingFilter(os.path.join(self.dir.name, 'filter.bin'), capacity, error_rate, 3600, 4)
+
+	def test_add_remove(self):
+		numbers = self.openFilter()
+		numbers.add('4917012345678')
+		self.assertTrue(numbers.contains('4917012345678'))
+		# Shared through the file
+		self.assertTrue(self.openFilter().contains('4917012345678'))
+		numbers.remove('4917012345678')
+		self.assertFalse(numbers.contains('4917012345678'))
+		self.assertFalse(self.openFilter().contains('4917012345678'))
+
+	def test_record(self):
+		filters = counting_filter.openFilters({
+			'dir': self.dir.name, 'capacity': 1000, 'error_rate': 0.01, 'max_age': 3600, 'generations': 4,
+			'causes': ['UNALLOCATED_NUMBER', 'NO_ROUTE_DESTINATION'],
+		})
+		self.assertEqual(counting_filter.record(filters, '4917012345678', 'UNALLOCATED_NUMBER'), 'added')
+		self.assertTrue(filters['UNALLOCATED_NUMBER'].contains('4917012345678'))
+		self.assertEqual(counting_filter.record(filters, '4917012345678', 'NORMAL_CLEARING'), 'removed')
+		self.assertFalse(filters['UNALLOCATED_NUMBER'].contains('4917012345678'))
+		self.assertIsNone(counting_filter.record(filters, '4917012345678', 'NORMAL_CLEARING'))
+
+	def test_false_positive_rate(self):
+		numbers = self.openFilter(capacity=2000, error_rate=0.01)
+		generations = list(range(numbers.generations))
+		# Fill every generation to capacity, as if they all were live
+		for generation in generations:
+			offset = numbers.dataOffset + generation * numbers.genBytes
+			for i in range(2000):
+				for p in numbers.positions('4917%d%07d' % (generation, i)):
+					numbers.map[offset + (p >> 1)] += 1 << ((p & 1) * 4)
+		for i in range(2000):
+			self.assertTrue(numbers.contains('4917%d%07d' % (0, i), generations))
+
+		probes = 20000
+		positives = sum(numbers.contains('4930%08d' % i, generations) for i in range(probes))
+		self.assertLess(positives / probes, 0.015)
+
+
+class NegativeFilterTest(SimpleTestCase):
+	def test_opened_on_first_use(self):
+		with tempfile.TemporaryDirectory() as dir:
+			config = dict(vhlr_filter.filter_settings, dir=os.path.join(dir, 'negative'), capacity=1000)
+			with mock.patch.object(vhlr_filter, 'filter_settings', config), \
+					mock.patch.object(vhlr_filter, '_filters', None), \
+					mock.patch.dict(vhlr_filter.counters, hits=0):
+				self.assertFalse(os.path.exists(config['dir']))
+				vhlr_filter.record('4917012345678', 'UNALLOCATED_NUMBER')
+				self.assertEqual(sorted(os.listdir(config['dir'])), ['number_changed.bin', 'unallocated_number.bin'])
+				self.assertEqual(vhlr_filter.deadCode('4917012345678'), 'UNALLOCATED_NUMBER')
+				self.assertIsNone(vhlr_filter.deadCode('4917087654321'))
+
+
+class CacheSnapshotTest(SimpleTestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.dir.cleanup)
+		self.path = os.path.join(self.dir.name, 'cache.snapshot')
+
+	def test_round_trip(self):
+		now = time.time()
+		items = [('4917%08d' % i, 'USER_BUSY', now + 60 + i) for i in range(1000)]
+		items.append(('491799999999', 'UNALLOCATED_NUMBER', now - 1))
+		items.append(('49' + 'ü' * 10, 'x' * 300, now + 60))
+		items.append(('4930' * 20000, 'USER_BUSY', now + 60)) # key too long, skipped
+
+		self.assertEqual(cache_snapshot.save(self.path, iter(items)), 1002)
+		self.assertEqual(cache_snapshot.load(self.path, now), items[:1000] + items[1001:1002])
+		self.assertEqual(len(cache_snapshot.load(self.path, now + 100)), 959)
+		self.assertEqual(os.listdir(self.dir.name), ['cache.snapshot'])
+
+	def test_started_by_server_only(self):
+		# Importing the cache module neither loads nor saves snapshots
+		self.assertFalse(vhlr_redis._snapshots)
+
+		cache_snapshot.save(self.path, [('4917012345678', 'USER_BUSY', time.time() + 60)])
+		local = vhlr_redis.LocalCache(1000, 60)
+		with mock.patch.dict(vhlr_redis.redis_settings, snapshot_path=self.path), \
+				mock.patch.object(vhlr_redis, 'local_cache', local), \
+				mock.patch.object(vhlr_redis, '_snapshots', False), \
+				mock.patch.object(vhlr_redis.threading, 'Thread') as thread, \
+				mock.patch.object(vhlr_redis.atexit, 'register') as register:
+			vhlr_redis.startSnapshots()
+			vhlr_redis.startSnapshots()
+			self.assertEqual(local.get('4917012345678'), 'USER_BUSY')
+			self.assertEqual(thread.call_count, 1)
+			register.assert_called_once_with(vhlr_redis.saveSnapshot)
+
+			local.set('4930123456789', 'UNALLOCATED_NUMBER')
+			vhlr_redis.saveSnapshot()
+		self.assertEqual(sorted(key for key, _, _ in cache_snapshot.load(self.path)), ['4917012345678', '4930123456789'])
+
+	def test_empty_and_foreign(self):
+		self.assertEqual(cache_snapshot.save(self.path, []), 0)
+		self.assertEqual(cache_snapshot.load(self.path), [])
+		with open(self.path, 'wb') as f:
+			f.write(b'not a snapshot at all')
+		with self.assertRaises(ValueError):
+			cache_snapshot.load(self.path)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+	def test_states(self):
+		breaker = vhlr_redis.CircuitBreaker(threshold=3, cooldown=10, name='test')
+		now = [100.0]
+		with mock.patch.object(vhlr_redis.time, 'monotonic', lambda: now[0]), self.assertLogs(vhlr_redis.logger):
+			breaker.failure()
+			breaker.failure()
+			breaker.success()
+			breaker.failure()
+			breaker.failure()
+			self.assertTrue(breaker.allow())
+			breaker.failure()
+			self.assertFalse(breaker.allow())
+
+			# One probe after the cool-down, a failed one opens the circuit again
+			now[0] += 10
+			self.assertTrue(breaker.allow())
+			self.assertEqual(breaker.state, breaker.HALF_OPEN)
+			breaker.failure()
+			self.assertFalse(breaker.allow())
+
+			now[0] += 10
+			self.assertTrue(breaker.allow())
+			breaker.success()
+			self.assertEqual(breaker.state, breaker.CLOSED)
+			self.assertTrue(breaker.allow())
+
+		self.assertEqual(breaker.stats(), {'errors': 6, 'rejected': 2, 'opened': 1, 'state': 'closed', 'failures': 0})
+
+	def test_local_fallback(self):
+		client = mock.Mock()
+		client.get.side_effect = client.setex.side_effect = redis.ConnectionError('down')
+		shard = vhlr_redis.Shard('test', client)
+		patches = [
+			mock.patch.object(vhlr_redis, 'cache', SimpleNamespace(shard=lambda key: shard)),
+			mock.patch.object(vhlr_redis, 'invalidator', None),
+			mock.patch.object(vhlr_redis, 'local_cache', vhlr_redis.LocalCache(1000, 60)),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+		vhlr_redis.setCode('4917012345678', 'USER_BUSY')
+		with self.assertLogs(vhlr_redis.logger, 'WARNING'):
+			for _ in range(shard.breaker.threshold):
+				self.assertEqual(vhlr_redis.getCode('4917012345678'), 'USER_BUSY')
+		self.assertEqual(shard.breaker.state, shard.breaker.OPEN)
+
+		# Open: answered locally without calling Redis
+		calls = client.get.call_count
+		self.assertEqual(vhlr_redis.getCode('4917012345678'), 'USER_BUSY')
+		self.assertIsNone(vhlr_redis.getCode('4917087654321'))
+		self.assertEqual(client.get.call_count, calls)
+
+
+class HashRingTest(SimpleTestCase):
+	def test_distribution(self):
+		ring = hash_ring.HashRing()
+		for name in ('a', 'b', 'c'):
+			ring.add(name)
+		keys = ['49170%07d' % i for i in range(30000)]
+		owners = {key: ring.node(key) for key in keys}
+		for name in ('a', 'b', 'c'):
+			share = list(owners.values()).count(name) / len(keys)
+			self.assertTrue(0.25 < share < 0.42, '%s owns %.3f' % (name, share))
+
+		# A fourth node takes about a quarter, all moved keys go to it
+		ring.add('d')
+		moved = [key for key in keys if ring.node(key) != owners[key]]
+		self.assertTrue(0.17 < len(moved) / len(keys) < 0.33)
+		self.assertTrue(all(ring.node(key) == 'd' for key in moved))
+
+		ring.remove('d')
+		self.assertEqual({key: ring.node(key) for key in keys}, owners)
+
+
+class ShardedCacheTest(SimpleTestCase):
+	"""Round trips over three local redis-server processes, skipped without redis-server."""
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		if not shutil.which('redis-server'):
+			raise unittest.SkipTest('redis-server not installed')
+		cls.servers = RedisServers(3)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.servers.stop()
+		super().tearDownClass()
+
+	def setUp(self):
+		for node in self.servers.nodes:
+			self.servers.client(node).flushdb()
+		self.cache = vhlr_redis.ShardedCache(self.servers.nodes)
+		patches = [
+			mock.patch.object(vhlr_redis, 'cache', self.cache),
+			mock.patch.object(vhlr_redis, 'invalidator', None),
+			mock.patch.object(vhlr_redis, 'local_cache', vhlr_redis.LocalCache(1000, 60)),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def nodeOf(self, number):
+		return next(node for node in self.servers.nodes if hash_ring.nodeName(node) == self.cache.ring.node(number))
+
+	def test_round_trip(self):
+		numbers = ['4917%08d' % i for i in range(300)]
+		vhlr_redis.setCode(numbers[0], 'UNALLOCATED_NUMBER')
+		vhlr_redis.setCodes({number: 'USER_BUSY' for number in numbers[1:]})
+
+		# Each number on its ring node only, and every node got some
+		for number in numbers:
+			for node in self.servers.nodes:
+				stored = self.servers.client(node).get(number)
+				self.assertEqual(stored is not None, node is self.nodeOf(number), number)
+		for node in self.servers.nodes:
+			self.assertGreater(self.servers.client(node).dbsize(), 50)
+
+		self.assertEqual(vhlr_redis.getCode(numbers[0]), 'UNALLOCATED_NUMBER')
+		codes = vhlr_redis.getCodes(numbers + ['491799999999'])
+		self.assertEqual(codes[numbers[1]], 'USER_BUSY')
+		self.assertEqual(sum(code == 'USER_BUSY' for code in codes.values()), 299)
+		self.assertIsNone(codes['491799999999'])
+
+	def test_worker_writes_where_api_reads(self):
+		vhlr_worker = importFreeswitch('vhlr_worker')
+		config = vhlr_worker.Config()
+		config.cache_nodes = self.servers.nodes
+		config.invalidation_channel = None
+
+		async def store(codes):
+			cache = vhlr_worker.ResultCache(config)
+			try:
+				for number, code in codes.items():
+					await cache.store(number, code)
+			finally:
+				await cache.close()
+
+		codes = {'4930%08d' % i: 'NORMAL_CLEARING' for i in range(50)}
+		asyncio.run(store(codes))
+		self.assertEqual(vhlr_redis.getCodes(list(codes)), codes)
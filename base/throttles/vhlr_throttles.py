@@ -0,0 +1,185 @@
+import functools
+import logging
+import math
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from base.cache import vhlr_redis
+
+# Per-client (JWT user) rate limits and daily quotas, shared by all web workers through Redis
+
+logger = logging.getLogger(__name__)
+
+limit_settings = settings.VHLR_RATE_LIMIT
+
+# Token bucket refilled at rate tokens/sec up to burst, plus a counter per
+# client and UTC day. One request takes one token and one unit of quota;
+# a refused request takes neither.
+#
+# KEYS: bucket hash, quota counter
+# ARGV: rate, burst, now (sec), daily quota (0 - unlimited), quota key ttl
+# Returns: allowed, tokens left, quota left, retry after (sec)
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local quota = tonumber(ARGV[4])
+
+local used = tonumber(redis.call('GET', KEYS[2]) or '0')
+if quota > 0 and used >= quota then
+	return {0, '0', 0, ARGV[5]}
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+	allowed = 1
+	used = redis.call('INCR', KEYS[2])
+	if used == 1 then
+		redis.call('EXPIRE', KEYS[2], ARGV[5])
+	end
+else
+	wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens), quota - used, tostring(wait)}
+"""
+
+RateResult = namedtuple('RateResult', 'allowed limit remaining quota quota_remaining retry_after')
+
+
+class RateLimiter(object):
+	"""
+	Applies the token bucket script on the cache shard of the client. The
+	check fails open: while the shard's circuit is open or the script
+	errors, requests are let through unlimited.
+	"""
+	def __init__(self, config):
+		self.config = config
+		self.keyPrefix = config['key_prefix']
+		self.script = None
+
+	def limits(self, client_id):
+		limits = {
+			'rate': self.config['rate'],
+			'burst': self.config['burst'],
+			'daily_quota': self.config['daily_quota'],
+		}
+		limits.update(self.config['clients'].get(client_id, {}))
+		return limits
+
+	def consume(self, client_id):
+		"""Take one request from the client's budget, None if it can't be checked."""
+		client_id = str(client_id)
+		limits = self.limits(client_id)
+
+		now = time.time()
+		day = time.strftime('%Y%m%d', time.gmtime(now))
+		# Seconds to the end of the UTC day, when the quota resets
+		quota_ttl = 86400 - int(now) % 86400
+		# Same hash tag: both keys go to the same shard and Cluster slot
+		tag = '{%s}' % client_id
+		keys = [self.keyPrefix + tag + ':bucket', self.keyPrefix + tag + ':quota:' + day]
+
+		shard = vhlr_redis.cache.shard(tag)
+		if not shard.breaker.allow():
+			return None
+
+		try:
+			if self.script is None:
+				self.script = shard.client.register_script(TOKEN_BUCKET_SCRIPT)
+			allowed, tokens, quota_left, wait = self.script(keys=keys,
+				args=[limits['rate'], limits['burst'], repr(now), limits['daily_quota'], quota_ttl],
+				client=shard.client)
+		except Exception as e:
+			shard.breaker.failure()
+			logger.debug('Rate limit check failed for %s on %s: %s', client_id, shard.name, e)
+			return None
+		shard.breaker.success()
+
+		return RateResult(
+			allowed=bool(allowed),
+			limit=limits['burst'],
+			remaining=int(float(tokens)),
+			quota=limits['daily_quota'],
+			quota_remaining=quota_left if limits['daily_quota'] else None,
+			retry_after=float(wait),
+		)
+
+
+limiter = RateLimiter(limit_settings)
+
+
+def consume(client_id):
+	if not limit_settings['enabled']:
+		return None
+	return limiter.consume(client_id)
+
+
+def headers(rate):
+	"""Response headers reporting the remaining budget."""
+	result = [
+		('X-RateLimit-Limit', str(rate.limit)),
+		('X-RateLimit-Remaining', str(rate.remaining)),
+	]
+	if rate.quota:
+		result += [
+			('X-Quota-Limit', str(rate.quota)),
+			('X-Quota-Remaining', str(max(0, rate.quota_remaining))),
+		]
+	return result
+
+
+class ClientRateThrottle(BaseThrottle):
+	"""
+	DRF throttle for the lookup view. A request the ASGI fast path already
+	charged (it forwards cache misses) is not charged again.
+	"""
+	rate = None
+
+	def allow_request(self, request, view):
+		scope = getattr(request._request, 'scope', None) or {}
+		if 'vhlr_rate' in scope:
+			rate = scope['vhlr_rate']
+		elif request.user and request.user.is_authenticated:
+			rate = consume(request.user.pk)
+		else:
+			rate = None
+
+		request._request.vhlr_rate = self.rate = rate
+		return rate is None or rate.allowed
+
+	def wait(self):
+		return retryAfter(self.rate) if self.rate else None
+
+
+def rateHeaders(view):
+	"""
+	Add the budget headers of ClientRateThrottle to the responses of an
+	@api_view view. Goes outside @api_view: DRF answers 429 before the
+	function it wraps runs.
+	"""
+	@functools.wraps(view)
+	def wrapper(request, *args, **kwargs):
+		response = view(request, *args, **kwargs)
+		rate = getattr(request, 'vhlr_rate', None)
+		if rate:
+			for name, value in headers(rate):
+				response[name] = value
+		return response
+	return wrapper
+
+
+def retryAfter(rate):
+	return max(1, int(math.ceil(rate.retry_after)))
@@ -7,6 +7,12 @@ app_name = 'vhlr'
 
 urlpatterns = [
         path('vhlr/', views.vhlrRequest),
+        path('vhlr/ready/', views.vhlrReady),
+        path('vhlr/metrics/', views.vhlrMetrics),
+        path('vhlr/calls/', views.vhlrCalls),
+        path('vhlr/stats/', views.vhlrStats),
+        path('vhlr/profile/', views.vhlrProfile),
+        path('vhlr/profile/<str:profile_id>/', views.vhlrProfileResult),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
@@ -1,50 +1,334 @@
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
+from django.conf import settings
+from django.http import HttpResponse
 #from django.core.cache import cache
-import redis
-import sys
-import os
+import json
+import logging
+import pstats
 import time
-sys.path.append(os.path.join(os.path.abspath(os.getcwd()), 'base/freeswitch'))
-import vhlr_callgen
+import uuid
+from base.cache import vhlr_redis, vhlr_filter
+from base.cache.vhlr_redis import redis_client, getCode, setCode
+from base.engine import vhlr_engine, vhlr_profiler
+from base.queue.vhlr_queue import QueueClient, QueueTimeout
+from base.throttles.vhlr_throttles import ClientRateThrottle, rateHeaders
+
+queue_client = QueueClient(vhlr_redis.queue_client, settings.VHLR_QUEUE)
+
+priorities = vhlr_engine.importFreeswitch('priorities')
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_KEY_PREFIX = 'vhlr:profile:'
+PROFILE_RESULT_TTL = 600 # sec a finished profile can be fetched
+
+logger = logging.getLogger(__name__)
+
+
+def deadlineExceeded(dst_number):
+	return Response({'number': dst_number, 'error': 'Deadline exceeded before dialing', 'partial': True},
+		status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+
+def storeResult(dst_number, disconnect_code):
+	setCode(dst_number, disconnect_code)
+	vhlr_filter.record(dst_number, disconnect_code)
+
+# Final outcomes of background retries in the in-process engine
+vhlr_engine.host().resultListeners.append(storeResult)
+
+
+@api_view(['GET'])
+@permission_classes([])
+def vhlrReady(request):
+	if settings.VHLR_DISPATCH == 'queue':
+		try:
+			ready = {'ready': bool(redis_client.ping())}
+		except Exception as e:
+			ready = {'ready': False, 'error': str(e)}
+	else:
+		host = vhlr_engine.host()
+		if not host.isReady():
+			# A failed or lost engine is started again, the balancer sees 503 until it's up
+			host.start(timeout=0)
+		ready = host.status()
+
+	return Response(ready, status=status.HTTP_200_OK if ready['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def vhlrMetrics(request):
+	metrics = {
+		'redis': vhlr_redis.stats(),
+		'negative_filter': vhlr_filter.stats(),
+		'engine_loops': engineLoops(),
+	}
+	return Response(metrics, status=status.HTTP_200_OK)
+
+
+def engineLoops():
+	"""
+	Background tasks and event loop lag per dialer node: from the snapshots
+	the workers publish in queue mode, else this web worker's engine, which
+	is not started for it.
+	"""
+	if settings.VHLR_DISPATCH == 'queue':
+		try:
+			return {snapshot['node']: snapshot.get('loop') for snapshot in queue_client.snapshots()}
+		except Exception as e:
+			return {'error': str(e)}
+
+	host = vhlr_engine.host()
+	try:
+		stats = host.loopStats(timeout=5)
+	except vhlr_engine.EngineNotReady as e:
+		return {'error': str(e)}
+	return {host.engine.config.node: stats}
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def vhlrCalls(request):
+	"""
+	In-flight lookups: every call with its state, age, node and pending
+	FreeSWITCH command, plus counts by state. In queue mode the snapshots
+	the workers publish every few seconds, inline only this web worker's
+	engine.
+	"""
+	if settings.VHLR_DISPATCH == 'queue':
+		try:
+			snapshots = queue_client.snapshots()
+		except Exception as e:
+			return Response({'error': str(e)}, status=status.HTTP_502_BAD_GATEWAY)
+	else:
+		try:
+			snapshots = [vhlr_engine.host().snapshot(timeout=5)]
+		except vhlr_engine.EngineNotReady as e:
+			return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+	calls = [call for snapshot in snapshots for call in snapshot['calls']]
+	result = vhlr_engine.summarizeCalls(calls)
+	result['nodes'] = {
+		snapshot['node']: {
+			'calls': len(snapshot['calls']),
+			'lookups': snapshot['lookups'],
+			'retry_pending': snapshot['retry_pending'],
+			'priorities': snapshot.get('priorities'),
+		} for snapshot in snapshots
+	}
+	result['calls'] = sorted(calls, key=lambda call: call['age'], reverse=True)
+	return Response(result, status=status.HTTP_200_OK)
+
+
+_outcome_stats = None
+
+def outcomeStats():
+	global _outcome_stats
+	if _outcome_stats is None:
+		call_stats = vhlr_engine.importFreeswitch('call_stats')
+		_outcome_stats = call_stats.OutcomeStats(settings.VHLR_STATS['path'], settings.VHLR_STATS['capacity'], readonly=True)
+	return _outcome_stats
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def vhlrStats(request):
+	"""
+	Outcomes per number prefix and gateway over a sliding window: share of
+	each SIP code, median time to ring and timeout rate.
+	Query: window (sec), digits (prefix length), limit (groups).
+	"""
+	try:
+		window = int(request.query_params.get('window', settings.VHLR_STATS['window']))
+		digits = int(request.query_params['digits']) if request.query_params.get('digits') else None
+		limit = int(request.query_params.get('limit', 100))
+	except ValueError as e:
+		return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+	try:
+		stats = outcomeStats()
+	except OSError as e:
+		return Response({'error': 'No outcome stats: %s' % e}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+	started = time.monotonic()
+	prefixes = stats.summary(window, digits, limit)
+	return Response({
+		'window': window,
+		'prefixes': prefixes,
+		'elapsed': round(time.monotonic() - started, 4),
+	}, status=status.HTTP_200_OK)
 
- # Create a connection pool
-redis_pool = redis.ConnectionPool(host='localhost', port=6379, db=3)
-# Connect to Redis using the pool
-redis_client = redis.StrictRedis(connection_pool=redis_pool)
-redis_expire_timeout = 60
 
 @api_view(['POST'])
+@permission_classes([IsAdminUser])
+def vhlrProfile(request):
+	"""
+	Start profiling this web worker for seconds sec on a thread of its own,
+	one profile at a time. Answers 202 with the id to fetch the result from
+	at vhlr/profile/<id>/, which any web worker serves.
+	mode=sample (default): stacks of all threads, the engine loop and the
+	request threads, every interval sec, as collapsed stacks for
+	flamegraph.pl or speedscope. mode=cprofile: deterministic profile of the
+	engine loop thread as pstats text, ordered by sort, limit lines. Inline
+	dispatch only: in queue mode the dialer runs in vhlr_worker processes.
+	"""
+	params = request.query_params
+	mode = params.get('mode', 'sample')
+	try:
+		seconds = float(params.get('seconds', 10))
+		interval = float(params.get('interval', 0.005))
+		limit = int(params.get('limit', 50))
+	except ValueError as e:
+		return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+	if mode not in ('sample', 'cprofile'):
+		return Response({'error': 'mode must be sample or cprofile'}, status=status.HTTP_400_BAD_REQUEST)
+	if not 0 < seconds <= PROFILE_MAX_SECONDS or interval <= 0:
+		return Response({'error': 'seconds must be in (0, %s], interval positive' % PROFILE_MAX_SECONDS},
+			status=status.HTTP_400_BAD_REQUEST)
+
+	sort = params.get('sort', 'cumulative')
+	if mode == 'cprofile':
+		if settings.VHLR_DISPATCH == 'queue':
+			return Response({'error': 'cprofile needs inline dispatch, in queue mode this worker runs no engine'},
+				status=status.HTTP_400_BAD_REQUEST)
+		if sort not in pstats.Stats.sort_arg_dict_default:
+			return Response({'error': 'Unknown sort %s' % sort}, status=status.HTTP_400_BAD_REQUEST)
+		if not vhlr_engine.host().isReady():
+			return Response({'error': 'VHLR engine is not ready'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+	profile_id = uuid.uuid4().hex
+	key = PROFILE_KEY_PREFIX + profile_id
+	try:
+		vhlr_profiler.background(runProfile, key, mode, seconds, interval, sort, limit)
+	except vhlr_profiler.ProfilerBusy as e:
+		return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+	try:
+		# nx: a short profile may be done already
+		redis_client.set(key, json.dumps({'status': 'running'}), ex=int(seconds) + PROFILE_RESULT_TTL, nx=True)
+	except Exception as e:
+		return Response({'error': 'Cannot keep the result: %s' % e}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+	return Response({
+		'id': profile_id,
+		'mode': mode,
+		'seconds': seconds,
+		'result': '%s%s/' % (request.path, profile_id),
+	}, status=status.HTTP_202_ACCEPTED)
+
+
+def runProfile(key, mode, seconds, interval, sort, limit):
+	# On the profiler thread, the result is fetched by vhlrProfileResult()
+	try:
+		if mode == 'sample':
+			body = vhlr_profiler.collapsed(vhlr_profiler.sample(seconds, interval))
+		else:
+			body = vhlr_profiler.statsText(vhlr_engine.host().profile(seconds), sort, limit)
+		result = {'status': 'done', 'body': body}
+	except vhlr_engine.EngineNotReady as e:
+		result = {'status': 'failed', 'error': str(e), 'code': status.HTTP_503_SERVICE_UNAVAILABLE}
+	except Exception as e:
+		logger.exception('Profile %s failed', key)
+		result = {'status': 'failed', 'error': str(e), 'code': status.HTTP_500_INTERNAL_SERVER_ERROR}
+
+	try:
+		redis_client.setex(key, PROFILE_RESULT_TTL, json.dumps(result))
+	except Exception as e:
+		logger.error('Failed to store profile %s: %s', key, e)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def vhlrProfileResult(request, profile_id):
+	"""Result of a profile started with vhlr/profile/: 202 while it runs."""
+	try:
+		value = redis_client.get(PROFILE_KEY_PREFIX + profile_id)
+	except Exception as e:
+		return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+	if value is None:
+		return Response({'error': 'Unknown or expired profile'}, status=status.HTTP_404_NOT_FOUND)
+
+	result = json.loads(value)
+	if result['status'] == 'running':
+		return Response(result, status=status.HTTP_202_ACCEPTED)
+	if result['status'] == 'failed':
+		return Response({'error': result['error']}, status=result['code'])
+	return HttpResponse(result['body'], content_type='text/plain; charset=utf-8')
+
+
+@rateHeaders
+@api_view(['POST'])
+@throttle_classes([ClientRateThrottle])
 def vhlrRequest(request):
+	started = time.time()
 	connect_timeout = 7
+	deadline = None
 	data = request.data
 	try:
 		dst_number = data['dst_number']
 		if data.get('connect_timeout'):
 			connect_timeout = int(data['connect_timeout'])
+		# interactive, bulk or refresh, see vhlr_callgen.DialScheduler
+		priority = data.get('priority') or 'interactive'
+		if priority not in priorities.NAMES:
+			raise ValueError('unknown priority %s' % priority)
+		# One key for every spelling of the number: filter, cache, single-flight and dial
+		number = vhlr_engine.normalizer().normalize(dst_number)
+		# The client's own time budget (sec): the answer comes within it, with
+		# the call state so far if the call isn't over
+		timeout = data.get('timeout') or request.headers.get('X-Request-Timeout')
+		if timeout:
+			timeout = float(timeout)
+			if timeout <= 0:
+				raise ValueError('timeout must be positive')
+			deadline = started + timeout
 	except Exception as e:
 		messageExist = {'Cant accept HLR request. Error: %s' % e}
 		return Response(messageExist)
 	
-	# Get a value from the cache
-	try:
-		redis_value = redis_client.get(dst_number)
-	except Exception as e:
-		redis_value = None
+	# Known dead numbers first, then the cache
+	disconnect_code = vhlr_filter.deadCode(number) or getCode(number)
 
-	if redis_value:
-		disconnect_code = redis_value.decode('utf-8')
+	if disconnect_code:
 		messageExist = {'number': dst_number, 'code': disconnect_code}
 	else:
-		disconnect_code = vhlr_callgen.main({'dst_number': dst_number, 'connect_timeout': connect_timeout})
+		if deadline is not None and time.time() >= deadline:
+			return deadlineExceeded(dst_number)
+
+		retrying = False
+		if settings.VHLR_DISPATCH == 'queue':
+			try:
+				result = queue_client.lookup(number, connect_timeout, priority, deadline)
+			except QueueTimeout as e:
+				return Response({'number': dst_number, 'error': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+			except Exception as e:
+				return Response({'number': dst_number, 'error': str(e)}, status=status.HTTP_502_BAD_GATEWAY)
+			disconnect_code = result['code']
+			retrying = result.get('retrying', False)
+			partial = result.get('partial', False)
+		else:
+			try:
+				disconnect_code, retrying, partial = vhlr_engine.host().lookup(number, connect_timeout,
+					timeout=connect_timeout + settings.VHLR_ENGINE_WAIT_MARGIN, priority=priority, deadline=deadline)
+			except vhlr_engine.EngineNotReady as e:
+				return Response({'number': dst_number, 'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+			except vhlr_engine.EngineTimeout as e:
+				return Response({'number': dst_number, 'error': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+		if partial and not disconnect_code:
+			return deadlineExceeded(dst_number)
 		messageExist = {'number': dst_number, 'code': disconnect_code}
 
-		# Add number status to the Redis
-		try:
-			redis_client.setex(dst_number, redis_expire_timeout, disconnect_code)
-		except Exception as e:
-			pass
+		if partial:
+			# The state so far, not an outcome: not cached
+			messageExist['partial'] = True
+		elif retrying:
+			# The dialer re-queued the number and caches the final outcome itself
+			messageExist['retrying'] = True
+		elif not vhlr_engine.isRetryable(disconnect_code):
+			# Add number status to the Redis, transient congestion is not cached
+			storeResult(number, disconnect_code)
 
 	return Response(messageExist, status=status.HTTP_200_OK)
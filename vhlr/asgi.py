@@ -14,3 +14,20 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vhlr.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings
+from base.cache import vhlr_redis
+from base.engine import vhlr_engine
+
+vhlr_redis.startSnapshots()
+vhlr_engine.prewarm()
+
+if settings.VHLR_FASTPATH:
+    # api/vhlr/ is answered before the Django/DRF stack, cache misses dialed on the event loop
+    from base.asgi.vhlr_fastpath import FastPath
+    application = FastPath(application)
+
+if settings.VHLR_WEBSOCKET['enabled']:
+    # Many lookups per connection for high-rate clients
+    from base.asgi.vhlr_websocket import LookupSocket
+    application = LookupSocket(application, settings.VHLR_WEBSOCKET)
@@ -179,3 +179,126 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Number status cache (base/cache/vhlr_redis.py)
+# Several nodes are sharded by consistent hashing, e.g. local redis-server
+# processes on ports 6379, 6380 and 6381. With 'cluster' set, the first node
+# is the entry point of a Redis Cluster that routes keys itself (db 0 only).
+VHLR_REDIS = {
+    'nodes': [
+        {'host': 'localhost', 'port': 6379, 'db': 3},
+    ],
+    'cluster': False,
+    'expire': 60,  # sec
+    'socket_timeout': 0.1,  # sec, a slow Redis must not hold requests
+    'socket_connect_timeout': 0.1,
+    'breaker_threshold': 5,  # consecutive failures that open the circuit
+    'breaker_cooldown': 10,  # sec without Redis calls once it is open
+    'local_maxsize': 100000,  # entries in the in-process fallback
+    # Every write is published on this channel and applied to the in-process
+    # cache of every worker, which then serves reads before Redis for up to
+    # local_ttl sec (default: expire). None - Redis first, the in-process
+    # cache is only the fallback.
+    'invalidation_channel': 'vhlr:cache:updates',
+    'local_ttl': None,  # sec
+    # Server processes (vhlr/wsgi.py, vhlr/asgi.py) save the fallback here
+    # every snapshot_period sec and on exit, and load it on start, skipping
+    # expired entries. None - no snapshots.
+    'snapshot_path': os.environ.get('VHLR_CACHE_SNAPSHOT', '/var/lib/vhlr/local_cache.bin'),
+    'snapshot_period': 60,  # sec
+}
+
+# Numbers recently found dead, shared by the workers of a host through
+# memory-mapped files (base/cache/vhlr_filter.py). error_rate is the false
+# positive rate of a lookup, which probes every cause and generation, so
+# each of those gets its share: capacity is per generation, the defaults
+# take ~9 MB per generation and cause.
+VHLR_NEGATIVE_FILTER = {
+    'enabled': True,
+    'dir': os.environ.get('VHLR_NEGATIVE_FILTER_DIR', '/var/lib/vhlr/negative'),
+    'causes': ['UNALLOCATED_NUMBER', 'NUMBER_CHANGED'],
+    'capacity': 1000000,
+    'error_rate': 0.001,
+    'max_age': 86400,  # sec
+    'generations': 4,
+}
+
+# VHLR lookup dispatch
+# 'inline' - dial from the web worker's own engine thread (base/engine/vhlr_engine.py)
+# 'queue'  - enqueue to a Redis stream served by base/freeswitch/vhlr_worker.py
+VHLR_DISPATCH = os.environ.get('VHLR_DISPATCH', 'inline')
+
+VHLR_QUEUE = {
+    'stream': 'vhlr:lookups',  # interactive lookups, other priorities go to <stream>:bulk and <stream>:refresh
+    'stream_maxlen': 100000,
+    'result_key_prefix': 'vhlr:result:',
+    'wait_margin': 30,  # sec, queue wait allowed on top of connect_timeout
+    'calls_key_prefix': 'vhlr:calls:',  # in-flight call snapshots published by the workers
+}
+
+# Call outcomes per prefix and gateway, a ring buffer in a memory-mapped file
+# (base/freeswitch/call_stats.py) the dialers of the host write to. 24 bytes
+# per outcome. The dedicated workers must use the same path.
+VHLR_STATS = {
+    'path': os.environ.get('VHLR_STATS_PATH', '/var/lib/vhlr/outcomes.bin'),
+    'capacity': 1000000,  # outcomes
+    'prefix_digits': 6,
+    'window': 3600,  # sec, default window of api/vhlr/stats/
+}
+
+# vhlr_callgen.Config overrides for the in-process engine
+VHLR_ENGINE = {
+    'cps': 1,
+    'max_calls_count': 10,
+    'reconnect_schedule': [5, 20, 60],
+    'stats_path': VHLR_STATS['path'],
+    'stats_capacity': VHLR_STATS['capacity'],
+    'stats_prefix_digits': VHLR_STATS['prefix_digits'],
+}
+VHLR_ENGINE_WAIT_MARGIN = 30  # sec, slot and CPS wait allowed on top of connect_timeout
+
+# Start the engine, connect to FreeSWITCH and resolve the profile when the
+# server loads vhlr/wsgi.py or vhlr/asgi.py, waiting up to
+# VHLR_PREWARM_TIMEOUT sec before taking traffic; api/vhlr/ready/ starts it
+# again if it failed. Serve with --preload off: the engine thread does not
+# survive a fork.
+VHLR_PREWARM = os.environ.get('VHLR_PREWARM', '1') == '1'
+VHLR_PREWARM_TIMEOUT = 10
+
+# Answer api/vhlr/ in vhlr/asgi.py without the DRF stack, cache misses are
+# dialed on the event loop (base/asgi/vhlr_fastpath.py)
+VHLR_FASTPATH = True
+# Per process, threads of the ASGI fast path and WebSocket waiting on queue dispatch results
+VHLR_ASGI_LOOKUP_THREADS = 64
+
+# WebSocket lookups (base/asgi/vhlr_websocket.py): many lookups on one
+# authenticated connection, results pushed as they finish
+VHLR_WEBSOCKET = {
+    'enabled': True,
+    'path': '/api/vhlr/ws/',
+    'max_inflight': 100,  # lookups per connection, no message is read while this many run
+    'send_queue': 100,  # results waiting for a slow client
+}
+
+# dst_number normalization to E.164 digits (base/freeswitch/number_utils.py),
+# the key of the caches and the number dialed
+VHLR_NUMBERS = {
+    'default_country': '49',
+    'trunk_prefix': '0',  # None for countries without one, then national_length applies
+    'international_prefixes': ['00'],
+    'rules': {},  # extra prefix -> replacement rules, e.g. {'0049': '49'}
+    'national_length': None,
+    'min_length': 7,
+    'max_length': 15,
+}
+
+# Per-client (JWT user) limits of api/vhlr/, enforced in the VHLR_REDIS cache
+VHLR_RATE_LIMIT = {
+    'enabled': True,
+    'key_prefix': 'vhlr:rate:',
+    'rate': 5,  # lookups per sec
+    'burst': 20,
+    'daily_quota': 50000,  # lookups per UTC day, 0 - unlimited
+    'clients': {},  # user id (str) -> overrides of rate, burst and daily_quota
+}
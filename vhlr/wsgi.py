@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vhlr.settings')
 
 application = get_wsgi_application()
+
+from base.cache import vhlr_redis
+from base.engine import vhlr_engine
+
+vhlr_redis.startSnapshots()
+vhlr_engine.prewarm()